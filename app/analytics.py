@@ -0,0 +1,181 @@
+import argparse
+import json
+from datetime import datetime, timedelta, UTC
+from typing import NamedTuple
+
+import numpy as np
+from sqlalchemy import Integer, case, cast, func, select
+
+from app.database import engine as default_engine, init_db
+from app.workers import to_utc_naive
+from app.models import BankAccount, Operation, DEPOSIT, WITHDRAWAL, TRANSFER_IN, OPERATION_KINDS
+
+CHUNK_SIZE = 200_000
+PERCENTILES = (50, 90, 95, 99)
+SECONDS_PER_DAY = 86_400
+
+# Коды видов операций — индексы в OPERATION_KINDS.
+KIND_CODES = {kind: code for code, kind in enumerate(OPERATION_KINDS)}
+INFLOW_KINDS = (KIND_CODES["deposit"], KIND_CODES["transfer_in"])
+
+OPERATION_DTYPE = np.dtype([("account_id", np.int64), ("amount", np.float64), ("timestamp", np.int64), ("kind", np.int8)])
+ACCOUNT_DTYPE = np.dtype([("id", np.int64), ("balance", np.float64)])
+
+
+class OperationColumns(NamedTuple):
+    account_id: np.ndarray
+    amount: np.ndarray
+    timestamp: np.ndarray
+    kind: np.ndarray
+
+
+class AccountColumns(NamedTuple):
+    id: np.ndarray
+    balance: np.ndarray
+
+
+def _epoch_seconds(column, dialect):
+    if dialect.name == "sqlite":
+        # unixepoch() (SQLite 3.38+) заметно дешевле strftime('%s') на миллионах строк.
+        if dialect.dbapi.sqlite_version_info >= (3, 38):
+            return func.unixepoch(column)
+        return cast(func.strftime("%s", column), Integer)
+    return cast(func.extract("epoch", column), Integer)
+
+
+def _kind_code():
+    return case(
+        (Operation.type == DEPOSIT, KIND_CODES["deposit"]),
+        (Operation.type == WITHDRAWAL, KIND_CODES["withdrawal"]),
+        (Operation.type.startswith(TRANSFER_IN), KIND_CODES["transfer_in"]),
+        else_=KIND_CODES["transfer_out"],
+    )
+
+
+def _fill(conn, query, dtype: np.dtype, total: int, chunk_size: int):
+    # Пачки строк читаются прямо из курсора DBAPI (все колонки — числа, обработка
+    # результата SQLAlchemy не нужна) и копируются в заранее выделенный структурный
+    # массив: в памяти одновременно только он и одна пачка кортежей.
+    data = np.empty(total, dtype)
+    offset = 0
+    result = conn.execute(query)
+    try:
+        while rows := result.cursor.fetchmany(chunk_size):
+            end = offset + len(rows)
+            if end > len(data):
+                # Между COUNT и чтением успели добавиться строки.
+                data = np.concatenate([data, np.empty(end - len(data), dtype)])
+            data[offset:end] = np.fromiter(rows, dtype, count=len(rows))
+            offset = end
+    finally:
+        result.close()
+    return tuple(data[name][:offset] for name in dtype.names)
+
+
+def load_operations(conn, date_from: datetime | None = None, date_to: datetime | None = None,
+                    chunk_size: int = CHUNK_SIZE):
+    """Операции в виде колонок NumPy: ID счёта, сумма по модулю, время (секунды UTC), код вида."""
+    conditions = [Operation.account_id.is_not(None), Operation.timestamp.is_not(None)]
+    if date_from is not None:
+        conditions.append(Operation.timestamp >= to_utc_naive(date_from))
+    if date_to is not None:
+        conditions.append(Operation.timestamp <= to_utc_naive(date_to))
+
+    total = conn.scalar(select(func.count()).select_from(Operation).where(*conditions))
+    query = select(
+        Operation.account_id,
+        func.abs(Operation.amount),
+        _epoch_seconds(Operation.timestamp, conn.dialect),
+        _kind_code(),
+    ).where(*conditions)
+    return OperationColumns(*_fill(conn, query, OPERATION_DTYPE, total, chunk_size))
+
+
+def load_accounts(conn, chunk_size: int = CHUNK_SIZE):
+    total = conn.scalar(select(func.count()).select_from(BankAccount))
+    query = select(BankAccount.id, BankAccount.balance)
+    return AccountColumns(*_fill(conn, query, ACCOUNT_DTYPE, total, chunk_size))
+
+
+def cash_flow_per_day(ops: OperationColumns):
+    days, index = np.unique(ops.timestamp // SECONDS_PER_DAY, return_inverse=True)
+    inflow_mask = np.isin(ops.kind, INFLOW_KINDS)
+    inflow = np.bincount(index, weights=np.where(inflow_mask, ops.amount, 0.0), minlength=len(days))
+    outflow = np.bincount(index, weights=np.where(inflow_mask, 0.0, ops.amount), minlength=len(days))
+    counts = np.bincount(index, minlength=len(days))
+    epoch = datetime(1970, 1, 1).date()
+    return [
+        {"day": (epoch + timedelta(days=int(day))).isoformat(), "in": float(i), "out": float(o),
+         "net": float(i - o), "operations": int(c)}
+        for day, i, o, c in zip(days, inflow, outflow, counts)
+    ]
+
+
+def amount_percentiles(ops: OperationColumns, percentiles=PERCENTILES):
+    report = {}
+    for kind in ("deposit", "withdrawal"):
+        amounts = ops.amount[ops.kind == KIND_CODES[kind]]
+        values = np.percentile(amounts, percentiles) if len(amounts) else [None] * len(percentiles)
+        report[kind] = {f"p{p}": (None if v is None else float(v)) for p, v in zip(percentiles, values)}
+    return report
+
+
+def top_accounts_by_volume(ops: OperationColumns, n: int = 10):
+    if not len(ops.account_id):
+        return []
+    volume = np.bincount(ops.account_id, weights=ops.amount)
+    counts = np.bincount(ops.account_id, minlength=len(volume))
+    n = min(n, np.count_nonzero(counts))
+    if n < 1:
+        return []
+    top = np.argpartition(-volume, n - 1)[:n]
+    top = top[np.argsort(-volume[top], kind="stable")]
+    return [{"account_id": int(i), "volume": float(volume[i]), "operations": int(counts[i])} for i in top]
+
+
+def dormant_accounts(ops: OperationColumns, accounts: AccountColumns, since: datetime):
+    """Счета без операций с момента since (или совсем без операций)."""
+    size = int(max(accounts.id.max(initial=0), ops.account_id.max(initial=0))) + 1
+    last_seen = np.full(size, -1, np.int64)
+    np.maximum.at(last_seen, ops.account_id, ops.timestamp)
+    cutoff = int(since.replace(tzinfo=since.tzinfo or UTC).timestamp())
+    dormant = last_seen[accounts.id] < cutoff
+    return {
+        "count": int(np.count_nonzero(dormant)),
+        "balance": float(accounts.balance[dormant].sum()),
+        "account_ids": accounts.id[dormant].tolist(),
+    }
+
+
+def build_report(conn, date_from: datetime | None = None, date_to: datetime | None = None, top: int = 10,
+                 dormant_days: int = 90, now: datetime | None = None, chunk_size: int = CHUNK_SIZE):
+    now = now or datetime.now(UTC)
+    ops = load_operations(conn, date_from, date_to, chunk_size)
+    # Для неактивных счетов нужна вся история, а не только выбранный период.
+    activity = ops if date_from is None and date_to is None else load_operations(conn, chunk_size=chunk_size)
+    return {
+        "operations": len(ops.amount),
+        "cash_flow": cash_flow_per_day(ops),
+        "percentiles": amount_percentiles(ops),
+        "top_accounts": top_accounts_by_volume(ops, top),
+        "dormant": dormant_accounts(activity, load_accounts(conn, chunk_size), now - timedelta(days=dormant_days)),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Отчёты по всем счетам: обороты по дням, перцентили, топ, неактивные")
+    parser.add_argument("--date-from", type=datetime.fromisoformat, default=None)
+    parser.add_argument("--date-to", type=datetime.fromisoformat, default=None)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--dormant-days", type=int, default=90)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    init_db()
+    with default_engine.connect() as conn:
+        report = build_report(conn, args.date_from, args.date_to, args.top, args.dormant_days, chunk_size=args.chunk_size)
+    print(json.dumps(report, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,32 @@
-from fastapi import APIRouter, HTTPException
-from app.schemas.account import BankAccountCreate, BankAccountOut, DepositRequest, WithdrawRequest, TransferRequest
-from app import functions
+import io
+import tempfile
+from datetime import datetime
+from typing import Literal
+
+from fastapi import APIRouter, HTTPException, Header, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from app.schemas.account import (
+    BankAccountCreate, BankAccountOut, DepositRequest, WithdrawRequest, TransferRequest,
+    SessionRequest, SessionOut, BatchRequest, BatchResult, OperationPage, BalanceOut, StatementOut
+)
+from app import functions, importer, export
+from app.responses import FastJSONResponse
+from app.transactions import TransactionConflict
 from sqlalchemy.exc import SQLAlchemyError
 
 router = APIRouter()
 
+
+def _require_credentials(pin: str | None, token: str | None):
+    if pin is None and token is None:
+        raise HTTPException(status_code=422, detail="Требуется PIN-код или токен сессии")
+
+
 @router.post("/accounts/", response_model=BankAccountOut)
-def create_account(account: BankAccountCreate):
+async def create_account(account: BankAccountCreate):
     try:
-        created = functions.create_account(
+        created = await functions.create_account_async(
             owner=account.owner,
             pin=account.pin,
             initial_balance=account.balance
@@ -19,72 +37,237 @@ def create_account(account: BankAccountCreate):
     except SQLAlchemyError:
         raise HTTPException(status_code=500, detail="Ошибка при работе с базой данных")
 
+@router.post("/accounts/import")
+async def import_accounts(request: Request, format: str | None = None):
+    if functions.shard_router is not None:
+        raise HTTPException(status_code=400, detail="Импорт счетов не поддерживается при шардировании счетов")
+    fmt = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    # Тело пишется во временный файл (в памяти до 8 МБ, дальше на диск),
+    # а импорт читает его построчно в пуле потоков.
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as buffer:
+        async for chunk in request.stream():
+            buffer.write(chunk)
+        buffer.seek(0)
+        try:
+            return await run_in_threadpool(
+                importer.import_accounts,
+                io.TextIOWrapper(buffer, encoding="utf-8", newline=""),
+                fmt
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except SQLAlchemyError:
+            raise HTTPException(status_code=500, detail="Ошибка при работе с базой данных")
+
+@router.post("/accounts/{account_id}/session", response_model=SessionOut)
+async def create_session(account_id: int, request: SessionRequest):
+    try:
+        token, expires_in = await functions.create_session_async(
+            account_id=account_id,
+            pin=request.pin
+        )
+        return {"token": token, "expires_in": expires_in}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except SQLAlchemyError:
+        raise HTTPException(status_code=500, detail="Ошибка при работе с базой данных")
+
 @router.get("/accounts/{account_id}", response_model=BankAccountOut)
-def get_account_by_id(account_id: int, pin: str):
+async def get_account_by_id(account_id: int, pin: str | None = None, x_session_token: str | None = Header(default=None)):
+    _require_credentials(pin, x_session_token)
     try:
-        account = functions.get_account_by_id(
+        account = await functions.get_account_by_id_async(
             account_id=account_id,
-            pin=pin
+            pin=pin,
+            token=x_session_token
+        )
+        return FastJSONResponse(account.json())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except SQLAlchemyError:
+        raise HTTPException(status_code=500, detail="Ошибка при работе с базой данных")
+
+@router.get("/accounts/{account_id}/operations", response_model=OperationPage)
+async def get_operations(
+    account_id: int,
+    pin: str | None = None,
+    limit: int = Query(default=50, ge=1, le=500),
+    cursor: str | None = None,
+    date_from: datetime | None = None,
+    date_to: datetime | None = None,
+    type: Literal["deposit", "withdraw", "withdrawal", "transfer", "transfer_in", "transfer_out"] | None = None,
+    x_session_token: str | None = Header(default=None)
+):
+    _require_credentials(pin, x_session_token)
+    try:
+        page = await functions.get_operations_page_async(
+            account_id=account_id,
+            pin=pin,
+            token=x_session_token,
+            limit=limit,
+            cursor=cursor,
+            date_from=date_from,
+            date_to=date_to,
+            op_type=type
+        )
+        return FastJSONResponse(page)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except SQLAlchemyError:
+        raise HTTPException(status_code=500, detail="Ошибка при работе с базой данных")
+
+@router.get("/accounts/{account_id}/balance", response_model=BalanceOut)
+async def get_balance(account_id: int, pin: str | None = None, as_of: datetime | None = None,
+                      x_session_token: str | None = Header(default=None)):
+    _require_credentials(pin, x_session_token)
+    try:
+        balance = await functions.get_balance_as_of_async(
+            account_id=account_id,
+            as_of=as_of,
+            pin=pin,
+            token=x_session_token
+        )
+        return FastJSONResponse({"account_id": account_id, "balance": balance, "as_of": as_of})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except SQLAlchemyError:
+        raise HTTPException(status_code=500, detail="Ошибка при работе с базой данных")
+
+@router.get("/accounts/{account_id}/statement", response_model=StatementOut)
+async def get_statement(account_id: int, period: str, pin: str | None = None,
+                        x_session_token: str | None = Header(default=None)):
+    _require_credentials(pin, x_session_token)
+    try:
+        return await functions.get_statement_async(
+            account_id=account_id,
+            period=period,
+            pin=pin,
+            token=x_session_token
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except SQLAlchemyError:
+        raise HTTPException(status_code=500, detail="Ошибка при работе с базой данных")
+
+@router.get("/accounts/{account_id}/operations/export")
+async def export_operations(
+    account_id: int,
+    pin: str | None = None,
+    format: Literal["ndjson", "csv"] = "ndjson",
+    gzip: bool = False,
+    x_session_token: str | None = Header(default=None)
+):
+    _require_credentials(pin, x_session_token)
+    try:
+        chunks = await functions.export_history_async(
+            account_id=account_id,
+            pin=pin,
+            token=x_session_token,
+            fmt=format,
+            compress=gzip
         )
-        return account
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except SQLAlchemyError:
         raise HTTPException(status_code=500, detail="Ошибка при работе с базой данных")
+    return StreamingResponse(
+        chunks,
+        media_type=export.media_type(format, gzip),
+        headers={"Content-Disposition": f'attachment; filename="account-{account_id}-operations.{export.file_extension(format, gzip)}"'}
+    )
 
 
-@router.post("/accounts/{account_id}/deposit")
-def deposit_to_account(account_id: int, request: DepositRequest):
+@router.post("/accounts/{account_id}/deposit", response_model=BankAccountOut)
+async def deposit_to_account(account_id: int, request: DepositRequest, x_session_token: str | None = Header(default=None),
+                             idempotency_key: str | None = Header(default=None)):
+    _require_credentials(request.pin, x_session_token)
     try:
-        account = functions.deposit_to_account(
+        account = await functions.deposit_to_account_async(
             account_id=account_id,
             amount=request.amount,
-            pin=request.pin
+            pin=request.pin,
+            token=x_session_token,
+            idempotency_key=idempotency_key
         )
         return account
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except TransactionConflict:
+        raise HTTPException(status_code=503, detail="База данных занята, повторите запрос позже", headers={"Retry-After": "1"})
     except SQLAlchemyError:
         raise HTTPException(status_code=500, detail="Ошибка при работе с базой данных")
 
-@router.post("/accounts/{account_id}/withdraw")
-def withdraw_from_account(account_id: int, request: WithdrawRequest):
+@router.post("/accounts/{account_id}/withdraw", response_model=BankAccountOut)
+async def withdraw_from_account(account_id: int, request: WithdrawRequest, x_session_token: str | None = Header(default=None),
+                                idempotency_key: str | None = Header(default=None)):
+    _require_credentials(request.pin, x_session_token)
     try:
-        account = functions.withdraw_from_account(
+        account = await functions.withdraw_from_account_async(
             account_id=account_id,
             amount=request.amount,
-            pin=request.pin
+            pin=request.pin,
+            token=x_session_token,
+            idempotency_key=idempotency_key
         )
         return account
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except TransactionConflict:
+        raise HTTPException(status_code=503, detail="База данных занята, повторите запрос позже", headers={"Retry-After": "1"})
     except SQLAlchemyError:
         raise HTTPException(status_code=500, detail="Ошибка при работе с базой данных")
-    
-@router.post("/accounts/{from_id}/{to_id}/transfer")
-def transfer_money_to_account(from_id: int, to_id: int, request: TransferRequest):
+
+@router.post("/accounts/{from_id}/{to_id}/transfer", response_model=list[BankAccountOut])
+async def transfer_money_to_account(from_id: int, to_id: int, request: TransferRequest,
+                                    x_session_token: str | None = Header(default=None),
+                                    idempotency_key: str | None = Header(default=None)):
+    _require_credentials(request.pin, x_session_token)
     try:
-        to_account, from_account = functions.transfer_money(
+        to_account, from_account = await functions.transfer_money_async(
             from_id=from_id,
             to_id=to_id,
             amount=request.amount,
-            pin=request.pin
+            pin=request.pin,
+            token=x_session_token,
+            idempotency_key=idempotency_key
         )
         return from_account, to_account
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except TransactionConflict:
+        raise HTTPException(status_code=503, detail="База данных занята, повторите запрос позже", headers={"Retry-After": "1"})
     except SQLAlchemyError:
         raise HTTPException(status_code=500, detail="Ошибка при работе с базой данных")
-    
+
 @router.delete("/accounts/delete/{account_id}")
-def delete_account(account_id: int, pin: str):
+async def delete_account(account_id: int, pin: str | None = None, x_session_token: str | None = Header(default=None)):
+    _require_credentials(pin, x_session_token)
     try:
-        message = functions.delete_account(
+        message = await functions.delete_account_async(
             account_id=account_id,
-            pin=pin
+            pin=pin,
+            token=x_session_token
         )
         return {"message": message}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except TransactionConflict:
+        raise HTTPException(status_code=503, detail="База данных занята, повторите запрос позже", headers={"Retry-After": "1"})
     except SQLAlchemyError:
-        raise HTTPException(status_code=500, detail="Ошибка при работе с базой данных")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Ошибка при работе с базой данных")
+
+@router.post("/operations/batch", response_model=list[BatchResult])
+async def apply_batch(request: BatchRequest):
+    for operation in request.operations:
+        _require_credentials(operation.pin, operation.token)
+    try:
+        return await functions.apply_batch_async(
+            operations=[operation.model_dump() for operation in request.operations],
+            atomic=request.atomic
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except TransactionConflict:
+        raise HTTPException(status_code=503, detail="База данных занята, повторите запрос позже", headers={"Retry-After": "1"})
+    except SQLAlchemyError:
+        raise HTTPException(status_code=500, detail="Ошибка при работе с базой данных")
@@ -0,0 +1,425 @@
+"""Архив старых операций.
+
+Операции старше горизонта (settings.archive_horizon_days, граница — полночь UTC)
+переносятся из таблицы operations в сжатые неизменяемые файлы-сегменты, по сегменту на
+диапазон из settings.archive_range_size счетов. Сегмент:
+
+    BANKARC1 | блок счёта (zlib, JSON) | ... | индекс (JSON) | длина индекса, BANKARC1
+
+Индекс в конце файла хранит для каждого счёта смещение и длину блока, число операций и
+сумму со знаком — сегмент проверяется и читается без базы. Для чтения из приложения те же
+сведения лежат в каталоге archived_accounts (плюс баланс после последней операции блока);
+строки каталога и удаление операций фиксируются одной транзакцией, после того как файл
+записан и сброшен на диск. Прерванный запуск оставляет только файл, которого нет в каталоге.
+
+История, выгрузка, страницы операций и баланс на дату дописывают архивные операции к
+«горячим» из таблицы. Все архивные операции счёта старше всех оставшихся в таблице:
+новые операции получают текущее время, а граница архива всегда в прошлом.
+
+    python -m app.archive run [--horizon-days 90]
+    python -m app.archive verify
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import struct
+import sys
+import uuid
+import zlib
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta, UTC
+from itertools import chain, groupby
+
+from sqlalchemy import delete, func, insert, select
+
+from app.cache import LRUCache
+from app.config import settings
+from app.database import SessionLocal, init_db
+from app.models import (
+    ArchiveSegment, ArchivedAccount, BalanceCheckpoint, BankAccount, DailyAggregate, Operation, WITHDRAWAL,
+    operation_kind
+)
+
+ARCHIVE_DIR = settings.archive_dir
+MAGIC = b"BANKARC1"
+FOOTER = struct.Struct(">Q8s")
+# Сумма со знаком сверяется с точностью до копеек накопленной ошибки float.
+TOLERANCE = 1e-6
+# Строк операций за одно чтение из базы при переносе в архив.
+READ_BATCH_SIZE = 1000
+
+ArchivedOperation = namedtuple("ArchivedOperation", "id type amount timestamp")
+
+# Сегменты неизменяемы, поэтому распакованные блоки можно держать без инвалидации.
+_blocks = LRUCache(maxsize=256)
+
+# Имя фильтра страницы операций -> виды operation_kind.
+_KIND_FILTERS = {
+    "deposit": {"deposit"},
+    "withdraw": {"withdrawal"},
+    "withdrawal": {"withdrawal"},
+    "transfer_in": {"transfer_in"},
+    "transfer_out": {"transfer_out"},
+    "transfer": {"transfer_in", "transfer_out"},
+}
+
+
+def _signed(op_type: str, amount: float):
+    return -amount if op_type == WITHDRAWAL else amount
+
+
+def _now():
+    return datetime.now(UTC).replace(tzinfo=None)
+
+
+def cutoff_for(horizon_days: int, now: datetime | None = None):
+    """Полночь UTC horizon_days дней назад: дни до неё уходят в архив целиком, и дневные
+    обороты за них остаются сверяемыми с архивом."""
+    now = now or _now()
+    return datetime.combine((now - timedelta(days=horizon_days)).date(), datetime.min.time())
+
+
+def _checksum(path: str):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_segment(directory: str, first_id: int, last_id: int, cutoff: datetime, accounts):
+    """Пишет сегмент из пар (счёт, операции счёта) по мере их поступления. Если пар
+    не оказалось, файла не остаётся и возвращается None."""
+    os.makedirs(directory, exist_ok=True)
+    name = f"operations_{first_id:09d}-{last_id:09d}_{cutoff:%Y%m%d}_{uuid.uuid4().hex[:8]}.seg"
+    path = os.path.join(directory, name)
+    index = {}
+    with open(path + ".tmp", "wb") as file:
+        file.write(MAGIC)
+        for account_id, rows in accounts:
+            payload = zlib.compress(json.dumps(
+                [[row.id, row.type, row.amount, row.timestamp.isoformat()] for row in rows], ensure_ascii=False
+            ).encode())
+            index[str(account_id)] = {
+                "offset": file.tell(), "length": len(payload), "operations": len(rows),
+                "total": sum(_signed(row.type, row.amount) for row in rows),
+            }
+            file.write(payload)
+        footer = json.dumps({"version": 1, "cutoff": cutoff.isoformat(), "accounts": index}).encode()
+        file.write(footer)
+        file.write(FOOTER.pack(len(footer), MAGIC))
+        file.flush()
+        os.fsync(file.fileno())
+    if not index:
+        os.remove(path + ".tmp")
+        return None
+    os.replace(path + ".tmp", path)
+    return name, index
+
+
+def read_index(path: str):
+    """Индекс из конца файла сегмента."""
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path}: не сегмент архива")
+        file.seek(-FOOTER.size, os.SEEK_END)
+        length, magic = FOOTER.unpack(file.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path}: повреждён конец сегмента")
+        file.seek(-FOOTER.size - length, os.SEEK_END)
+        return json.loads(file.read(length))
+
+
+def read_block(name: str, offset: int, length: int, directory: str | None = None):
+    path = os.path.join(directory or ARCHIVE_DIR, name)
+    rows = _blocks.get((path, offset))
+    if rows is None:
+        with open(path, "rb") as file:
+            file.seek(offset)
+            payload = file.read(length)
+        rows = tuple(
+            ArchivedOperation(operation_id, op_type, amount, datetime.fromisoformat(timestamp))
+            for operation_id, op_type, amount, timestamp in json.loads(zlib.decompress(payload))
+        )
+        _blocks.set((path, offset), rows)
+    return rows
+
+
+def _archive_range(db, first_id: int, last_id: int, cutoff: datetime, directory: str):
+    # Баланс сразу после последней архивной операции — текущий минус всё, что позже;
+    # одним запросом, чтобы оба значения были из одного снимка базы.
+    later = select(func.coalesce(func.sum(Operation.signed_amount()), 0.0)).where(
+        Operation.account_id == BankAccount.id, Operation.timestamp >= cutoff
+    ).scalar_subquery()
+    balances = dict(db.execute(
+        select(BankAccount.id, BankAccount.balance - later).where(BankAccount.id.between(first_id, last_id))
+    ).all())
+    # Операции читаются порциями и уходят в файл по счёту: в памяти операции одного счёта,
+    # а не всего диапазона. Для каталога от счёта остаются только границы по времени.
+    rows = db.execute(
+        select(Operation.account_id, Operation.id, Operation.type, Operation.amount, Operation.timestamp)
+        .where(Operation.account_id.between(first_id, last_id), Operation.timestamp < cutoff)
+        .order_by(Operation.account_id, Operation.timestamp, Operation.id)
+        .execution_options(yield_per=READ_BATCH_SIZE)
+    )
+    bounds = {}
+
+    def accounts():
+        for account_id, group in groupby(rows, key=lambda row: row.account_id):
+            # Операции без счёта (например, оставшиеся от старых версий) остаются в таблице.
+            if account_id not in balances:
+                continue
+            group = list(group)
+            bounds[account_id] = (group[0].timestamp, group[-1].timestamp)
+            yield account_id, group
+
+    written = _write_segment(directory, first_id, last_id, cutoff, accounts())
+    if written is None:
+        return None
+    name, index = written
+    try:
+        operations = sum(entry["operations"] for entry in index.values())
+        total = sum(entry["total"] for entry in index.values())
+        segment = ArchiveSegment(
+            path=name, first_account_id=first_id, last_account_id=last_id, cutoff=cutoff, operations=operations,
+            total=total, checksum=_checksum(os.path.join(directory, name)), created_at=_now()
+        )
+        db.add(segment)
+        db.flush()
+        db.execute(insert(ArchivedAccount), [
+            {
+                "segment_id": segment.id, "account_id": account_id, "operations": index[str(account_id)]["operations"],
+                "total": index[str(account_id)]["total"], "first_timestamp": first_timestamp,
+                "last_timestamp": last_timestamp, "balance_after": balances[account_id],
+                "offset": index[str(account_id)]["offset"], "length": index[str(account_id)]["length"],
+            }
+            for account_id, (first_timestamp, last_timestamp) in bounds.items()
+        ])
+
+        archived = (Operation.account_id.in_(list(bounds)), Operation.timestamp < cutoff)
+        removed_count, removed_total = db.execute(
+            select(func.count(), func.coalesce(func.sum(Operation.signed_amount()), 0.0)).where(*archived)
+        ).one()
+        if removed_count != operations or abs(removed_total - total) > TOLERANCE:
+            raise RuntimeError(
+                f"Счета {first_id}-{last_id}: удаляется {removed_count} операций на {removed_total}, "
+                f"в сегменте {operations} на {total}"
+            )
+        db.execute(delete(BalanceCheckpoint).where(
+            BalanceCheckpoint.account_id.in_(list(bounds)), BalanceCheckpoint.timestamp < cutoff
+        ))
+        db.execute(delete(Operation).where(*archived))
+        db.commit()
+    except BaseException:
+        db.rollback()
+        os.remove(os.path.join(directory, name))
+        raise
+    return {"segment": name, "accounts": len(bounds), "operations": operations}
+
+
+def archive_operations(horizon_days: int | None = None, range_size: int | None = None,
+                       directory: str | None = None, cutoff: datetime | None = None):
+    """Переносит операции старше горизонта в сегменты; одна транзакция на диапазон счетов."""
+    cutoff = cutoff or cutoff_for(settings.archive_horizon_days if horizon_days is None else horizon_days)
+    range_size = range_size or settings.archive_range_size
+    directory = directory or ARCHIVE_DIR
+    report = {"cutoff": cutoff.isoformat(), "segments": [], "operations": 0}
+    db = SessionLocal()
+    try:
+        buckets = db.scalars(
+            select(func.distinct((Operation.account_id - 1) // range_size)).where(Operation.timestamp < cutoff)
+            .order_by((Operation.account_id - 1) // range_size)
+        ).all()
+        for bucket in buckets:
+            result = _archive_range(db, bucket * range_size + 1, (bucket + 1) * range_size, cutoff, directory)
+            if result:
+                report["segments"].append(result["segment"])
+                report["operations"] += result["operations"]
+    finally:
+        db.close()
+    return report
+
+
+def _entries(db, account_id: int, *where, newest_first: bool = False):
+    last_timestamp = ArchivedAccount.last_timestamp
+    return db.execute(
+        select(ArchiveSegment.path, ArchivedAccount.offset, ArchivedAccount.length, ArchivedAccount.last_timestamp,
+               ArchivedAccount.balance_after)
+        .join(ArchiveSegment, ArchiveSegment.id == ArchivedAccount.segment_id)
+        .where(ArchivedAccount.account_id == account_id, *where)
+        .order_by(last_timestamp.desc() if newest_first else last_timestamp)
+    ).all()
+
+
+def blocks(db, account_id: int):
+    """Каталог блоков счёта по возрастанию времени: (path, offset, length, ...) для
+    read_block. Асинхронный экспорт читает по нему блоки по одному в пуле потоков."""
+    return _entries(db, account_id)
+
+
+def operations(db, account_id: int):
+    """Архивные операции счёта по возрастанию (timestamp, id). Сегменты одного счёта
+    не пересекаются по времени, поэтому их блоки просто идут друг за другом. Каталог
+    читается сразу, а блоки — по мере перебора: в памяти один блок, а не весь архив."""
+    return chain.from_iterable(read_block(entry.path, entry.offset, entry.length) for entry in blocks(db, account_id))
+
+
+def _position(row):
+    return row.timestamp, row.id
+
+
+def page(db, account_id: int, limit: int, before: tuple | None = None, date_from: datetime | None = None,
+         date_to: datetime | None = None, op_type: str | None = None):
+    """До limit архивных операций по убыванию (timestamp, id) — продолжение страницы
+    операций, когда в таблице строки кончились. Блоки, целиком вне курсора и дат,
+    отсекаются по каталогу, остальные читаются от новых к старым, пока страница не наполнится."""
+    kinds = _KIND_FILTERS[op_type] if op_type is not None else None
+    where = []
+    if before is not None:
+        where.append(ArchivedAccount.first_timestamp <= before[0])
+    if date_from is not None:
+        where.append(ArchivedAccount.last_timestamp >= date_from)
+    if date_to is not None:
+        where.append(ArchivedAccount.first_timestamp < date_to)
+    rows = []
+    for entry in _entries(db, account_id, *where, newest_first=True):
+        block = read_block(entry.path, entry.offset, entry.length)
+        end = bisect.bisect_left(block, before, key=_position) if before is not None else len(block)
+        if date_to is not None:
+            end = min(end, bisect.bisect_left(block, date_to, key=lambda row: row.timestamp))
+        for position in range(end - 1, -1, -1):
+            row = block[position]
+            if date_from is not None and row.timestamp < date_from:
+                return rows
+            if kinds is None or operation_kind(row.type) in kinds:
+                rows.append(row)
+                if len(rows) == limit:
+                    return rows
+    return rows
+
+
+def balance_as_of(db, account_id: int, as_of: datetime):
+    """Баланс на момент as_of, если он внутри архива счёта, иначе None: тогда нужные
+    операции все в таблице и баланс считается по ней."""
+    entries = _entries(db, account_id)
+    if not entries or as_of >= entries[-1].last_timestamp:
+        return None
+    later = sum(
+        _signed(row.type, row.amount)
+        for entry in entries for row in read_block(entry.path, entry.offset, entry.length) if row.timestamp > as_of
+    )
+    return entries[-1].balance_after - later
+
+
+def archived_until(db):
+    """Граница самого нового архива: операций раньше неё в таблице нет."""
+    return db.scalar(select(func.max(ArchiveSegment.cutoff)))
+
+
+def verify(db, directory: str | None = None):
+    """Сверяет архив: файл и контрольная сумма, индекс файла против каталога, блоки против
+    индекса, отсутствие в таблице операций старше границы, дневные обороты за архивные дни
+    против сумм по архиву. Блоки удалённых счетов остаются в неизменяемом файле, но их
+    строки каталога и обороты удалены вместе со счётом — с каталогом они не сверяются."""
+    directory = directory or ARCHIVE_DIR
+    report = {"segments": 0, "operations": 0, "errors": [], "orphans": []}
+    errors = report["errors"]
+    days = defaultdict(lambda: defaultdict(lambda: [0, 0.0]))
+    known = set()
+
+    for segment in db.scalars(select(ArchiveSegment).order_by(ArchiveSegment.id)):
+        known.add(segment.path)
+        path = os.path.join(directory, segment.path)
+        report["segments"] += 1
+        if not os.path.exists(path):
+            errors.append(f"{segment.path}: файл не найден")
+            continue
+        if _checksum(path) != segment.checksum:
+            errors.append(f"{segment.path}: контрольная сумма не совпадает")
+            continue
+        index = read_index(path)["accounts"]
+        catalog = {entry.account_id: entry for entry in db.scalars(
+            select(ArchivedAccount).where(ArchivedAccount.segment_id == segment.id)
+        )}
+        indexed = {int(account_id) for account_id in index}
+        deleted = indexed - set(catalog) - set(db.scalars(
+            select(BankAccount.id).where(BankAccount.id.in_(list(indexed - set(catalog))))
+        ))
+        if set(catalog) != indexed - deleted:
+            errors.append(f"{segment.path}: счета в индексе файла и в каталоге различаются")
+        operations_total, signed_total = 0, 0.0
+        for account_id, entry in index.items():
+            rows = read_block(segment.path, entry["offset"], entry["length"], directory)
+            total = sum(_signed(row.type, row.amount) for row in rows)
+            stored = catalog.get(int(account_id))
+            if len(rows) != entry["operations"] or abs(total - entry["total"]) > TOLERANCE:
+                errors.append(f"{segment.path}: блок счёта {account_id} не совпадает с индексом")
+            if stored is not None and (
+                (stored.offset, stored.length, stored.operations) != (entry["offset"], entry["length"], entry["operations"])
+                or abs(stored.total - entry["total"]) > TOLERANCE
+            ):
+                errors.append(f"{segment.path}: каталог счёта {account_id} не совпадает с индексом")
+            if any(row.timestamp >= segment.cutoff for row in rows):
+                errors.append(f"{segment.path}: у счёта {account_id} операции новее границы архива")
+            operations_total += len(rows)
+            signed_total += total
+            if int(account_id) in deleted:
+                continue
+            for row in rows:
+                counter = days[(int(account_id), row.timestamp.date())][operation_kind(row.type)]
+                counter[0] += 1
+                counter[1] += abs(row.amount)
+        if operations_total != segment.operations or abs(signed_total - segment.total) > TOLERANCE:
+            errors.append(f"{segment.path}: итоги сегмента не совпадают с каталогом")
+        left = db.scalar(select(func.count()).select_from(Operation).where(
+            Operation.account_id.in_(list(catalog)), Operation.timestamp < segment.cutoff
+        ))
+        if left:
+            errors.append(f"{segment.path}: в таблице остались операции старше границы: {left}")
+        report["operations"] += operations_total
+
+    # Дни до границы архивированы целиком, поэтому дневные обороты за них должны
+    # в точности совпадать с суммами по архиву.
+    for (account_id, day), kinds in days.items():
+        aggregate = db.get(DailyAggregate, (account_id, day))
+        for kind, (count, total) in kinds.items():
+            if aggregate is None or getattr(aggregate, f"{kind}_count") != count or \
+                    abs(getattr(aggregate, f"{kind}_total") - total) > TOLERANCE:
+                errors.append(f"счёт {account_id}, {day}: обороты {kind} не совпадают с архивом")
+
+    if os.path.isdir(directory):
+        report["orphans"] = sorted(
+            name for name in os.listdir(directory) if name.endswith((".seg", ".seg.tmp")) and name not in known
+        )
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Архив старых операций: перенос и сверка")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="перенести операции старше горизонта в сегменты")
+    run.add_argument("--horizon-days", type=int, default=None)
+    run.add_argument("--range-size", type=int, default=None)
+    run.add_argument("--dir", default=None)
+    check = commands.add_parser("verify", help="сверить архив с каталогом и дневными оборотами")
+    check.add_argument("--dir", default=None)
+    args = parser.parse_args(argv)
+
+    init_db()
+    if args.command == "run":
+        report = archive_operations(args.horizon_days, args.range_size, args.dir)
+    else:
+        db = SessionLocal()
+        try:
+            report = verify(db, args.dir)
+        finally:
+            db.close()
+    print(json.dumps(report, ensure_ascii=False))
+    if report.get("errors"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import asyncio
+import contextvars
+import hashlib
+import hmac
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import bcrypt
+
+from app import metrics
+from app.cache import LRUCache
+from app.config import settings
+
+SECRET_KEY = settings.secret_key.encode() or secrets.token_bytes(32)
+SESSION_TTL = settings.session_ttl
+CREDENTIAL_CACHE_SIZE = settings.credential_cache_size
+# bcrypt отпускает GIL на время хэширования, поэтому обычный пул потоков
+# даёт настоящий параллелизм по ядрам. 0 — без отдельного пула: bcrypt уходит в
+# общий пул потоков цикла событий, но никогда не выполняется в самом цикле.
+PIN_WORKERS = settings.pin_workers
+
+_executor = None
+_executor_lock = Lock()
+
+# account_id -> (pin_hash, HMAC от PIN): после первой проверки bcrypt
+# повторные запросы с тем же PIN сверяются за O(1). Смена PIN меняет
+# pin_hash, поэтому старая запись перестаёт совпадать сама собой.
+_verified = LRUCache(maxsize=CREDENTIAL_CACHE_SIZE, ttl=SESSION_TTL)
+
+
+def _sign(message: str):
+    return hmac.new(SECRET_KEY, message.encode(), hashlib.sha256).hexdigest()
+
+
+def hash_pin(pin: str):
+    with metrics.pin_timer("hash"):
+        return bcrypt.hashpw(pin.encode(), bcrypt.gensalt()).decode()
+
+
+def verify_pin(account_id: int, pin_hash: str, pin: str):
+    credential = (pin_hash, _sign(f"{account_id}:{pin}"))
+    cached = _verified.get(account_id)
+    if cached is not None and hmac.compare_digest(cached[1], credential[1]) and cached[0] == pin_hash:
+        return True
+    with metrics.pin_timer("verify"):
+        matches = bcrypt.checkpw(pin.encode(), pin_hash.encode())
+    if not matches:
+        return False
+    _verified.set(account_id, credential)
+    return True
+
+
+def remember(account_id: int, pin_hash: str, pin: str):
+    """Кладёт в кэш пару, о которой известно, что она совпадает (pin_hash только что
+    получен из этого PIN): первая проверка нового счёта обойдётся без bcrypt."""
+    _verified.set(account_id, (pin_hash, _sign(f"{account_id}:{pin}")))
+
+
+def pin_cached(account_id: int, pin: str):
+    """Есть ли в кэше удачная проверка этого PIN: тогда verify_pin обойдётся без bcrypt,
+    если pin_hash с тех пор не менялся."""
+    cached = _verified.get(account_id)
+    return cached is not None and hmac.compare_digest(cached[1], _sign(f"{account_id}:{pin}"))
+
+
+def issue_token(account_id: int, pin_hash: str):
+    expires_at = int(time.time()) + SESSION_TTL
+    signature = _sign(f"{account_id}.{expires_at}.{pin_hash}")
+    return f"{account_id}.{expires_at}.{signature}"
+
+
+def verify_token(account_id: int, pin_hash: str, token: str):
+    try:
+        token_account_id, expires_at, signature = token.split(".")
+        token_account_id, expires_at = int(token_account_id), int(expires_at)
+    except ValueError:
+        return False
+    if token_account_id != account_id or expires_at <= time.time():
+        return False
+    expected = _sign(f"{account_id}.{expires_at}.{pin_hash}")
+    return hmac.compare_digest(signature, expected)
+
+
+def invalidate(account_id: int):
+    _verified.pop(account_id)
+
+
+def credential_cache_stats():
+    return _verified.stats()
+
+
+def configure_executor(max_workers: int):
+    global _executor, PIN_WORKERS
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+        PIN_WORKERS = max_workers
+
+
+def executor_enabled():
+    return PIN_WORKERS > 0
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None and PIN_WORKERS > 0:
+            _executor = ThreadPoolExecutor(max_workers=PIN_WORKERS, thread_name_prefix="pin-hash")
+        return _executor
+
+
+async def hash_pin_async(pin: str):
+    loop = asyncio.get_running_loop()
+    # Без отдельного пула get_executor() вернёт None — это пул цикла по умолчанию, как у
+    # asyncio.to_thread. Копия контекста — чтобы время bcrypt попало в метрики текущего запроса.
+    return await loop.run_in_executor(get_executor(), contextvars.copy_context().run, hash_pin, pin)
+
+
+async def verify_pin_async(account_id: int, pin_hash: str, pin: str):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), contextvars.copy_context().run, verify_pin, account_id, pin_hash, pin
+    )
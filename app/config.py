@@ -0,0 +1,186 @@
+import json
+import os
+import tomllib
+from dataclasses import dataclass, fields, replace
+
+JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+
+@dataclass(frozen=True)
+class Settings:
+    database_url: str = "sqlite:///bank.db"
+    # Пусто — выводится из database_url (sqlite:// -> sqlite+aiosqlite://).
+    async_database_url: str = ""
+    # URL баз-шардов через запятую (app/sharding.py); пусто — без шардирования.
+    shard_urls: str = ""
+
+    # PRAGMA, которые выполняются на каждом новом соединении с SQLite.
+    # WAL + synchronous=NORMAL: читатели не блокируют писателя, а fsync
+    # делается на чекпоинте, а не на каждом коммите. busy_timeout короткий: занятая
+    # база быстро отвечает «database is locked», и ожидание переходит в повторы runner,
+    # где оно учитывается в lock_wait и ограничено tx_deadline.
+    sqlite_journal_mode: str = "WAL"
+    sqlite_synchronous: str = "NORMAL"
+    sqlite_busy_timeout: int = 100
+    sqlite_cache_size: int = -64000
+    sqlite_mmap_size: int = 268435456
+
+    pool_size: int = 5
+    max_overflow: int = 10
+
+    # Повторы транзакций при «database is locked» (app/transactions.py).
+    tx_max_attempts: int = 10
+    tx_base_delay: float = 0.005
+    tx_max_delay: float = 0.25
+    tx_deadline: float = 5.0
+
+    # Процессов приложения с общей базой (uvicorn/gunicorn --workers); по умолчанию —
+    # WEB_CONCURRENCY, из которого uvicorn и gunicorn берут число воркеров.
+    workers: int = int(os.environ.get("WEB_CONCURRENCY") or 1)
+
+    # Кэш снимков счетов для чтения баланса (app/snapshots.py); 0 — без кэша, -1 — по
+    # числу процессов. Кэш свой у каждого процесса, и запись в другом процессе его не
+    # сбрасывает: снимок может отставать от базы на account_cache_ttl секунд. Поэтому
+    # при workers > 1 он по умолчанию выключен; явный размер включает его с этой оговоркой.
+    account_cache_size: int = -1
+    account_cache_ttl: float = 5.0
+
+    # Групповой коммит (app/group_commit.py): асинхронные пополнения и снятия копятся
+    # до group_commit_max_batch штук или group_commit_window_ms мс и фиксируются одной
+    # транзакцией. Выключен по умолчанию.
+    group_commit: bool = False
+    group_commit_max_batch: int = 64
+    group_commit_window_ms: float = 2.0
+
+    # Наибольшее число операций в одном POST /operations/batch: пакет — одна транзакция,
+    # и без предела один запрос держал бы блокировку записи сколько угодно долго.
+    batch_max_operations: int = 1000
+
+    # Ключи идемпотентности (app/idempotency.py): сколько хранится ответ в БД и
+    # сколько ключей держит кэш перед ней; 0 — без кэша.
+    idempotency_ttl: int = 86400
+    idempotency_cache_size: int = 10000
+
+    # Архив операций (app/archive.py): операции старше archive_horizon_days дней
+    # переносятся в сжатые сегменты в archive_dir, по сегменту на archive_range_size счетов.
+    archive_dir: str = "archive"
+    archive_horizon_days: int = 90
+    archive_range_size: int = 1000
+
+    # Контрольная точка баланса пишется каждые checkpoint_interval операций по счёту.
+    checkpoint_interval: int = 100
+
+    # Ключ подписи токенов сессий. Пусто — случайный ключ процесса: токены живут до
+    # перезапуска и не принимаются другими воркерами, поэтому при workers > 1 он обязателен.
+    secret_key: str = ""
+    session_ttl: int = 900
+    credential_cache_size: int = 10000
+    pin_workers: int = os.cpu_count() or 1
+
+    # Число и время SQL-запросов в заголовках ответа (X-Query-Count, X-Query-Time).
+    debug_query_header: bool = False
+
+    def __post_init__(self):
+        if self.checkpoint_interval < 1:
+            raise ValueError("checkpoint_interval должен быть положительным")
+        if self.group_commit_max_batch < 1:
+            raise ValueError("group_commit_max_batch должен быть положительным")
+        if self.batch_max_operations < 1:
+            raise ValueError("batch_max_operations должен быть положительным")
+        if self.archive_range_size < 1:
+            raise ValueError("archive_range_size должен быть положительным")
+        if self.workers < 1:
+            raise ValueError("workers должен быть положительным")
+        if self.workers > 1 and not self.secret_key:
+            raise ValueError("При workers > 1 нужен secret_key (BANK_SECRET_KEY), общий для всех процессов")
+        if self.account_cache_size < -1:
+            raise ValueError("account_cache_size: 0 — без кэша, -1 — по числу процессов")
+        if self.idempotency_ttl < 1:
+            raise ValueError("idempotency_ttl должен быть положительным")
+        if self.sqlite_journal_mode.upper() not in JOURNAL_MODES:
+            raise ValueError(f"Недопустимый sqlite_journal_mode: {self.sqlite_journal_mode}")
+        if self.sqlite_synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Недопустимый sqlite_synchronous: {self.sqlite_synchronous}")
+        if self.lock_timeout >= self.tx_deadline:
+            raise ValueError("sqlite_busy_timeout должен быть меньше tx_deadline: иначе на повторы не остаётся времени")
+
+    @property
+    def is_sqlite(self):
+        return self.database_url.startswith("sqlite")
+
+    @property
+    def lock_timeout(self):
+        """Сколько одна попытка транзакции может ждать блокировку внутри драйвера, секунды."""
+        return self.sqlite_busy_timeout / 1000 if self.is_sqlite else 0.0
+
+    @property
+    def resolved_account_cache_size(self):
+        if self.account_cache_size >= 0:
+            return self.account_cache_size
+        return 10000 if self.workers == 1 else 0
+
+    @property
+    def resolved_async_database_url(self):
+        if self.async_database_url:
+            return self.async_database_url
+        if self.database_url.startswith("sqlite://"):
+            return "sqlite+aiosqlite://" + self.database_url.removeprefix("sqlite://")
+        return self.database_url
+
+    def sqlite_pragmas(self):
+        return {
+            "journal_mode": self.sqlite_journal_mode.upper(),
+            "synchronous": self.sqlite_synchronous.upper(),
+            "busy_timeout": int(self.sqlite_busy_timeout),
+            "cache_size": int(self.sqlite_cache_size),
+            "mmap_size": int(self.sqlite_mmap_size),
+        }
+
+
+def _read_config_file(path: str):
+    with open(path, "rb") as f:
+        if path.endswith(".toml"):
+            data = tomllib.load(f)
+        else:
+            data = json.load(f)
+    return data.get("bank", data)
+
+
+def _convert(value, default):
+    if isinstance(default, bool):
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() in ("1", "true", "yes", "on"):
+            return True
+        if str(value).lower() in ("0", "false", "no", "off", ""):
+            return False
+        raise ValueError(f"Ожидается логическое значение: {value}")
+    if isinstance(default, float):
+        return float(value)
+    if isinstance(default, int):
+        return int(value)
+    return str(value)
+
+
+def load_settings(environ=None):
+    """Настройки по умолчанию, поверх — файл из BANK_CONFIG_FILE (TOML или JSON),
+    поверх — переменные окружения BANK_<ИМЯ_ПОЛЯ>."""
+    environ = os.environ if environ is None else environ
+    settings = Settings()
+    values = {}
+    if config_file := environ.get("BANK_CONFIG_FILE"):
+        values.update(_read_config_file(config_file))
+    for field in fields(Settings):
+        env_name = f"BANK_{field.name.upper()}"
+        if env_name in environ:
+            values[field.name] = environ[env_name]
+
+    known = {field.name: getattr(settings, field.name) for field in fields(Settings)}
+    unknown = set(values) - set(known)
+    if unknown:
+        raise ValueError(f"Неизвестные настройки: {', '.join(sorted(unknown))}")
+    return replace(settings, **{name: _convert(value, known[name]) for name, value in values.items()})
+
+
+settings = load_settings()
@@ -1,11 +1,69 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
 
-engine = create_engine("sqlite:///bank.db")
+from app import metrics
+from app.config import settings
+from app.migrations import LATEST_VERSION, get_schema_version, run_migrations
+
+DATABASE_URL = settings.database_url
+ASYNC_DATABASE_URL = settings.resolved_async_database_url
+
+
+def _engine_options(url):
+    # In-memory SQLite живёт в одном соединении (StaticPool/SingletonThreadPool),
+    # размер пула к нему неприменим.
+    if url.startswith("sqlite") and (":memory:" in url or url.rstrip("/").endswith(":")):
+        return {}
+    return {"pool_size": settings.pool_size, "max_overflow": settings.max_overflow}
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record=None):
+    cursor = dbapi_connection.cursor()
+    for name, value in settings.sqlite_pragmas().items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def create_database_engine(url):
+    """Синхронный движок с PRAGMA SQLite и метриками: основная база и шарды (app/sharding.py)."""
+    engine = create_engine(url, **_engine_options(url))
+    if url.startswith("sqlite"):
+        event.listen(engine, "connect", apply_sqlite_pragmas)
+    metrics.instrument_engine(engine)
+    return engine
+
+
+engine = create_database_engine(DATABASE_URL)
 
 SessionLocal = sessionmaker(bind=engine)
 
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_engine_options(ASYNC_DATABASE_URL))
+
+AsyncSessionLocal = async_sessionmaker(bind=async_engine)
+
+if settings.is_sqlite:
+    event.listen(async_engine.sync_engine, "connect", apply_sqlite_pragmas)
+
+metrics.instrument_engine(async_engine.sync_engine)
+# AsyncSession работает поверх обычной Session, поэтому события класса покрывают обе.
+metrics.instrument_sessions(Session)
+
 Base = declarative_base()
 
+def init_schema(bind):
+    """Таблицы и миграции. Если версия схемы уже последняя, create_all пропускается:
+    каждая новая таблица приходит со своей миграцией, а проверять все таблицы при
+    каждом старте — лишние запросы к базе."""
+    with bind.connect() as conn:
+        if get_schema_version(conn) >= LATEST_VERSION:
+            return
+    # Таблицы попадают в Base.metadata при импорте моделей; без него на пустой базе
+    # create_all ничего не создаст, а первая миграция не найдёт таблиц.
+    import app.models  # noqa: F401
+    Base.metadata.create_all(bind=bind)
+    run_migrations(bind)
+
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    init_schema(engine)
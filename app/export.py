@@ -0,0 +1,54 @@
+import csv
+import io
+import json
+import zlib
+
+FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv"),
+}
+CSV_HEADER = ("id", "type", "amount", "timestamp")
+
+
+def media_type(fmt: str, compress: bool = False):
+    return "application/gzip" if compress else FORMATS[fmt][0]
+
+
+def file_extension(fmt: str, compress: bool = False):
+    extension = FORMATS[fmt][1]
+    return f"{extension}.gz" if compress else extension
+
+
+class ExportWriter:
+    def __init__(self, fmt: str = "ndjson", compress: bool = False):
+        if fmt not in FORMATS:
+            raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+        self.fmt = fmt
+        self.compress = compress
+        # wbits=31 — поток в формате gzip, а не «голый» zlib.
+        self._compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def _encode(self, text: str):
+        data = text.encode()
+        return self._compressor.compress(data) if self._compressor else data
+
+    def header(self):
+        if self.fmt != "csv":
+            return b""
+        return self._encode(",".join(CSV_HEADER) + "\r\n")
+
+    def write(self, rows):
+        if self.fmt == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows((row.id, row.type, row.amount, row.timestamp.isoformat()) for row in rows)
+            return self._encode(buffer.getvalue())
+        return self._encode("".join(
+            json.dumps(
+                {"id": row.id, "type": row.type, "amount": row.amount, "timestamp": row.timestamp.isoformat()},
+                ensure_ascii=False
+            ) + "\n"
+            for row in rows
+        ))
+
+    def close(self):
+        return self._compressor.flush() if self._compressor else b""
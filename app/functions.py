@@ -1,136 +1,774 @@
-from app.models import BankAccount
-from app.database import SessionLocal
-
-def create_account(owner: str, pin: str, initial_balance: float = 0.0):
-    if not owner.strip():
-        raise ValueError("Имя владельца не может быть пустым")
-    
-    if len(pin) < 4:
-        raise ValueError("PIN должен быть 4 или более символов")
-    
-    if initial_balance < 0:
-        raise ValueError("Начальный баланс не может быть отрицательным")
-    
-    db = SessionLocal()
+import asyncio
+import base64
+from itertools import chain, islice
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import select, tuple_, func
+
+from app.models import (
+    BankAccount, Operation, BalanceCheckpoint, DailyAggregate, OPERATION_KINDS
+)
+from app.database import SessionLocal, AsyncSessionLocal
+from app import archive, auth, idempotency, workers
+from app.config import settings
+from app.export import ExportWriter
+from app.group_commit import GroupCommitWriter
+from app.snapshots import AccountSnapshot, account_cache
+from app.transactions import TransactionRunner
+
+EXPORT_BATCH_SIZE = 1000
+
+# Денежные операции и удаление выполняются через runner: при «database is locked»
+# транзакция повторяется, а число повторов и время ожидания копятся в runner.stats.
+runner = TransactionRunner(
+    SessionLocal, AsyncSessionLocal, max_attempts=settings.tx_max_attempts, base_delay=settings.tx_base_delay,
+    max_delay=settings.tx_max_delay, deadline=settings.tx_deadline, lock_timeout=settings.lock_timeout
+)
+
+
+async def _verify_pin_async(db, account_id: int, pin: str | None, token: str | None = None):
+    # bcrypt считается в пуле auth, а не внутри run_sync: удачная проверка
+    # попадает в кэш, и workers.authorize в рабочей функции проходит за O(1).
+    if pin is None or token is not None:
+        return
+    snapshot = account_cache.get(account_id)
+    if snapshot is None:
+        try:
+            snapshot = await db.run_sync(_load_snapshot, account_id)
+        except ValueError:
+            # Об отсутствующем счёте сообщит рабочая функция — со своим текстом ошибки.
+            return
+    if not await auth.verify_pin_async(account_id, snapshot.pin_hash, pin):
+        raise ValueError("Неверный PIN-код")
+
+
+def _create_session(db, account_id: int, pin: str):
+    account = workers.get_account(db, account_id)
+    workers.authorize(account, pin=pin)
+    return account.issue_token(), auth.SESSION_TTL
+
+
+def _get_authorized_snapshot(db, account_id: int, pin: str | None, token: str | None):
+    # Для чтения ORM-объект не нужен: снимок из кэша или один SELECT по колонкам.
+    snapshot = account_cache.get(account_id) or _load_snapshot(db, account_id)
+    workers.authorize(snapshot, pin, token)
+    return snapshot
+
+
+def _encode_cursor(timestamp: datetime, operation_id: int):
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{operation_id}".encode()).decode()
+
+
+def _decode_cursor(cursor: str):
     try:
-        existing_account = db.query(BankAccount).filter(BankAccount.owner == owner).first()
-        if existing_account:
-            raise ValueError("Такой аккаунт уже существует")
-        account = BankAccount(owner=owner, balance=initial_balance)
-        account.set_pin(pin)
-        db.add(account)
-        db.commit()
-        db.refresh(account)
-        return account
+        timestamp, operation_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(operation_id)
+    except ValueError:
+        raise ValueError("Некорректный курсор")
+
+
+def _get_operations_page(db, account_id: int, pin: str | None, token: str | None, limit: int = 50,
+                         cursor: str | None = None, date_from: datetime | None = None,
+                         date_to: datetime | None = None, op_type: str | None = None):
+    if limit < 1:
+        raise ValueError("Размер страницы должен быть положительным")
+    _get_authorized_snapshot(db, account_id, pin, token)
+
+    query = select(Operation.id, Operation.type, Operation.amount, Operation.timestamp).where(
+        Operation.account_id == account_id
+    )
+    before = _decode_cursor(cursor) if cursor is not None else None
+    date_from, date_to = workers.to_utc_naive(date_from), workers.to_utc_naive(date_to)
+    if before is not None:
+        query = query.where(tuple_(Operation.timestamp, Operation.id) < tuple_(*before))
+    if date_from is not None:
+        query = query.where(Operation.timestamp >= date_from)
+    if date_to is not None:
+        query = query.where(Operation.timestamp < date_to)
+    if op_type is not None:
+        query = query.where(Operation.kind_filter(op_type))
+
+    # Порядок совпадает с индексом (account_id, timestamp, id): страница — один проход по диапазону.
+    rows = db.execute(query.order_by(Operation.timestamp.desc(), Operation.id.desc()).limit(limit + 1)).all()
+    if len(rows) <= limit:
+        # Архивные операции старше любой строки таблицы — страница продолжается ими.
+        rows += archive.page(db, account_id, limit + 1 - len(rows), before, date_from, date_to, op_type)
+    page = rows[:limit]
+    next_cursor = _encode_cursor(page[-1].timestamp, page[-1].id) if len(rows) > limit else None
+    return {"items": [row._asdict() for row in page], "next_cursor": next_cursor}
+
+
+def _get_history(db, account_id: int, pin: str | None, token: str | None):
+    _get_authorized_snapshot(db, account_id, pin, token)
+    return [
+        (row.type, row.amount, row.timestamp.strftime("%Y-%m-%d %H:%M:%S"))
+        for row in chain(archive.operations(db, account_id), db.execute(workers.history_query(account_id)))
+    ]
+
+
+def _archived_chunks(rows, writer: ExportWriter):
+    # Архив отдаётся ленивым итератором по блокам — режется на пачки так же, как таблица.
+    rows = iter(rows)
+    while batch := list(islice(rows, EXPORT_BATCH_SIZE)):
+        if chunk := writer.write(batch):
+            yield chunk
+
+
+def _stream_history(db, account_id: int, writer: ExportWriter):
+    try:
+        if header := writer.header():
+            yield header
+        yield from _archived_chunks(archive.operations(db, account_id), writer)
+        result = db.execute(workers.history_query(account_id).execution_options(yield_per=EXPORT_BATCH_SIZE))
+        for rows in result.partitions():
+            if chunk := writer.write(rows):
+                yield chunk
+        if tail := writer.close():
+            yield tail
     finally:
         db.close()
 
-def deposit_to_account(account_id: int, amount: float, pin: str):
+
+async def _stream_history_async(db, account_id: int, writer: ExportWriter):
+    try:
+        if header := writer.header():
+            yield header
+        for entry in await db.run_sync(archive.blocks, account_id):
+            # Чтение файла и zlib — в пуле потоков, по блоку за раз, а не в цикле событий.
+            block = await asyncio.to_thread(archive.read_block, entry.path, entry.offset, entry.length)
+            for chunk in _archived_chunks(block, writer):
+                yield chunk
+        result = await db.stream(workers.history_query(account_id).execution_options(yield_per=EXPORT_BATCH_SIZE))
+        async for rows in result.partitions():
+            if chunk := writer.write(rows):
+                yield chunk
+        if tail := writer.close():
+            yield tail
+    finally:
+        await db.close()
+
+
+def _load_snapshot(db, account_id: int):
+    # Поколение берётся до запроса: если запись успеет инвалидировать счёт,
+    # прочитанный здесь снимок в кэш не попадёт.
+    generation = account_cache.generation()
+    row = db.execute(
+        select(BankAccount.id, BankAccount.owner, BankAccount.balance, BankAccount._pin).where(BankAccount.id == account_id)
+    ).first()
+    if row is None:
+        raise ValueError("Аккаунт с таким ID не найден")
+    snapshot = AccountSnapshot(*row)
+    account_cache.put(snapshot, generation)
+    return snapshot
+
+
+def _get_snapshot(account_id: int, pin: str | None, token: str | None):
+    snapshot = account_cache.get(account_id)
+    if snapshot is None:
+        db = SessionLocal()
+        try:
+            snapshot = _load_snapshot(db, account_id)
+        finally:
+            db.close()
+    workers.authorize(snapshot, pin, token)
+    return snapshot
+
+
+async def _get_snapshot_async(account_id: int, pin: str | None, token: str | None):
+    snapshot = account_cache.get(account_id)
+    if snapshot is None:
+        async with AsyncSessionLocal() as db:
+            snapshot = await db.run_sync(_load_snapshot, account_id)
+    if pin is not None and token is None and not await auth.verify_pin_async(account_id, snapshot.pin_hash, pin):
+        raise ValueError("Неверный PIN-код")
+    workers.authorize(snapshot, pin, token)
+    return snapshot
+
+
+def _balance_as_of(db, account: AccountSnapshot, as_of: datetime):
+    if (archived := archive.balance_as_of(db, account.id, as_of)) is not None:
+        return archived
+    signed = func.coalesce(func.sum(Operation.signed_amount()), 0.0)
+    position = tuple_(Operation.timestamp, Operation.id)
+    checkpoints = select(BalanceCheckpoint.timestamp, BalanceCheckpoint.operation_id, BalanceCheckpoint.balance).where(
+        BalanceCheckpoint.account_id == account.id
+    ).limit(1)
+
+    before = db.execute(checkpoints.where(BalanceCheckpoint.timestamp <= as_of).order_by(
+        BalanceCheckpoint.timestamp.desc(), BalanceCheckpoint.operation_id.desc()
+    )).first()
+    if before:
+        tail = db.scalar(select(signed).where(
+            Operation.account_id == account.id,
+            position > tuple_(before.timestamp, before.operation_id),
+            Operation.timestamp <= as_of
+        ))
+        return before.balance + tail
+
+    # Точек до as_of нет: идём назад от ближайшей следующей точки, а если нет и её —
+    # от текущего баланса. В обоих случаях суммируется не больше интервала точек.
+    after = db.execute(checkpoints.where(BalanceCheckpoint.timestamp > as_of).order_by(
+        BalanceCheckpoint.timestamp, BalanceCheckpoint.operation_id
+    )).first()
+    later = (Operation.account_id == account.id, Operation.timestamp > as_of)
+    if after:
+        return after.balance - db.scalar(select(signed).where(
+            *later, position <= tuple_(after.timestamp, after.operation_id)
+        ))
+    # Текущий баланс — из базы и в том же запросе, что и сумма: снимок из кэша мог
+    # отстать, а два отдельных запроса могли увидеть разные состояния счёта.
+    balance = db.scalar(select(BankAccount.balance - select(signed).where(*later).scalar_subquery()).where(
+        BankAccount.id == account.id
+    ))
+    if balance is None:
+        raise ValueError("Аккаунт с таким ID не найден")
+    return balance
+
+
+def _get_balance_as_of(db, account_id: int, pin: str | None, token: str | None, as_of: datetime | None = None):
+    account = _get_authorized_snapshot(db, account_id, pin, token)
+    if as_of is None:
+        return account.balance
+    return _balance_as_of(db, account, workers.to_utc_naive(as_of))
+
+
+def _parse_period(period: str):
+    """'2026' — год, '2026-09' — месяц, '2026-09-15' — день. Возвращает [начало, конец)."""
+    try:
+        match period.count("-"):
+            case 0:
+                start = date(int(period), 1, 1)
+                return start, date(start.year + 1, 1, 1)
+            case 1:
+                start = datetime.strptime(period, "%Y-%m").date()
+                return start, date(start.year + start.month // 12, start.month % 12 + 1, 1)
+            case 2:
+                start = date.fromisoformat(period)
+                return start, start + timedelta(days=1)
+    except ValueError:
+        pass
+    raise ValueError("Период указывается как ГГГГ, ГГГГ-ММ или ГГГГ-ММ-ДД")
+
+
+def _get_statement(db, account_id: int, pin: str | None, token: str | None, period: str):
+    start, end = _parse_period(period)
+    account = _get_authorized_snapshot(db, account_id, pin, token)
+
+    # Не больше 366 дневных строк по первичному ключу — время не зависит от длины истории.
+    columns = [f"{kind}_{field}" for kind in OPERATION_KINDS for field in ("count", "total")]
+    totals = db.execute(select(*(
+        func.coalesce(func.sum(getattr(DailyAggregate, column)), 0).label(column) for column in columns
+    )).where(
+        DailyAggregate.account_id == account_id, DailyAggregate.day >= start, DailyAggregate.day < end
+    )).one()._mapping
+
+    operations = {
+        kind: {"count": totals[f"{kind}_count"], "amount": totals[f"{kind}_total"]} for kind in OPERATION_KINDS
+    }
+    total_in = operations["deposit"]["amount"] + operations["transfer_in"]["amount"]
+    total_out = operations["withdrawal"]["amount"] + operations["transfer_out"]["amount"]
+    opening = _balance_as_of(db, account, datetime.combine(start, datetime.min.time()) - timedelta(microseconds=1))
+    return {
+        "account_id": account_id,
+        "period": period,
+        "date_from": start,
+        "date_to": end - timedelta(days=1),
+        "opening_balance": opening,
+        "closing_balance": opening + total_in - total_out,
+        "total_in": total_in,
+        "total_out": total_out,
+        "operations": operations,
+    }
+
+
+def _apply_batch(db, operations: list[dict], atomic: bool = True, verified: dict | None = None):
+    # Словарь держит аккаунты в identity map до конца пакета: db.get в рабочих функциях без SQL.
+    loaded = workers.load_accounts(db, _batch_account_ids(operations))
+
+    verified = dict(verified or {})
+    results = []
+    for index, op in enumerate(operations):
+        try:
+            pin, token = op.get("pin"), op.get("token")
+            credential = (op["account_id"], pin, token)
+            if credential not in verified:
+                account = loaded.get(op["account_id"])
+                if account:
+                    try:
+                        workers.authorize(account, pin, token)
+                        verified[credential] = True
+                    except ValueError:
+                        verified[credential] = False
+            if verified.get(credential) is False:
+                raise ValueError("Неверный PIN-код" if token is None else "Недействительный или просроченный токен сессии")
+
+            match op["type"]:
+                case "deposit":
+                    account = workers.deposit(db, op["account_id"], op["amount"], pin, token)
+                case "withdraw":
+                    account = workers.withdraw(db, op["account_id"], op["amount"], pin, token)
+                case "transfer":
+                    if op.get("to_id") is None:
+                        raise ValueError("Не указан получатель перевода")
+                    _, account = workers.transfer(db, op["account_id"], op["to_id"], op["amount"], pin, token)
+                case _:
+                    raise ValueError(f"Неизвестный тип операции: {op['type']}")
+            results.append({"index": index, "status": "ok", "balance": account.balance})
+        except ValueError as e:
+            if atomic:
+                raise ValueError(f"Операция {index}: {e}")
+            # Методы BankAccount проверяют сумму до записи, а списание — условный
+            # UPDATE, который либо проходит целиком, либо ничего не меняет.
+            results.append({"index": index, "status": "error", "detail": str(e)})
+    return results
+
+
+def _apply_group(db, operations: list[tuple]):
+    """Рабочая функция группового коммита: операции (вид, ID, сумма, PIN, токен) ->
+    тело ответа или ValueError. Ошибка возвращается, а не поднимается: её получает
+    только вызывающий этой операции, остальные фиксируются."""
+    # Как и в _apply_batch, словарь держит аккаунты в identity map до конца окна.
+    loaded = workers.load_accounts(db, {account_id for _, account_id, _, _, _ in operations})
+    apply = {"deposit": workers.deposit, "withdraw": workers.withdraw}
+    results = []
+    for kind, account_id, amount, pin, token in operations:
+        try:
+            results.append(workers.account_body(apply[kind](db, account_id, amount, pin, token)))
+        except ValueError as e:
+            results.append(e)
+    return results
+
+
+def _group_committed(db, results):
+    account_cache.invalidate(*(result["id"] for result in results if not isinstance(result, ValueError)))
+
+
+group_writer = None
+
+
+def configure_group_commit(enabled: bool, max_batch: int = settings.group_commit_max_batch,
+                           window_ms: float = settings.group_commit_window_ms):
+    """Включает или выключает групповой коммит для асинхронных пополнений и снятий."""
+    global group_writer
+    if group_writer is not None:
+        group_writer.close()
+    group_writer = GroupCommitWriter(
+        runner, _apply_group, _group_committed, max_batch=max_batch, window=window_ms / 1000
+    ) if enabled else None
+
+
+configure_group_commit(settings.group_commit)
+
+
+# Роутер шардов (app.sharding) при запуске с BANK_SHARD_URLS: операции над счетами идут в
+# базу шарда, а не в BANK_DATABASE_URL. Ставит lifespan приложения.
+shard_router = None
+
+
+def configure_sharding(router):
+    global shard_router
+    shard_router = router
+
+
+def _require_single_database(operation: str):
+    if shard_router is not None:
+        raise ValueError(f"{operation} не поддерживается при шардировании счетов")
+
+
+def create_account(owner: str, pin: str, initial_balance: float = 0.0, pin_hash: str | None = None):
+    if shard_router is not None:
+        return shard_router.create_account(owner, pin, initial_balance)
+    workers.validate_new_account(owner, pin, initial_balance)
+
     db = SessionLocal()
     try:
-        account = db.query(BankAccount).filter(BankAccount.id == account_id).first()
-        if not account:
-            raise ValueError("Аккаунт с таким ID не найден")
-        account.deposit(amount=amount, pin=pin)
+        account = workers.create_account(db, owner, pin, initial_balance, pin_hash)
         db.commit()
         db.refresh(account)
         return account
-    except ValueError as e:
-        db.rollback()
-        raise e
     finally:
         db.close()
-        
 
-def withdraw_from_account(account_id: int, amount: float, pin: str):
+
+def create_session(account_id: int, pin: str):
+    if shard_router is not None:
+        return shard_router.create_session(account_id, pin)
     db = SessionLocal()
     try:
-        account = db.query(BankAccount).filter(BankAccount.id == account_id).first()
-        if not account:
-            raise ValueError("Аккаунт с таким ID не найден")
-        account.withdraw(amount=amount, pin=pin)
-        db.commit()
-        db.refresh(account)
-        return account
-    except ValueError as e:
-        db.rollback()
-        raise e
+        return _create_session(db, account_id, pin)
     finally:
         db.close()
-        
-        
-def transfer_money(from_id: int, to_id: int, amount: float, pin: str):
+
+
+def _snapshots(body):
+    # Тело перевода — список из двух счетов, как и результат transfer: (получатель, отправитель).
+    if isinstance(body, list):
+        return tuple(AccountSnapshot.from_body(item) for item in body)
+    return AccountSnapshot.from_body(body)
+
+
+def _invalidate_body(body):
+    account_cache.invalidate(*(item["id"] for item in (body if isinstance(body, list) else [body])))
+
+
+def _batch_account_ids(operations: list[dict]):
+    return {op["account_id"] for op in operations} | {op["to_id"] for op in operations if op.get("to_id") is not None}
+
+
+def _idempotent_request(key: str | None, operation: str, account_id: int, **params):
+    if key is not None:
+        # Ответ под ключом нельзя записать в одной транзакции с операцией в шарде.
+        _require_single_database("Idempotency-Key")
+    return idempotency.IdempotentRequest(key, operation, account_id, **params) if key is not None else None
+
+
+# Денежная операция возвращает снимок счёта (для перевода — пару снимков), собранный
+# из тела ответа. Тело строится внутри транзакции: баланс уже обновлён UPDATE ... RETURNING,
+# поэтому после коммита объекты не перечитываются. С Idempotency-Key то же тело
+# сохраняется под ключом, и повтор после обычной проверки PIN или токена возвращает
+# такой же снимок.
+def _replay(request, pin: str | None, token: str | None):
     db = SessionLocal()
     try:
-        from_account = db.query(BankAccount).filter(BankAccount.id == from_id).first()
-        to_account = db.query(BankAccount).filter(BankAccount.id == to_id).first()
-        if not from_account:
-            raise ValueError(f"Аккаунт с ID {from_id} не найден")
-        if not to_account:
-            raise ValueError(f"Аккаунт с ID {to_id} не найден")
-        from_account.transfer(to_account=to_account, amount=amount, pin=pin)
-        db.commit()
-        db.refresh(from_account)
-        db.refresh(to_account)
-        return to_account, from_account
-    except ValueError as e:
-        db.rollback()
-        raise e
+        stored = idempotency.load(db, request)
+        if stored is None:
+            return None
+        _get_authorized_snapshot(db, request.account_id, pin, token)
+        return idempotency.replay(request, stored)
     finally:
         db.close()
 
 
-def get_history(account_id: int, pin: str):
+def _run_idempotent(name: str, request, pin: str | None, token: str | None, work, body):
+    """runner.run, который вместе с операцией записывает ответ под ключом request (если
+    он есть) и возвращает снимок из этого ответа. Если тот же ключ успела зафиксировать
+    параллельная транзакция, эта откатывается и возвращается её ответ."""
+    if request is not None and (replayed := _replay(request, pin, token)) is not None:
+        return _snapshots(replayed)
+    saved = []
+
+    def recorded(db):
+        response = body(work(db))
+        saved[:] = [response, idempotency.save(db, request, response) if request is not None else None]
+
+    def committed(db, _):
+        if request is not None:
+            idempotency.remember(request, saved[1])
+        _invalidate_body(saved[0])
+
+    try:
+        runner.run(name, recorded, committed)
+    except idempotency.DuplicateRequest:
+        return _snapshots(_replay(request, pin, token))
+    return _snapshots(saved[0])
+
+
+def deposit_to_account(account_id: int, amount: float, pin: str | None = None, token: str | None = None,
+                       idempotency_key: str | None = None):
+    if shard_router is not None and idempotency_key is None:
+        return shard_router.deposit_to_account(account_id, amount, pin, token)
+    request = _idempotent_request(idempotency_key, "deposit", account_id, amount=amount)
+    return _run_idempotent(
+        "deposit", request, pin, token, lambda db: workers.deposit(db, account_id, amount, pin, token), workers.account_body
+    )
+
+
+def withdraw_from_account(account_id: int, amount: float, pin: str | None = None, token: str | None = None,
+                          idempotency_key: str | None = None):
+    if shard_router is not None and idempotency_key is None:
+        return shard_router.withdraw_from_account(account_id, amount, pin, token)
+    request = _idempotent_request(idempotency_key, "withdraw", account_id, amount=amount)
+    return _run_idempotent(
+        "withdraw", request, pin, token, lambda db: workers.withdraw(db, account_id, amount, pin, token), workers.account_body
+    )
+
+
+def transfer_money(from_id: int, to_id: int, amount: float, pin: str | None = None, token: str | None = None,
+                   idempotency_key: str | None = None):
+    if shard_router is not None and idempotency_key is None:
+        return shard_router.transfer_money(from_id, to_id, amount, pin, token)
+    request = _idempotent_request(idempotency_key, "transfer", from_id, to_id=to_id, amount=amount)
+    return _run_idempotent(
+        "transfer", request, pin, token, lambda db: workers.transfer(db, from_id, to_id, amount, pin, token), workers.pair_body
+    )
+
+
+def get_history(account_id: int, pin: str | None = None, token: str | None = None):
+    if shard_router is not None:
+        return shard_router.get_history(account_id, pin, token)
     db = SessionLocal()
     try:
-        account = db.query(BankAccount).filter(BankAccount.id == account_id).first()
-        if not account:
-            raise ValueError("Аккаунт с таким ID не найден")
-        return account.get_history(pin)
+        return _get_history(db, account_id, pin, token)
     finally:
         db.close()
-    
-    
-def get_account_balance(account_id: int, pin: str):
+
+
+def export_history(account_id: int, pin: str | None = None, token: str | None = None,
+                   fmt: str = "ndjson", compress: bool = False):
+    _require_single_database("Экспорт истории")
+    writer = ExportWriter(fmt, compress)
     db = SessionLocal()
     try:
-        account = db.query(BankAccount).filter(BankAccount.id == account_id).first()
-        if not account:
-            raise ValueError("Аккаунт с таким ID не найден")
-        if not account.check_pin(pin):
-            raise ValueError("Неверный PIN-код")
-        return account.balance
-    finally:
+        _get_authorized_snapshot(db, account_id, pin, token)
+    except BaseException:
         db.close()
+        raise
+    return _stream_history(db, account_id, writer)
+
+
+def get_account_balance(account_id: int, pin: str | None = None, token: str | None = None):
+    if shard_router is not None:
+        return shard_router.get_account_balance(account_id, pin, token)
+    return _get_snapshot(account_id, pin, token).balance
 
 
-def get_account_by_id(account_id: int, pin: str):
+def get_balance_as_of(account_id: int, as_of: datetime | None = None, pin: str | None = None,
+                      token: str | None = None):
+    if as_of is None and shard_router is not None:
+        return shard_router.get_account_balance(account_id, pin, token)
+    _require_single_database("Баланс на дату")
     db = SessionLocal()
     try:
-        account = db.query(BankAccount).filter(BankAccount.id == account_id).first()
-        if not account:
-            raise ValueError("Аккаунт с таким ID не найден")
-        if not account.check_pin(pin):
-            raise ValueError("Неверный PIN-код")
-        return account
+        return _get_balance_as_of(db, account_id, pin, token, as_of)
     finally:
         db.close()
 
 
-def delete_account(account_id: int, pin: str):
+def get_statement(account_id: int, period: str, pin: str | None = None, token: str | None = None):
+    _require_single_database("Выписка")
     db = SessionLocal()
     try:
-        account = db.query(BankAccount).filter(BankAccount.id == account_id).first()
-        if not account:
-            raise ValueError("Аккаунт с таким ID не найден")
-        if not account.check_pin(pin):
-            raise ValueError("Неверный PIN-код")
+        return _get_statement(db, account_id, pin, token, period)
+    finally:
+        db.close()
 
-        db.delete(account)
-        db.commit()
-        return f"Аккаунт {account_id} успешно удалён"
-    except ValueError as e:
-        db.rollback()
-        raise e
+
+def get_account_by_id(account_id: int, pin: str | None = None, token: str | None = None):
+    if shard_router is not None:
+        return shard_router.get_account_by_id(account_id, pin, token)
+    return _get_snapshot(account_id, pin, token)
+
+
+def get_operations_page(account_id: int, pin: str | None = None, token: str | None = None, limit: int = 50,
+                        cursor: str | None = None, date_from: datetime | None = None,
+                        date_to: datetime | None = None, op_type: str | None = None):
+    _require_single_database("Страницы истории")
+    db = SessionLocal()
+    try:
+        return _get_operations_page(db, account_id, pin, token, limit, cursor, date_from, date_to, op_type)
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+def delete_account(account_id: int, pin: str | None = None, token: str | None = None):
+    if shard_router is not None:
+        return shard_router.delete_account(account_id, pin, token)
+    runner.run(
+        "delete", lambda db: workers.delete_account(db, account_id, pin, token),
+        lambda db, _: (account_cache.invalidate(account_id), auth.invalidate(account_id))
+    )
+    return f"Аккаунт {account_id} успешно удалён"
+
+
+def apply_batch(operations: list[dict], atomic: bool = True):
+    _require_single_database("Пакет операций")
+    return runner.run(
+        "batch", lambda db: _apply_batch(db, operations, atomic),
+        lambda db, _: account_cache.invalidate(*_batch_account_ids(operations))
+    )
+
+
+async def create_account_async(owner: str, pin: str, initial_balance: float = 0.0):
+    if shard_router is not None:
+        return await asyncio.to_thread(shard_router.create_account, owner, pin, initial_balance)
+    workers.validate_new_account(owner, pin, initial_balance)
+    pin_hash = await auth.hash_pin_async(pin)
+
+    async with AsyncSessionLocal() as db:
+        account = await db.run_sync(workers.create_account, owner, pin, initial_balance, pin_hash)
+        await db.commit()
+        await db.refresh(account)
+        return account
+
+
+async def create_session_async(account_id: int, pin: str):
+    if shard_router is not None:
+        return await asyncio.to_thread(shard_router.create_session, account_id, pin)
+    async with AsyncSessionLocal() as db:
+        await _verify_pin_async(db, account_id, pin)
+        return await db.run_sync(_create_session, account_id, pin)
+
+
+async def _replay_async(request, pin: str | None, token: str | None):
+    async with AsyncSessionLocal() as db:
+        stored = idempotency.cached(request) or await db.run_sync(idempotency.load, request)
+        if stored is None:
+            return None
+        await _verify_pin_async(db, request.account_id, pin, token)
+        await db.run_sync(_get_authorized_snapshot, request.account_id, pin, token)
+        return idempotency.replay(request, stored)
+
+
+async def _run_idempotent_async(name: str, request, pin: str | None, token: str | None, work, body):
+    if request is not None and (replayed := await _replay_async(request, pin, token)) is not None:
+        return _snapshots(replayed)
+    saved = []
+
+    async def recorded(db):
+        response = body(await work(db))
+        saved[:] = [
+            response, await db.run_sync(idempotency.save, request, response) if request is not None else None
+        ]
+
+    async def committed(db, _):
+        if request is not None:
+            idempotency.remember(request, saved[1])
+        _invalidate_body(saved[0])
+
+    try:
+        await runner.run_async(name, recorded, committed)
+    except idempotency.DuplicateRequest:
+        return _snapshots(await _replay_async(request, pin, token))
+    return _snapshots(saved[0])
+
+
+async def _submit_grouped(kind: str, account_id: int, amount: float, pin: str | None, token: str | None):
+    # bcrypt — до очереди, в пуле auth: писатель проверяет PIN уже по кэшу проверок.
+    if pin is not None and token is None and not auth.pin_cached(account_id, pin):
+        async with AsyncSessionLocal() as db:
+            await _verify_pin_async(db, account_id, pin, token)
+    return _snapshots(await group_writer.submit((kind, account_id, amount, pin, token)))
+
+
+async def deposit_to_account_async(account_id: int, amount: float, pin: str | None = None, token: str | None = None,
+                                   idempotency_key: str | None = None):
+    if shard_router is not None and idempotency_key is None:
+        return await asyncio.to_thread(shard_router.deposit_to_account, account_id, amount, pin, token)
+    if group_writer is not None and idempotency_key is None:
+        return await _submit_grouped("deposit", account_id, amount, pin, token)
+
+    async def work(db):
+        await _verify_pin_async(db, account_id, pin, token)
+        return await db.run_sync(workers.deposit, account_id, amount, pin, token)
+    request = _idempotent_request(idempotency_key, "deposit", account_id, amount=amount)
+    return await _run_idempotent_async("deposit", request, pin, token, work, workers.account_body)
+
+
+async def withdraw_from_account_async(account_id: int, amount: float, pin: str | None = None, token: str | None = None,
+                                      idempotency_key: str | None = None):
+    if shard_router is not None and idempotency_key is None:
+        return await asyncio.to_thread(shard_router.withdraw_from_account, account_id, amount, pin, token)
+    if group_writer is not None and idempotency_key is None:
+        return await _submit_grouped("withdraw", account_id, amount, pin, token)
+
+    async def work(db):
+        await _verify_pin_async(db, account_id, pin, token)
+        return await db.run_sync(workers.withdraw, account_id, amount, pin, token)
+    request = _idempotent_request(idempotency_key, "withdraw", account_id, amount=amount)
+    return await _run_idempotent_async("withdraw", request, pin, token, work, workers.account_body)
+
+
+async def transfer_money_async(from_id: int, to_id: int, amount: float, pin: str | None = None, token: str | None = None,
+                               idempotency_key: str | None = None):
+    if shard_router is not None and idempotency_key is None:
+        return await asyncio.to_thread(shard_router.transfer_money, from_id, to_id, amount, pin, token)
+
+    async def work(db):
+        await _verify_pin_async(db, from_id, pin, token)
+        return await db.run_sync(workers.transfer, from_id, to_id, amount, pin, token)
+    request = _idempotent_request(idempotency_key, "transfer", from_id, to_id=to_id, amount=amount)
+    return await _run_idempotent_async("transfer", request, pin, token, work, workers.pair_body)
+
+
+async def get_history_async(account_id: int, pin: str | None = None, token: str | None = None):
+    if shard_router is not None:
+        return await asyncio.to_thread(shard_router.get_history, account_id, pin, token)
+    async with AsyncSessionLocal() as db:
+        await _verify_pin_async(db, account_id, pin, token)
+        return await db.run_sync(_get_history, account_id, pin, token)
+
+
+async def export_history_async(account_id: int, pin: str | None = None, token: str | None = None,
+                               fmt: str = "ndjson", compress: bool = False):
+    _require_single_database("Экспорт истории")
+    writer = ExportWriter(fmt, compress)
+    db = AsyncSessionLocal()
+    try:
+        await _verify_pin_async(db, account_id, pin, token)
+        await db.run_sync(_get_authorized_snapshot, account_id, pin, token)
+    except BaseException:
+        await db.close()
+        raise
+    return _stream_history_async(db, account_id, writer)
+
+
+async def get_account_balance_async(account_id: int, pin: str | None = None, token: str | None = None):
+    if shard_router is not None:
+        return await asyncio.to_thread(shard_router.get_account_balance, account_id, pin, token)
+    return (await _get_snapshot_async(account_id, pin, token)).balance
+
+
+async def get_balance_as_of_async(account_id: int, as_of: datetime | None = None, pin: str | None = None,
+                                  token: str | None = None):
+    if as_of is None and shard_router is not None:
+        return await asyncio.to_thread(shard_router.get_account_balance, account_id, pin, token)
+    _require_single_database("Баланс на дату")
+    async with AsyncSessionLocal() as db:
+        await _verify_pin_async(db, account_id, pin, token)
+        return await db.run_sync(_get_balance_as_of, account_id, pin, token, as_of)
+
+
+async def get_statement_async(account_id: int, period: str, pin: str | None = None, token: str | None = None):
+    _require_single_database("Выписка")
+    async with AsyncSessionLocal() as db:
+        await _verify_pin_async(db, account_id, pin, token)
+        return await db.run_sync(_get_statement, account_id, pin, token, period)
+
+
+async def get_account_by_id_async(account_id: int, pin: str | None = None, token: str | None = None):
+    if shard_router is not None:
+        return await asyncio.to_thread(shard_router.get_account_by_id, account_id, pin, token)
+    return await _get_snapshot_async(account_id, pin, token)
+
+
+async def get_operations_page_async(account_id: int, pin: str | None = None, token: str | None = None,
+                                    limit: int = 50, cursor: str | None = None, date_from: datetime | None = None,
+                                    date_to: datetime | None = None, op_type: str | None = None):
+    _require_single_database("Страницы истории")
+    async with AsyncSessionLocal() as db:
+        await _verify_pin_async(db, account_id, pin, token)
+        return await db.run_sync(
+            _get_operations_page, account_id, pin, token, limit, cursor, date_from, date_to, op_type
+        )
+
+
+async def delete_account_async(account_id: int, pin: str | None = None, token: str | None = None):
+    if shard_router is not None:
+        return await asyncio.to_thread(shard_router.delete_account, account_id, pin, token)
+    async def work(db):
+        await _verify_pin_async(db, account_id, pin, token)
+        await db.run_sync(workers.delete_account, account_id, pin, token)
+    await runner.run_async("delete", work)
+    account_cache.invalidate(account_id)
+    auth.invalidate(account_id)
+    return f"Аккаунт {account_id} успешно удалён"
+
+
+async def apply_batch_async(operations: list[dict], atomic: bool = True):
+    _require_single_database("Пакет операций")
+    async def work(db):
+        credentials = {(op["account_id"], op.get("pin")) for op in operations if op.get("token") is None and op.get("pin") is not None}
+        pin_hashes = dict((await db.execute(
+            select(BankAccount.id, BankAccount._pin).where(BankAccount.id.in_({account_id for account_id, _ in credentials}))
+        )).all())
+        credentials = [(account_id, pin) for account_id, pin in credentials if account_id in pin_hashes]
+        checks = await asyncio.gather(*(
+            auth.verify_pin_async(account_id, pin_hashes[account_id], pin) for account_id, pin in credentials
+        ))
+        verified = {(account_id, pin, None): ok for (account_id, pin), ok in zip(credentials, checks)}
+
+        return await db.run_sync(_apply_batch, operations, atomic, verified)
+
+    async def invalidate(db, _):
+        account_cache.invalidate(*_batch_account_ids(operations))
+    return await runner.run_async("batch", work, invalidate)
@@ -0,0 +1,121 @@
+"""Ключи идемпотентности для пополнения, снятия и перевода.
+
+Ответ на запрос с заголовком Idempotency-Key записывается в idempotency_keys в той же
+транзакции, что и сама операция: либо зафиксированы оба, либо ничего. Повтор с тем же
+ключом отдаёт сохранённый ответ и ничего не выполняет. Записи живут
+settings.idempotency_ttl секунд; перед таблицей стоит LRU-кэш, чтобы повтор сразу после
+ответа обходился без SQL."""
+import hashlib
+import json
+from datetime import datetime, timedelta, UTC
+
+from sqlalchemy import delete
+
+from app import metrics
+from app.cache import LRUCache
+from app.config import settings
+from app.models import IdempotencyKey, upsert
+
+MAX_KEY_LENGTH = 255
+
+
+class DuplicateRequest(Exception):
+    """Тот же ключ зафиксировала другая транзакция, пока выполнялась эта: операцию
+    нужно откатить и отдать сохранённый ответ."""
+
+
+class IdempotentRequest:
+    """Ключ из заголовка вместе со счётом и отпечатком операции и её параметров."""
+    __slots__ = ("account_id", "key", "operation", "fingerprint")
+
+    def __init__(self, key: str, operation: str, account_id: int, **params):
+        if not key or len(key) > MAX_KEY_LENGTH or not key.isprintable():
+            raise ValueError(f"Idempotency-Key должен быть непустой строкой не длиннее {MAX_KEY_LENGTH} символов")
+        self.account_id = account_id
+        self.key = key
+        self.operation = operation
+        payload = json.dumps({"operation": operation, "account_id": account_id, **params}, sort_keys=True)
+        self.fingerprint = hashlib.sha256(payload.encode()).hexdigest()
+
+
+class StoredResponse:
+    __slots__ = ("fingerprint", "body", "expires_at")
+
+    def __init__(self, fingerprint: str, body, expires_at: datetime):
+        self.fingerprint = fingerprint
+        self.body = body
+        self.expires_at = expires_at
+
+
+cache = (
+    LRUCache(maxsize=settings.idempotency_cache_size, ttl=settings.idempotency_ttl)
+    if settings.idempotency_cache_size > 0 else None
+)
+
+
+def _now():
+    # Время в БД хранится наивным UTC, как и у операций.
+    return datetime.now(UTC).replace(tzinfo=None)
+
+
+def cached(request: IdempotentRequest):
+    if cache is None:
+        return None
+    stored = cache.get((request.account_id, request.key))
+    if stored is None or stored.expires_at <= _now():
+        return None
+    return stored
+
+
+def remember(request: IdempotentRequest, stored: StoredResponse):
+    if cache is not None:
+        cache.set((request.account_id, request.key), stored)
+
+
+def load(db, request: IdempotentRequest):
+    """Сохранённый ответ из кэша, иначе из БД; истёкшая запись — как отсутствующая."""
+    stored = cached(request)
+    if stored is not None:
+        return stored
+    row = db.get(IdempotencyKey, (request.account_id, request.key))
+    if row is None or row.expires_at <= _now():
+        return None
+    stored = StoredResponse(row.fingerprint, json.loads(row.response), row.expires_at)
+    remember(request, stored)
+    return stored
+
+
+def replay(request: IdempotentRequest, stored: StoredResponse):
+    # Вызывается после проверки PIN или токена: иначе по ответу об ошибке можно было бы
+    # подбирать чужие ключи.
+    if stored.fingerprint != request.fingerprint:
+        raise ValueError("Idempotency-Key уже использован для другого запроса")
+    metrics.idempotent_replays.inc(operation=request.operation)
+    return stored.body
+
+
+def save(db, request: IdempotentRequest, body):
+    """Пишет ответ в текущей транзакции. Истёкшая запись с тем же ключом заменяется,
+    действующая — нет: тогда DuplicateRequest откатывает операцию."""
+    now = _now()
+    stored = StoredResponse(request.fingerprint, body, now + timedelta(seconds=settings.idempotency_ttl))
+    values = {
+        "operation": request.operation, "fingerprint": request.fingerprint, "response": json.dumps(body),
+        "created_at": now, "expires_at": stored.expires_at,
+    }
+    stmt = upsert(db, IdempotencyKey).values(account_id=request.account_id, key=request.key, **values)
+    result = db.execute(stmt.on_conflict_do_update(
+        index_elements=["account_id", "key"], set_=values, where=IdempotencyKey.expires_at <= now
+    ))
+    if result.rowcount == 0:
+        raise DuplicateRequest(request.key)
+    return stored
+
+
+def purge_expired(db):
+    """Удаляет истёкшие записи; возвращает их число."""
+    return db.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at <= _now())).rowcount
+
+
+def cache_stats():
+    return cache.stats() if cache is not None else {}
@@ -0,0 +1,164 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from itertools import islice
+
+from sqlalchemy import select
+
+from app import auth
+from app.database import SessionLocal, init_db
+from app.workers import validate_new_account
+from app.models import BankAccount, upsert
+
+CHUNK_SIZE = 500
+CHUNKS_PER_TRANSACTION = 20
+MAX_REPORTED_ERRORS = 100
+
+
+def read_rows(stream, fmt: str = "ndjson"):
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == "ndjson":
+        for line_no, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                row = None
+            yield line_no, row
+    else:
+        raise ValueError(f"Неизвестный формат импорта: {fmt}")
+
+
+def _parse_row(row):
+    if not isinstance(row, dict):
+        raise ValueError("Строка не является объектом")
+    owner, pin = row.get("owner"), row.get("pin")
+    if not isinstance(owner, str) or not isinstance(pin, str):
+        raise ValueError("owner и pin должны быть строками")
+    try:
+        balance = float(row.get("balance") or 0.0)
+    except (TypeError, ValueError):
+        raise ValueError("Некорректный начальный баланс")
+    validate_new_account(owner, pin, balance)
+    return owner, pin, balance
+
+
+def _hash_pins(pins):
+    executor = auth.get_executor()
+    if executor is None:
+        return [auth.hash_pin(pin) for pin in pins]
+    return list(executor.map(auth.hash_pin, pins))
+
+
+def _import_chunk(db, chunk, report, on_reject):
+    def reject(line_no, owner, reason):
+        report["rejected"] += 1
+        error = {"line": line_no, "owner": owner, "reason": reason}
+        if len(report["errors"]) < MAX_REPORTED_ERRORS:
+            report["errors"].append(error)
+        if on_reject:
+            on_reject(error)
+
+    candidates = {}
+    for line_no, row in chunk:
+        report["processed"] += 1
+        try:
+            owner, pin, balance = _parse_row(row)
+        except ValueError as e:
+            reject(line_no, row.get("owner") if isinstance(row, dict) else None, str(e))
+            continue
+        if owner in candidates:
+            reject(line_no, owner, "Такой аккаунт уже существует")
+            continue
+        candidates[owner] = (line_no, pin, balance)
+
+    if candidates:
+        existing = set(db.scalars(select(BankAccount.owner).where(BankAccount.owner.in_(candidates))))
+        for owner in [owner for owner in candidates if owner in existing]:
+            line_no, _, _ = candidates.pop(owner)
+            reject(line_no, owner, "Такой аккаунт уже существует")
+
+    if candidates:
+        owners = list(candidates)
+        pin_hashes = _hash_pins([candidates[owner][1] for owner in owners])
+        # Владельца мог создать параллельный запрос уже после проверки выше. ON CONFLICT
+        # DO NOTHING пропускает такие строки, а не роняет IntegrityError всю транзакцию
+        # с предыдущими чанками; RETURNING показывает, какие строки вставлены.
+        inserted = set(db.scalars(
+            upsert(db, BankAccount).on_conflict_do_nothing(index_elements=["owner"]).returning(BankAccount.owner),
+            [
+                {"owner": owner, "balance": candidates[owner][2], "_pin": pin_hash}
+                for owner, pin_hash in zip(owners, pin_hashes)
+            ]
+        ))
+        for owner in owners:
+            if owner not in inserted:
+                reject(candidates[owner][0], owner, "Такой аккаунт уже существует")
+        report["created"] += len(inserted)
+
+
+def import_accounts(stream, fmt: str = "ndjson", chunk_size: int = CHUNK_SIZE,
+                    chunks_per_transaction: int = CHUNKS_PER_TRANSACTION, progress=None, on_reject=None):
+    report = {"processed": 0, "created": 0, "rejected": 0, "errors": []}
+    rows = read_rows(stream, fmt)
+    db = SessionLocal()
+    try:
+        chunks_in_transaction = 0
+        while chunk := list(islice(rows, chunk_size)):
+            _import_chunk(db, chunk, report, on_reject)
+            chunks_in_transaction += 1
+            if chunks_in_transaction >= chunks_per_transaction:
+                db.commit()
+                chunks_in_transaction = 0
+            if progress:
+                progress(report)
+        db.commit()
+        return report
+    finally:
+        db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Массовый импорт аккаунтов из NDJSON или CSV")
+    parser.add_argument("path", help="файл с аккаунтами или '-' для stdin")
+    parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--chunks-per-transaction", type=int, default=CHUNKS_PER_TRANSACTION)
+    parser.add_argument("--rejects", help="куда записать отклонённые строки (NDJSON)")
+    args = parser.parse_args(argv)
+
+    init_db()
+    started = time.perf_counter()
+
+    def progress(report):
+        elapsed = time.perf_counter() - started
+        print(
+            f"\rобработано {report['processed']}, создано {report['created']}, "
+            f"отклонено {report['rejected']} ({report['processed'] / elapsed:.0f} строк/с)",
+            end="", file=sys.stderr, flush=True
+        )
+
+    rejects = open(args.rejects, "w", encoding="utf-8") if args.rejects else None
+    source = sys.stdin if args.path == "-" else open(args.path, encoding="utf-8", newline="")
+    try:
+        report = import_accounts(
+            source, args.format, args.chunk_size, args.chunks_per_transaction, progress=progress,
+            on_reject=(lambda error: rejects.write(json.dumps(error, ensure_ascii=False) + "\n")) if rejects else None
+        )
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if rejects:
+            rejects.close()
+    print(file=sys.stderr)
+    print(json.dumps({k: v for k, v in report.items() if k != "errors"}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import argparse
+import json
+
+from sqlalchemy import case, delete, func, insert, select, update
+
+from app import archive, idempotency
+from app.config import settings
+from app.database import SessionLocal, init_db
+from app.models import BankAccount, Operation, BalanceCheckpoint, DailyAggregate, ArchivedAccount, OPERATION_KINDS, WITHDRAWAL
+
+REBUILD_BATCH_SIZE = 1000
+
+
+def _signed(op_type: str, amount: float):
+    return -amount if op_type == WITHDRAWAL else amount
+
+
+def _rebuild_account_checkpoints(db, account_id: int, balance: float, interval: int):
+    total = db.scalar(select(func.coalesce(func.sum(Operation.signed_amount()), 0.0)).where(
+        Operation.account_id == account_id
+    ))
+    # Начальный баланс не хранится операцией, поэтому восстанавливаем его из текущего.
+    running = balance - total
+    db.execute(delete(BalanceCheckpoint).where(BalanceCheckpoint.account_id == account_id))
+
+    # Архивные операции в таблице не лежат, но входят в счётчик: точки ставятся по его кратным.
+    count = db.scalar(select(func.coalesce(func.sum(ArchivedAccount.operations), 0)).where(
+        ArchivedAccount.account_id == account_id
+    ))
+    checkpoints = []
+    rows = db.execute(
+        select(Operation.id, Operation.type, Operation.amount, Operation.timestamp)
+        .where(Operation.account_id == account_id)
+        .order_by(Operation.timestamp, Operation.id)
+        .execution_options(yield_per=REBUILD_BATCH_SIZE)
+    )
+    for row in rows:
+        count += 1
+        running += _signed(row.type, row.amount)
+        if count % interval == 0:
+            checkpoints.append({
+                "account_id": account_id, "operation_id": row.id, "timestamp": row.timestamp, "balance": running
+            })
+    if checkpoints:
+        db.execute(insert(BalanceCheckpoint), checkpoints)
+    db.execute(update(BankAccount).where(BankAccount.id == account_id).values(operation_count=count))
+    return len(checkpoints)
+
+
+def rebuild_checkpoints(account_ids=None, interval: int | None = None):
+    """Пересобирает контрольные точки баланса по истории операций: для счетов,
+    чья история появилась до точек, или после смены checkpoint_interval."""
+    interval = interval or settings.checkpoint_interval
+    report = {"accounts": 0, "checkpoints": 0}
+    db = SessionLocal()
+    try:
+        query = select(BankAccount.id, BankAccount.balance).order_by(BankAccount.id)
+        if account_ids:
+            query = query.where(BankAccount.id.in_(account_ids))
+        for account_id, balance in db.execute(query).all():
+            report["checkpoints"] += _rebuild_account_checkpoints(db, account_id, balance, interval)
+            report["accounts"] += 1
+            # Один счёт — одна транзакция: писатели ждут недолго, а прерванный запуск
+            # можно просто повторить.
+            db.commit()
+        return report
+    finally:
+        db.close()
+
+
+def rebuild_daily_aggregates(conn, account_ids=None, since=None):
+    """Пересчитывает дневные обороты одним INSERT ... SELECT ... GROUP BY.
+    Принимает Connection или Session; транзакцией управляет вызывающий.
+    since — первый пересчитываемый день: обороты за архивированные дни по таблице
+    уже не восстановить, их нужно оставить как есть."""
+    day = func.date(Operation.timestamp)
+    columns = [Operation.account_id, day]
+    names = ["account_id", "day"]
+    for kind in OPERATION_KINDS:
+        matches = Operation.kind_filter(kind)
+        columns += [
+            func.sum(case((matches, 1), else_=0)),
+            func.sum(case((matches, func.abs(Operation.amount)), else_=0.0)),
+        ]
+        names += [f"{kind}_count", f"{kind}_total"]
+
+    grouped = select(*columns).where(
+        Operation.account_id.is_not(None), Operation.timestamp.is_not(None)
+    ).group_by(Operation.account_id, day)
+    cleanup = delete(DailyAggregate)
+    if account_ids:
+        grouped = grouped.where(Operation.account_id.in_(account_ids))
+        cleanup = cleanup.where(DailyAggregate.account_id.in_(account_ids))
+    if since is not None:
+        grouped = grouped.where(Operation.timestamp >= since)
+        cleanup = cleanup.where(DailyAggregate.day >= since.date())
+    conn.execute(cleanup)
+    return conn.execute(insert(DailyAggregate).from_select(names, grouped)).rowcount
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Обслуживание производных данных по операциям")
+    commands = parser.add_subparsers(dest="command", required=True)
+    checkpoints = commands.add_parser("checkpoints", help="пересобрать контрольные точки баланса")
+    checkpoints.add_argument("--account", type=int, action="append", help="ID счёта (можно несколько)")
+    checkpoints.add_argument("--interval", type=int, default=None)
+    aggregates = commands.add_parser("aggregates", help="пересчитать дневные обороты для выписок")
+    aggregates.add_argument("--account", type=int, action="append", help="ID счёта (можно несколько)")
+    commands.add_parser("idempotency", help="удалить истёкшие ключи идемпотентности")
+    args = parser.parse_args(argv)
+
+    init_db()
+    if args.command == "checkpoints":
+        report = rebuild_checkpoints(args.account, args.interval)
+    elif args.command == "idempotency":
+        db = SessionLocal()
+        try:
+            report = {"purged": idempotency.purge_expired(db)}
+            db.commit()
+        finally:
+            db.close()
+    else:
+        db = SessionLocal()
+        try:
+            report = {"days": rebuild_daily_aggregates(db, args.account, archive.archived_until(db))}
+            db.commit()
+        finally:
+            db.close()
+    print(json.dumps(report, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,105 @@
-from fastapi import FastAPI
-from app.api.routes import router
-from app.database import init_db
+"""Приложение FastAPI.
 
-app = FastAPI(title="Bank Account API", log_level="debug")
+create_app() собирает приложение, а схема базы создаётся и мигрируется в lifespan при
+старте сервера: импорт app.main не трогает базу и не загружает бизнес-логику, а
+атрибут app собирается при первом обращении.
 
-init_db()
+    uvicorn app.main:app
+    uvicorn app.main:create_app --factory
+"""
+from contextlib import asynccontextmanager
 
-app.include_router(router)
+from fastapi import APIRouter, FastAPI
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
 
-@app.get("/")
+from app import metrics
+
+service = APIRouter()
+
+
+@service.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@service.get("/")
 def redd_root():
-    return {"message": "Welcome"}
\ No newline at end of file
+    return {"message": "Welcome"}
+
+
+def _runtime_stats():
+    # Счётчики, которые уже ведут runner и кэши, — в формате Prometheus на момент запроса.
+    # Модули импортируются здесь: к первому сбору метрик они уже загружены приложением.
+    from app import auth, idempotency
+    from app.functions import runner
+    from app.snapshots import account_cache
+
+    transactions = runner.stats.snapshot()
+    for field, name, documentation in (
+        ("calls", "bank_transactions_total", "Зафиксированные и отклонённые транзакции runner"),
+        ("retries", "bank_transaction_retries_total", "Повторы из-за блокировки базы"),
+        ("failures", "bank_transaction_failures_total", "Транзакции, не прошедшие за отведённые попытки"),
+        ("lock_wait", "bank_transaction_lock_wait_seconds_total", "Время, потерянное на блокировках"),
+    ):
+        yield name, "counter", documentation, [({"operation": op}, entry[field]) for op, entry in transactions.items()]
+
+    for cache_name, stats in (
+        ("account", account_cache.stats()), ("pin", auth.credential_cache_stats()),
+        ("idempotency", idempotency.cache_stats()),
+    ):
+        if not stats:
+            continue
+        yield f"bank_{cache_name}_cache_size", "gauge", "Записей в кэше", [({}, stats["size"])]
+        for field in ("hits", "misses", "evictions", "expirations"):
+            yield f"bank_{cache_name}_cache_{field}_total", "counter", f"Кэш: {field}", [({}, stats[field])]
+
+
+metrics.registry.register_collector(_runtime_stats)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    from app import functions
+    from app.config import settings
+    from app.database import init_db
+
+    # Пока схема не готова, запросы не принимаются; при актуальной версии схемы это
+    # один запрос версии (в SQLite — PRAGMA user_version).
+    await run_in_threadpool(init_db)
+    router = None
+    if settings.shard_urls:
+        from app.sharding import ShardRouter
+
+        # Схема шардов и завершение переводов, оставшихся в prepared после падения, —
+        # до первого запроса, а не по ручному запуску python -m app.sharding recover.
+        router = ShardRouter.from_settings()
+        await run_in_threadpool(router.init)
+        functions.configure_sharding(router)
+    yield
+    if functions.group_writer is not None:
+        functions.group_writer.close()
+    if router is not None:
+        functions.configure_sharding(None)
+        router.dispose()
+
+
+def create_app():
+    # Роуты тянут за собой бизнес-логику, модели и движки базы — только когда
+    # приложение действительно собирают.
+    from app.api.routes import router
+
+    app = FastAPI(title="Bank Account API", log_level="debug", lifespan=lifespan)
+    app.add_middleware(metrics.MetricsMiddleware)
+    app.include_router(router)
+    app.include_router(service)
+    return app
+
+
+def __getattr__(name):
+    # app.main:app для uvicorn и тестов собирается при первом обращении, а не при импорте.
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,389 @@
+"""Метрики в текстовом формате Prometheus: задержки маршрутов, время bcrypt, запросы
+к БД и коммиты — в целом и в разрезе запроса.
+
+Внутри HTTP-запроса время по фазам копится в RequestPhases из contextvar: события
+SQLAlchemy выполняются в том же контексте (и в greenlet асинхронного движка), а
+bcrypt в пуле auth получает копию контекста при отправке задачи."""
+import math
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+from sqlalchemy import event
+
+from app.config import settings
+
+# Число сочетаний значений меток на метрику; сверх него значения заменяются на "other",
+# чтобы неожиданные пути или методы не раздували ответ /metrics.
+MAX_SERIES = 500
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+METHODS = {"GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS"}
+STATEMENTS = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+PHASES = ("db", "pin", "commit")
+
+# Заголовки X-Query-Count и X-Query-Time с числом и временем SQL-запросов в ответе —
+# для отладки и тестов; в рабочей конфигурации выключены (BANK_DEBUG_QUERY_HEADER).
+QUERY_HEADER = settings.debug_query_header
+
+
+def _escape(value: str):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + "}"
+
+
+def _format_value(value: float):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = Lock()
+
+    def _key(self, labels: dict):
+        key = tuple(str(labels[name]) for name in self.labels)
+        if key not in self._series and len(self._series) >= MAX_SERIES:
+            key = ("other",) * len(self.labels)
+        return key
+
+    def collect(self):
+        raise NotImplementedError
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        super().__init__(f"{name}_total", documentation, labels)
+
+    def inc(self, amount: float = 1.0, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0.0) + amount
+
+    def value(self, **labels):
+        return self._series.get(tuple(str(labels[name]) for name in self.labels), 0.0)
+
+    def collect(self):
+        with self._lock:
+            return [(self.name, _format_labels(self.labels, key), value) for key, value in self._series.items()]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        with self._lock:
+            key = self._key(labels)
+            series = self._series.get(key)
+            if series is None:
+                # Счётчики по корзинам (не накопительные), сумма, количество.
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels):
+        series = self._series.get(tuple(str(labels[name]) for name in self.labels))
+        return series[2] if series else 0
+
+    def collect(self):
+        samples = []
+        with self._lock:
+            for key, (buckets, total, count) in self._series.items():
+                cumulative = 0
+                for bound, hits in zip(self.buckets, buckets):
+                    cumulative += hits
+                    samples.append((f"{self.name}_bucket", _format_labels(self.labels, key, [("le", bound)]), cumulative))
+                samples.append((f"{self.name}_bucket", _format_labels(self.labels, key, [("le", "+Inf")]), count))
+                samples.append((f"{self.name}_sum", _format_labels(self.labels, key), total))
+                samples.append((f"{self.name}_count", _format_labels(self.labels, key), count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name: str, documentation: str, labels=()):
+        metric = Counter(name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collect):
+        """collect() возвращает [(имя, тип, описание, [(метки dict, значение), ...]), ...] —
+        для значений, которые уже считает кто-то другой (runner.stats, кэш счетов)."""
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines += [f"# HELP {metric.name} {metric.documentation}", f"# TYPE {metric.name} {metric.type}"]
+            lines += [f"{name}{labels} {_format_value(value)}" for name, labels, value in metric.collect()]
+        for collect in self._collectors:
+            for name, type_, documentation, samples in collect():
+                lines += [f"# HELP {name} {documentation}", f"# TYPE {name} {type_}"]
+                lines += [
+                    f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}"
+                    for labels, value in samples
+                ]
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        for metric in self._metrics:
+            metric.reset()
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "bank_http_requests", "HTTP-запросы по маршруту и классу статуса", ("method", "route", "status")
+)
+http_duration = registry.histogram(
+    "bank_http_request_duration_seconds", "Время обработки HTTP-запроса", ("method", "route")
+)
+http_phase = registry.histogram(
+    "bank_http_request_phase_seconds", "Время запроса по фазам: db — SQL, pin — bcrypt, commit — фиксация",
+    ("route", "phase")
+)
+http_db_queries = registry.histogram(
+    "bank_http_request_db_queries", "Число SQL-запросов на один HTTP-запрос", ("route",), COUNT_BUCKETS
+)
+db_query_duration = registry.histogram("bank_db_query_duration_seconds", "Время SQL-запроса", ("statement",))
+db_commit_duration = registry.histogram("bank_db_commit_duration_seconds", "Время фиксации транзакции")
+pin_duration = registry.histogram(
+    "bank_pin_duration_seconds", "Время bcrypt: hash — set_pin, verify — check_pin без попадания в кэш",
+    ("operation",)
+)
+group_commit_batch = registry.histogram(
+    "bank_group_commit_batch_size", "Операций в одной транзакции группового коммита", (), COUNT_BUCKETS
+)
+idempotent_replays = registry.counter(
+    "bank_idempotent_replays", "Повторы по Idempotency-Key, отданные из сохранённого ответа", ("operation",)
+)
+
+
+class RequestPhases:
+    __slots__ = ("db_queries", "db", "pin", "commit", "_lock")
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db = 0.0
+        self.pin = 0.0
+        self.commit = 0.0
+        # Пакет операций проверяет несколько PIN параллельно в разных потоках.
+        self._lock = Lock()
+
+    def add(self, phase: str, seconds: float, queries: int = 0):
+        with self._lock:
+            setattr(self, phase, getattr(self, phase) + seconds)
+            self.db_queries += queries
+
+
+_phases: ContextVar[RequestPhases | None] = ContextVar("bank_request_phases", default=None)
+
+
+def current_phases():
+    return _phases.get()
+
+
+def _add_phase(phase: str, seconds: float, queries: int = 0):
+    phases = _phases.get()
+    if phases is not None:
+        phases.add(phase, seconds, queries)
+
+
+class QueryCounter:
+    __slots__ = ("count", "statements")
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def add(self, statement: str):
+        self.count += 1
+        self.statements.append(statement)
+
+
+class QueryBudgetExceeded(AssertionError):
+    def __init__(self, limit: int, counter: QueryCounter):
+        listing = "\n".join(f"  {index}. {statement}" for index, statement in enumerate(counter.statements, 1))
+        super().__init__(f"Выполнено SQL-запросов: {counter.count}, допустимо: {limit}\n{listing}")
+        self.limit = limit
+        self.counter = counter
+
+
+_query_counters: ContextVar[tuple] = ContextVar("bank_query_counters", default=())
+
+
+@contextmanager
+def count_queries():
+    """Считает SQL-запросы, выполненные в текущем контексте (в том числе из
+    asyncio.run и run_sync). Вложенные счётчики видят и запросы внутренних блоков."""
+    counter = QueryCounter()
+    token = _query_counters.set(_query_counters.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        _query_counters.reset(token)
+
+
+@contextmanager
+def query_budget(limit: int):
+    """Падает с QueryBudgetExceeded (и списком запросов), если блок выполнил больше limit запросов."""
+    with count_queries() as counter:
+        yield counter
+    if counter.count > limit:
+        raise QueryBudgetExceeded(limit, counter)
+
+
+@contextmanager
+def pin_timer(operation: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        pin_duration.observe(elapsed, operation=operation)
+        _add_phase("pin", elapsed)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["metrics_query_started"].pop()
+    elapsed = time.perf_counter() - started
+    keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    db_query_duration.observe(elapsed, statement=keyword.lower() if keyword in STATEMENTS else "other")
+    _add_phase("db", elapsed, queries=1)
+    for counter in _query_counters.get():
+        counter.add(statement)
+
+
+def _handle_error(context):
+    # После ошибки after_cursor_execute не вызывается — убираем отметку о начале.
+    started = context.connection.info.get("metrics_query_started") if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def instrument_engine(engine):
+    """Время и число SQL-запросов; для async-движка передаётся async_engine.sync_engine."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+def _before_commit(session):
+    session.info["metrics_commit_started"] = time.perf_counter()
+
+
+def _after_flush_postexec(session, flush_context):
+    # Сброс изменений внутри commit() — это обычные SQL-запросы, они уже учтены в фазе db;
+    # отсчёт времени фиксации начинается после него.
+    if "metrics_commit_started" in session.info:
+        session.info["metrics_commit_started"] = time.perf_counter()
+
+
+def _after_commit(session):
+    started = session.info.pop("metrics_commit_started", None)
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        db_commit_duration.observe(elapsed)
+        _add_phase("commit", elapsed)
+
+
+def _after_rollback(session):
+    session.info.pop("metrics_commit_started", None)
+
+
+def instrument_sessions(session_class):
+    event.listen(session_class, "before_commit", _before_commit)
+    event.listen(session_class, "after_flush_postexec", _after_flush_postexec)
+    event.listen(session_class, "after_commit", _after_commit)
+    event.listen(session_class, "after_rollback", _after_rollback)
+
+
+def _route_label(scope):
+    # Шаблон пути (/accounts/{account_id}), а не сам путь: число значений ограничено числом маршрутов.
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: задержка, статус и фазы каждого HTTP-запроса. Время считается
+    до конца отправки тела, поэтому потоковые выгрузки учитываются целиком."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if QUERY_HEADER:
+                    # Для потоковых ответов — только запросы до начала отправки тела.
+                    message = {**message, "headers": [
+                        *message.get("headers", []),
+                        (b"x-query-count", str(phases.db_queries).encode()),
+                        (b"x-query-time", f"{phases.db * 1000:.3f}".encode()),
+                    ]}
+            await send(message)
+
+        phases = RequestPhases()
+        token = _phases.set(phases)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            _phases.reset(token)
+            method = scope["method"] if scope["method"] in METHODS else "other"
+            route = _route_label(scope)
+            http_requests.inc(method=method, route=route, status=f"{status // 100}xx")
+            http_duration.observe(elapsed, method=method, route=route)
+            http_db_queries.observe(phases.db_queries, route=route)
+            for phase in PHASES:
+                http_phase.observe(getattr(phases, phase), route=route, phase=phase)
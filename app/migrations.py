@@ -0,0 +1,116 @@
+from sqlalchemy import Column, Integer, MetaData, Table, delete, inspect, insert, select, text
+
+# Версия схемы вне SQLite: у других СУБД нет PRAGMA user_version.
+schema_version = Table("schema_version", MetaData(), Column("version", Integer, nullable=False))
+
+
+def _add_operations_index(conn):
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_operations_account_timestamp_id "
+        "ON operations (account_id, timestamp, id)"
+    ))
+
+
+def _add_owner_unique_index(conn):
+    duplicates = conn.execute(text(
+        "SELECT owner FROM accounts GROUP BY owner HAVING COUNT(*) > 1 LIMIT 10"
+    )).scalars().all()
+    if duplicates:
+        raise RuntimeError(
+            "Нельзя создать уникальный индекс по owner: повторяются владельцы "
+            + ", ".join(duplicates) + ". Исправьте данные и запустите миграцию снова."
+        )
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_accounts_owner ON accounts (owner)"))
+
+
+def _add_operation_count(conn):
+    columns = {column["name"] for column in inspect(conn).get_columns("accounts")}
+    if "operation_count" not in columns:
+        conn.execute(text("ALTER TABLE accounts ADD COLUMN operation_count INTEGER NOT NULL DEFAULT 0"))
+    conn.execute(text(
+        "UPDATE accounts SET operation_count = "
+        "(SELECT COUNT(*) FROM operations WHERE operations.account_id = accounts.id)"
+    ))
+
+
+def _add_daily_aggregates(conn):
+    # Импорт здесь: модели и ledger сами зависят от app.database, который импортирует этот модуль.
+    from app.ledger import rebuild_daily_aggregates
+    from app.models import DailyAggregate
+
+    DailyAggregate.__table__.create(conn, checkfirst=True)
+    rebuild_daily_aggregates(conn)
+
+
+def _add_idempotency_keys(conn):
+    from app.models import IdempotencyKey
+
+    IdempotencyKey.__table__.create(conn, checkfirst=True)
+
+
+def _add_shard_transfers(conn):
+    from app.models import ShardTransfer
+
+    ShardTransfer.__table__.create(conn, checkfirst=True)
+
+
+def _add_archive_catalog(conn):
+    from app.models import ArchiveSegment, ArchivedAccount
+
+    ArchiveSegment.__table__.create(conn, checkfirst=True)
+    ArchivedAccount.__table__.create(conn, checkfirst=True)
+
+
+# (версия, описание, функция). Версия схемы хранится в PRAGMA user_version (SQLite) или
+# в таблице schema_version; каждая миграция выполняется в своей транзакции вместе с
+# записью новой версии.
+MIGRATIONS = [
+    (1, "составной индекс operations(account_id, timestamp, id)", _add_operations_index),
+    (2, "уникальный индекс accounts(owner)", _add_owner_unique_index),
+    (3, "счётчик операций accounts.operation_count", _add_operation_count),
+    (4, "дневные обороты daily_aggregates", _add_daily_aggregates),
+    (5, "ключи идемпотентности idempotency_keys", _add_idempotency_keys),
+    (6, "журнал межшардовых переводов shard_transfers", _add_shard_transfers),
+    (7, "каталог архива операций archive_segments, archived_accounts", _add_archive_catalog),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _uses_pragma(conn):
+    return conn.dialect.name == "sqlite"
+
+
+def get_schema_version(conn):
+    if _uses_pragma(conn):
+        return conn.execute(text("PRAGMA user_version")).scalar()
+    if not inspect(conn).has_table(schema_version.name):
+        return 0
+    return conn.scalar(select(schema_version.c.version)) or 0
+
+
+def _set_schema_version(conn, version: int):
+    if _uses_pragma(conn):
+        conn.execute(text(f"PRAGMA user_version = {int(version)}"))
+        return
+    schema_version.create(conn, checkfirst=True)
+    conn.execute(delete(schema_version))
+    conn.execute(insert(schema_version).values(version=version))
+
+
+def run_migrations(engine):
+    applied = []
+    with engine.connect() as conn:
+        version = get_schema_version(conn)
+    for target, description, migrate in MIGRATIONS:
+        if target <= version:
+            continue
+        with engine.connect() as conn:
+            # pysqlite сам не открывает транзакцию перед DDL, поэтому BEGIN явно:
+            # иначе индекс и новая версия схемы фиксировались бы по отдельности.
+            if _uses_pragma(conn):
+                conn.exec_driver_sql("BEGIN")
+            migrate(conn)
+            _set_schema_version(conn, target)
+            conn.commit()
+        applied.append((target, description))
+    return applied
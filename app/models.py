@@ -1,73 +1,143 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, Text, ForeignKey, Index, update, case
 from sqlalchemy.orm import relationship, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+import importlib
 from datetime import datetime, UTC
 from app.database import Base
-import bcrypt
+from app import auth
+from app.config import settings
+
+DEPOSIT = "Пополнение"
+WITHDRAWAL = "Снятие"
+TRANSFER_OUT = "Перевод на аккаунт"
+TRANSFER_IN = "Перевод от аккаунта"
+
+# Ключи для DailyAggregate (колонки <kind>_count и <kind>_total) и выписок.
+OPERATION_KINDS = ("deposit", "withdrawal", "transfer_in", "transfer_out")
+
+
+def operation_kind(type_: str):
+    if type_ == DEPOSIT:
+        return "deposit"
+    if type_ == WITHDRAWAL:
+        return "withdrawal"
+    if type_.startswith(TRANSFER_OUT):
+        return "transfer_out"
+    if type_.startswith(TRANSFER_IN):
+        return "transfer_in"
+    raise ValueError(f"Неизвестный тип операции: {type_}")
 
 class BankAccount(Base):
     __tablename__ = "accounts"
     
     id = Column(Integer, primary_key=True)
-    owner = Column(String, nullable=False)
+    owner = Column(String, nullable=False, unique=True, index=True)
     balance = Column(Float, default=0.0)
     created_at = Column(DateTime, default=datetime.now(UTC))
     _pin = Column("pin", String, nullable=False)
+    # Сколько операций было по счёту; по нему add_operation решает, когда писать контрольную точку.
+    operation_count = Column(Integer, nullable=False, default=0, server_default="0")
     
-    operations = relationship("Operation", back_populates="account", cascade="all, delete-orphan")
+    # passive_deletes: при удалении счёта коллекции не загружаются — workers.delete_account
+    # удаляет дочерние строки сам, одним DELETE на таблицу.
+    operations = relationship("Operation", back_populates="account", cascade="all, delete-orphan", passive_deletes=True)
+    checkpoints = relationship("BalanceCheckpoint", cascade="all, delete-orphan", passive_deletes=True)
+    daily_aggregates = relationship("DailyAggregate", cascade="all, delete-orphan", passive_deletes=True)
 
     def set_pin(self, pin: str):
-        hashed = bcrypt.hashpw(pin.encode(), bcrypt.gensalt())
-        self._pin = hashed.decode()
+        self._pin = auth.hash_pin(pin)
 
     def check_pin(self, pin: str):
-        return bcrypt.checkpw(pin.encode(), self._pin.encode())
+        return auth.verify_pin(self.id, self._pin, pin)
+
+    def issue_token(self):
+        return auth.issue_token(self.id, self._pin)
+
+    def check_token(self, token: str):
+        return auth.verify_token(self.id, self._pin, token)
     
-    def deposit(self, amount, pin):
-        if not self.check_pin(pin):
-            raise ValueError("Неверный PIN-код")
+    def _change_balance(self, delta):
+        """Меняет баланс одним UPDATE ... SET balance = balance + :delta; списание
+        выполняется только при WHERE balance >= :amount. Поэтому два конкурентных
+        снятия не могут оба пройти проверку по устаревшему балансу в памяти."""
+        session = object_session(self)
+        if session is None or self.id is None:
+            if self.balance + delta < 0:
+                raise ValueError("Недостаточно средств")
+            self.balance += delta
+            self.operation_count = (self.operation_count or 0) + 1
+            return
+        stmt = (
+            update(BankAccount)
+            .where(BankAccount.id == self.id)
+            .values(balance=BankAccount.balance + delta, operation_count=BankAccount.operation_count + 1)
+            .returning(BankAccount.balance, BankAccount.operation_count)
+        )
+        if delta < 0:
+            stmt = stmt.where(BankAccount.balance >= -delta)
+        row = session.execute(stmt, execution_options={"synchronize_session": False}).one_or_none()
+        if row is None:
+            raise ValueError("Недостаточно средств")
+        set_committed_value(self, "balance", row.balance)
+        set_committed_value(self, "operation_count", row.operation_count)
+
+    def deposit(self, amount):
         if amount <= 0:
             raise ValueError("Сумма должна быть положительной")
-        self.balance += amount
-        self.add_operation("Пополнение", amount)
+        self._change_balance(amount)
+        self.add_operation(DEPOSIT, amount)
         
-    def withdraw(self, amount, pin):
-        if not self.check_pin(pin):
-            raise ValueError("Неверный PIN-код")
+    def withdraw(self, amount):
         if amount <= 0:
             raise ValueError("Сумма должна быть положительной")
-        if amount > self.balance:
-            raise ValueError("Недостаточно средств")
-        self.balance -= amount
-        self.add_operation("Снятие", amount)
+        self._change_balance(-amount)
+        self.add_operation(WITHDRAWAL, amount)
 
-    def transfer(self, to_account, amount, pin):
-        if not self.check_pin(pin):
-            raise ValueError("Неверный PIN-код")
+    def transfer_out(self, to_id: int, amount):
+        """Списывающая половина перевода. Межшардовый перевод (app/sharding.py) выполняет
+        половины в разных базах; в одной базе — transfer."""
         if amount <= 0:
             raise ValueError("Сумма должна быть положительной")
-        if amount > self.balance:
-            raise ValueError("Недостаточно средств")
+        self._change_balance(-amount)
+        self.add_operation(f"{TRANSFER_OUT} {to_id}", -amount)
 
-        self.balance -= amount
-        to_account.balance += amount
+    def transfer_in(self, from_id: int, amount):
+        if amount <= 0:
+            raise ValueError("Сумма должна быть положительной")
+        self._change_balance(amount)
+        self.add_operation(f"{TRANSFER_IN} {from_id}", amount)
+
+    def transfer(self, to_account, amount):
+        if amount <= 0:
+            raise ValueError("Сумма должна быть положительной")
 
-        self.add_operation(f"Перевод на аккаунт {to_account.id}", -amount)
-        to_account.add_operation(f"Перевод от аккаунта {self.id}", amount)
+        # Операция пишется сразу за своим изменением баланса: при переводе самому себе
+        # оба изменения идут по одной строке, и контрольная точка должна получить баланс
+        # после своей половины, а не после обеих.
+        self._change_balance(-amount)
+        self.add_operation(f"{TRANSFER_OUT} {to_account.id}", -amount)
+        to_account._change_balance(amount)
+        to_account.add_operation(f"{TRANSFER_IN} {self.id}", amount)
 
     def add_operation(self, type_, amount):
         op = Operation(type=type_, amount=amount, timestamp=datetime.now(UTC), account=self)
         session = object_session(self)
         if session:
             session.add(op)
-        
-    def get_history(self, pin):
-        if not self.check_pin(pin):
-            raise ValueError("Неверный PIN-код")
-        return [(op.type, op.amount, op.timestamp.strftime("%Y-%m-%d %H:%M:%S")) for op in self.operations]
+            # self.balance здесь — значение из UPDATE ... RETURNING, т.е. баланс сразу после op:
+            # вызывающий добавляет операцию сразу за её _change_balance.
+            if self.operation_count and self.operation_count % settings.checkpoint_interval == 0:
+                session.add(BalanceCheckpoint(
+                    account_id=self.id, operation=op, timestamp=op.timestamp, balance=self.balance
+                ))
+            DailyAggregate.record(session, self.id, op.timestamp, type_, amount)
     
     
 class Operation(Base):
     __tablename__ = "operations"
+    __table_args__ = (
+        Index("ix_operations_account_timestamp_id", "account_id", "timestamp", "id"),
+    )
     
     id = Column(Integer, primary_key=True)
     type = Column(String)
@@ -75,4 +145,159 @@ class Operation(Base):
     timestamp = Column(DateTime, default=datetime.now(UTC))
     account_id = Column(Integer, ForeignKey("accounts.id"))
     
-    account = relationship("BankAccount", back_populates="operations")
\ No newline at end of file
+    account = relationship("BankAccount", back_populates="operations")
+
+    @staticmethod
+    def kind_filter(kind: str):
+        match kind:
+            case "deposit":
+                return Operation.type == DEPOSIT
+            # withdrawal — как в OPERATION_KINDS, выписках и аналитике; withdraw — как в URL операции.
+            case "withdraw" | "withdrawal":
+                return Operation.type == WITHDRAWAL
+            case "transfer_out":
+                return Operation.type.startswith(TRANSFER_OUT)
+            case "transfer_in":
+                return Operation.type.startswith(TRANSFER_IN)
+            case "transfer":
+                return Operation.type.startswith(TRANSFER_OUT) | Operation.type.startswith(TRANSFER_IN)
+        raise ValueError(f"Неизвестный тип операции: {kind}")
+
+    @staticmethod
+    def signed_amount():
+        # Снятие хранится положительной суммой, исходящий перевод — отрицательной.
+        return case((Operation.type == WITHDRAWAL, -Operation.amount), else_=Operation.amount)
+
+
+class BalanceCheckpoint(Base):
+    """Баланс счёта сразу после операции operation_id. Пишется каждые
+    settings.checkpoint_interval операций по счёту, чтобы баланс на дату считался
+    от ближайшей точки, а не пересчётом всей истории."""
+    __tablename__ = "balance_checkpoints"
+    __table_args__ = (
+        Index("ix_balance_checkpoints_account_timestamp", "account_id", "timestamp", "operation_id"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    account_id = Column(Integer, ForeignKey("accounts.id", ondelete="CASCADE"), nullable=False)
+    operation_id = Column(Integer, ForeignKey("operations.id", ondelete="CASCADE"), nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+    balance = Column(Float, nullable=False)
+
+    operation = relationship("Operation")
+
+
+# Диалекты с INSERT ... ON CONFLICT. Модуль PostgreSQL тянет за собой asyncpg и psycopg,
+# поэтому диалект импортируется при первом upsert, а не при импорте моделей.
+_UPSERT_DIALECTS = {"postgresql": "sqlalchemy.dialects.postgresql", "sqlite": "sqlalchemy.dialects.sqlite"}
+
+
+def upsert(session, model):
+    """insert(model) диалекта базы сессии — с on_conflict_do_update/do_nothing."""
+    return importlib.import_module(_UPSERT_DIALECTS[session.get_bind().dialect.name]).insert(model)
+
+
+class DailyAggregate(Base):
+    """Обороты счёта за день (UTC) по видам операций. Обновляется в той же
+    транзакции, что и операция; выписки за месяц и год суммируют дневные строки."""
+    __tablename__ = "daily_aggregates"
+
+    account_id = Column(Integer, ForeignKey("accounts.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    deposit_count = Column(Integer, nullable=False, default=0, server_default="0")
+    deposit_total = Column(Float, nullable=False, default=0.0, server_default="0")
+    withdrawal_count = Column(Integer, nullable=False, default=0, server_default="0")
+    withdrawal_total = Column(Float, nullable=False, default=0.0, server_default="0")
+    transfer_in_count = Column(Integer, nullable=False, default=0, server_default="0")
+    transfer_in_total = Column(Float, nullable=False, default=0.0, server_default="0")
+    transfer_out_count = Column(Integer, nullable=False, default=0, server_default="0")
+    transfer_out_total = Column(Float, nullable=False, default=0.0, server_default="0")
+
+    @staticmethod
+    def record(session, account_id: int, timestamp: datetime, type_: str, amount: float):
+        kind = operation_kind(type_)
+        count, total = f"{kind}_count", f"{kind}_total"
+        # Суммы хранятся по модулю: у исходящего перевода amount отрицательный.
+        stmt = upsert(session, DailyAggregate).values(
+            account_id=account_id, day=timestamp.date(), **{count: 1, total: abs(amount)}
+        )
+        table = DailyAggregate.__table__.c
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=["account_id", "day"],
+            set_={count: table[count] + 1, total: table[total] + abs(amount)}
+        ))
+
+
+class IdempotencyKey(Base):
+    """Сохранённый ответ на денежную операцию с заголовком Idempotency-Key. Ключ
+    действует в пределах счёта, с которого списываются или на который зачисляются
+    деньги; строка пишется в той же транзакции, что и операция (app/idempotency.py)."""
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        Index("ix_idempotency_keys_expires_at", "expires_at"),
+    )
+
+    account_id = Column(Integer, ForeignKey("accounts.id", ondelete="CASCADE"), primary_key=True)
+    key = Column(String, primary_key=True)
+    operation = Column(String, nullable=False)
+    # SHA-256 от операции и её параметров: тот же ключ с другим телом запроса — ошибка.
+    fingerprint = Column(String, nullable=False)
+    response = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class ShardTransfer(Base):
+    """Запись межшардового перевода в базе одного из участников (app/sharding.py).
+    У получателя она появляется в состоянии prepared до списания и переходит в
+    committed или aborted; у отправителя пишется сразу committed в одной транзакции
+    со списанием и служит решением при восстановлении."""
+    __tablename__ = "shard_transfers"
+    __table_args__ = (
+        Index("ix_shard_transfers_state", "state", "role"),
+    )
+
+    id = Column(String, primary_key=True)
+    role = Column(String, nullable=False)
+    account_id = Column(Integer, nullable=False)
+    counterparty_id = Column(Integer, nullable=False)
+    amount = Column(Float, nullable=False)
+    state = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class ArchiveSegment(Base):
+    """Файл архива операций (app/archive.py): операции счетов first_account_id..last_account_id
+    старше cutoff. Файл неизменяем; checksum — SHA-256 всего файла."""
+    __tablename__ = "archive_segments"
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String, nullable=False, unique=True)
+    first_account_id = Column(Integer, nullable=False)
+    last_account_id = Column(Integer, nullable=False)
+    cutoff = Column(DateTime, nullable=False)
+    operations = Column(Integer, nullable=False)
+    total = Column(Float, nullable=False)
+    checksum = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+
+class ArchivedAccount(Base):
+    """Блок одного счёта в сегменте архива: где он лежит в файле и что в нём.
+    balance_after — баланс сразу после последней операции блока; total — сумма
+    операций со знаком."""
+    __tablename__ = "archived_accounts"
+    __table_args__ = (
+        Index("ix_archived_accounts_account", "account_id", "last_timestamp"),
+    )
+
+    segment_id = Column(Integer, ForeignKey("archive_segments.id"), primary_key=True)
+    account_id = Column(Integer, ForeignKey("accounts.id", ondelete="CASCADE"), primary_key=True)
+    operations = Column(Integer, nullable=False)
+    total = Column(Float, nullable=False)
+    first_timestamp = Column(DateTime, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    balance_after = Column(Float, nullable=False)
+    offset = Column(Integer, nullable=False)
+    length = Column(Integer, nullable=False)
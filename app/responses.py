@@ -0,0 +1,18 @@
+import orjson
+from fastapi.responses import Response
+
+
+def dumps(content) -> bytes:
+    # OPT_UTC_Z — время в UTC с суффиксом Z, как его пишет Pydantic.
+    return orjson.dumps(content, option=orjson.OPT_UTC_Z)
+
+
+class FastJSONResponse(Response):
+    """Ответ, сериализуемый orjson без проверки через response_model.
+
+    Готовые bytes (например, AccountSnapshot.json()) отдаются как есть. Схема
+    в response_model маршрута остаётся и по-прежнему описывает ответ в OpenAPI."""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return content if isinstance(content, bytes) else dumps(content)
@@ -1,4 +1,9 @@
-from pydantic import BaseModel, ConfigDict
+from datetime import date, datetime
+from typing import Literal
+
+from pydantic import BaseModel, ConfigDict, Field
+
+from app.config import settings
 
 class BankAccountCreate(BaseModel):
     owner: str
@@ -15,12 +20,77 @@ class BankAccountOut(BaseModel):
     
 class DepositRequest(BaseModel):
     amount: float
-    pin: str
+    pin: str | None = None
     
 class WithdrawRequest(BaseModel):
     amount: float
-    pin: str
+    pin: str | None = None
     
 class TransferRequest(BaseModel):
     amount: float
-    pin: str
\ No newline at end of file
+    pin: str | None = None
+
+
+class SessionRequest(BaseModel):
+    pin: str
+
+
+class SessionOut(BaseModel):
+    token: str
+    expires_in: int
+
+
+class BatchOperation(BaseModel):
+    type: Literal["deposit", "withdraw", "transfer"]
+    account_id: int
+    to_id: int | None = None
+    amount: float
+    pin: str | None = None
+    token: str | None = None
+
+
+class BatchRequest(BaseModel):
+    operations: list[BatchOperation] = Field(max_length=settings.batch_max_operations)
+    atomic: bool = True
+
+
+class BatchResult(BaseModel):
+    index: int
+    status: Literal["ok", "error"]
+    balance: float | None = None
+    detail: str | None = None
+
+
+class OperationOut(BaseModel):
+    id: int
+    type: str
+    amount: float
+    timestamp: datetime
+
+
+class BalanceOut(BaseModel):
+    account_id: int
+    balance: float
+    as_of: datetime | None = None
+
+
+class StatementLine(BaseModel):
+    count: int
+    amount: float
+
+
+class StatementOut(BaseModel):
+    account_id: int
+    period: str
+    date_from: date
+    date_to: date
+    opening_balance: float
+    closing_balance: float
+    total_in: float
+    total_out: float
+    operations: dict[Literal["deposit", "withdrawal", "transfer_in", "transfer_out"], StatementLine]
+
+
+class OperationPage(BaseModel):
+    items: list[OperationOut]
+    next_cursor: str | None = None
@@ -0,0 +1,329 @@
+"""Шардирование счетов по нескольким базам.
+
+Каждый шард — отдельная база со своим движком, фабрикой сессий и TransactionRunner,
+так что записи в разные шарды не ждут одну блокировку SQLite. Счёт живёт в шарде
+(id - 1) % N: ID выдаются в шарде i как i + 1, i + 1 + N, ..., а владелец направляется в
+шард по хэшу имени — поэтому уникальность owner внутри шарда означает уникальность везде.
+
+Операции над одним счётом выполняются рабочими функциями app.workers в сессии его шарда.
+Перевод между шардами — двухфазный, с записями ShardTransfer в обеих базах:
+
+1. prepare у получателя: счёт существует, запись prepared;
+2. решение у отправителя: списание и запись committed — одна транзакция;
+3. у получателя запись переводится в committed вместе с зачислением (или в aborted,
+   если списание не прошло).
+
+Упавший между шагами процесс оставляет у получателя запись prepared. ShardRouter.recover()
+(и init() при старте) завершает такие переводы по записи отправителя: есть committed —
+зачисляет, нет — сначала пишет у отправителя решение aborted. Первичный ключ записи не
+даст зафиксировать списание после этого, поэтому восстановление безопасно и рядом с
+процессом, который как раз фиксирует перевод. Тем же путём решение читается, если
+фиксация списания завершилась ошибкой: неясно, прошёл ли коммит.
+
+С BANK_SHARD_URLS приложение строит роутер в lifespan (app.main), вызывает init() и
+передаёт его в app.functions.configure_sharding: функции app.functions и HTTP-маршруты
+отправляют операции над счетами в шарды. Операции, которых у роутера нет (выписки,
+страницы и экспорт истории, пакеты, Idempotency-Key, импорт), в этом режиме отклоняются.
+
+Кэш снимков app.snapshots здесь не используется: чтения идут через ORM-объект шарда, а
+денежные операции возвращают снимки из тела ответа, как app.functions."""
+import argparse
+import json
+import uuid
+import zlib
+from datetime import datetime, UTC
+
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from app import auth, workers
+from app.config import settings
+from app.database import create_database_engine, init_schema
+from app.models import BankAccount, ShardTransfer
+from app.snapshots import AccountSnapshot
+from app.transactions import TransactionRunner
+
+PREPARED = "prepared"
+COMMITTED = "committed"
+ABORTED = "aborted"
+
+
+def _now():
+    return datetime.now(UTC).replace(tzinfo=None)
+
+
+class Shard:
+    def __init__(self, index: int, count: int, url: str):
+        self.index = index
+        self.count = count
+        self.url = url
+        self.engine = create_database_engine(url)
+        self.session_factory = sessionmaker(bind=self.engine)
+        self.runner = TransactionRunner(
+            self.session_factory, max_attempts=settings.tx_max_attempts, base_delay=settings.tx_base_delay,
+            max_delay=settings.tx_max_delay, deadline=settings.tx_deadline, lock_timeout=settings.lock_timeout
+        )
+
+    def run(self, name: str, work, after_commit=None):
+        return self.runner.run(name, work, after_commit)
+
+    def read(self, work):
+        db = self.session_factory()
+        try:
+            return work(db)
+        finally:
+            db.close()
+
+    def next_id(self):
+        # Вычисляется в том же INSERT, что и вставка: две параллельные вставки в шард
+        # не получат один ID.
+        return select(func.coalesce(func.max(BankAccount.id) + self.count, self.index + 1)).scalar_subquery()
+
+    def __repr__(self):
+        return f"Shard({self.index}, {self.url!r})"
+
+
+def _refresh(db, account):
+    db.refresh(account)
+
+
+def _create_account(db, shard: Shard, owner: str, initial_balance: float, pin_hash: str):
+    account = BankAccount(id=shard.next_id(), owner=owner, balance=initial_balance)
+    account._pin = pin_hash
+    db.add(account)
+    try:
+        db.flush()
+    except IntegrityError:
+        raise ValueError("Такой аккаунт уже существует")
+    return account
+
+
+def _get_balance(db, account_id: int, pin: str | None, token: str | None):
+    return workers.get_authorized_account(db, account_id, pin, token).balance
+
+
+def _get_snapshot(db, account_id: int, pin: str | None, token: str | None):
+    return AccountSnapshot.from_body(workers.account_body(workers.get_authorized_account(db, account_id, pin, token)))
+
+
+def _create_session(db, account_id: int, pin: str):
+    account = workers.get_account(db, account_id)
+    workers.authorize(account, pin=pin)
+    return account.issue_token(), auth.SESSION_TTL
+
+
+def _get_history(db, account_id: int, pin: str | None, token: str | None):
+    workers.get_authorized_account(db, account_id, pin, token)
+    return [
+        (row.type, row.amount, row.timestamp.strftime("%Y-%m-%d %H:%M:%S"))
+        for row in db.execute(workers.history_query(account_id))
+    ]
+
+
+def _delete_shard_account(db, account_id: int, pin: str | None, token: str | None):
+    pending = db.scalar(select(func.count()).select_from(ShardTransfer).where(
+        ShardTransfer.account_id == account_id, ShardTransfer.state == PREPARED
+    ))
+    if pending:
+        raise ValueError("По счёту есть незавершённые переводы")
+    workers.delete_account(db, account_id, pin, token)
+
+
+def _authorize_source(db, from_id: int, pin: str | None, token: str | None):
+    workers.authorize(workers.get_account(db, from_id, f"Аккаунт с ID {from_id} не найден"), pin, token)
+
+
+def _prepare_target(db, transfer_id: str, from_id: int, to_id: int, amount: float):
+    if db.get(BankAccount, to_id) is None:
+        raise ValueError(f"Аккаунт с ID {to_id} не найден")
+    now = _now()
+    db.add(ShardTransfer(
+        id=transfer_id, role="target", account_id=to_id, counterparty_id=from_id, amount=amount,
+        state=PREPARED, created_at=now, updated_at=now
+    ))
+
+
+def _commit_source(db, transfer_id: str, from_id: int, to_id: int, amount: float,
+                   pin: str | None, token: str | None):
+    account = workers.get_account(db, from_id, f"Аккаунт с ID {from_id} не найден")
+    workers.authorize(account, pin, token)
+    account.transfer_out(to_id, amount)
+    now = _now()
+    db.add(ShardTransfer(
+        id=transfer_id, role="source", account_id=from_id, counterparty_id=to_id, amount=amount,
+        state=COMMITTED, created_at=now, updated_at=now
+    ))
+    return account
+
+
+def _decide(db, transfer_id: str, from_id: int, to_id: int, amount: float):
+    """Решение по переводу в базе отправителя: committed, если списание уже
+    зафиксировано, иначе — записанное сейчас aborted, после которого списание по этому
+    переводу зафиксировать уже нельзя."""
+    now = _now()
+    db.add(ShardTransfer(
+        id=transfer_id, role="source", account_id=from_id, counterparty_id=to_id, amount=amount,
+        state=ABORTED, created_at=now, updated_at=now
+    ))
+    try:
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        return db.scalar(select(ShardTransfer.state).where(ShardTransfer.id == transfer_id))
+    return ABORTED
+
+
+def _finish_target(db, transfer_id: str, state: str):
+    """Переводит запись получателя из prepared в state; при committed — вместе с
+    зачислением. Условный UPDATE делает шаг повторяемым: второй вызов ничего не меняет."""
+    finished = db.execute(
+        update(ShardTransfer)
+        .where(ShardTransfer.id == transfer_id, ShardTransfer.role == "target", ShardTransfer.state == PREPARED)
+        .values(state=state, updated_at=_now())
+    ).rowcount
+    if not finished:
+        current = db.get(ShardTransfer, transfer_id)
+        if current is None or current.state != state:
+            raise RuntimeError(
+                f"Перевод {transfer_id}: у получателя {current.state if current else 'нет записи'}, ожидалось {state}"
+            )
+        return None
+    if state != COMMITTED:
+        return None
+    record = db.get(ShardTransfer, transfer_id)
+    account = workers.get_account(db, record.account_id)
+    account.transfer_in(record.counterparty_id, record.amount)
+    return account
+
+
+class ShardRouter:
+    """Направляет операции в шард счёта. Методы повторяют одноимённые функции app.functions."""
+
+    def __init__(self, urls: list[str]):
+        if not urls:
+            raise ValueError("Нужен хотя бы один шард")
+        self.shards = [Shard(index, len(urls), url) for index, url in enumerate(urls)]
+
+    @classmethod
+    def from_settings(cls):
+        return cls([url.strip() for url in settings.shard_urls.split(",") if url.strip()])
+
+    def shard_for(self, account_id: int):
+        return self.shards[(account_id - 1) % len(self.shards)]
+
+    def shard_for_owner(self, owner: str):
+        # crc32, а не hash(): распределение не должно зависеть от PYTHONHASHSEED.
+        return self.shards[zlib.crc32(owner.encode()) % len(self.shards)]
+
+    def init(self):
+        """Схема во всех шардах и восстановление незавершённых переводов — при старте."""
+        for shard in self.shards:
+            init_schema(shard.engine)
+        return self.recover()
+
+    def dispose(self):
+        for shard in self.shards:
+            shard.engine.dispose()
+
+    def create_account(self, owner: str, pin: str, initial_balance: float = 0.0):
+        workers.validate_new_account(owner, pin, initial_balance)
+        shard = self.shard_for_owner(owner)
+        pin_hash = auth.hash_pin(pin)
+        return shard.run(
+            "create", lambda db: _create_account(db, shard, owner, initial_balance, pin_hash), _refresh
+        )
+
+    def create_session(self, account_id: int, pin: str):
+        return self.shard_for(account_id).read(lambda db: _create_session(db, account_id, pin))
+
+    def get_account_by_id(self, account_id: int, pin: str | None = None, token: str | None = None):
+        return self.shard_for(account_id).read(lambda db: _get_snapshot(db, account_id, pin, token))
+
+    def get_account_balance(self, account_id: int, pin: str | None = None, token: str | None = None):
+        return self.shard_for(account_id).read(lambda db: _get_balance(db, account_id, pin, token))
+
+    def get_history(self, account_id: int, pin: str | None = None, token: str | None = None):
+        return self.shard_for(account_id).read(lambda db: _get_history(db, account_id, pin, token))
+
+    def deposit_to_account(self, account_id: int, amount: float, pin: str | None = None, token: str | None = None):
+        return AccountSnapshot.from_body(self.shard_for(account_id).run(
+            "deposit", lambda db: workers.account_body(workers.deposit(db, account_id, amount, pin, token))
+        ))
+
+    def withdraw_from_account(self, account_id: int, amount: float, pin: str | None = None,
+                              token: str | None = None):
+        return AccountSnapshot.from_body(self.shard_for(account_id).run(
+            "withdraw", lambda db: workers.account_body(workers.withdraw(db, account_id, amount, pin, token))
+        ))
+
+    def delete_account(self, account_id: int, pin: str | None = None, token: str | None = None):
+        self.shard_for(account_id).run("delete", lambda db: _delete_shard_account(db, account_id, pin, token))
+        auth.invalidate(account_id)
+        return f"Аккаунт {account_id} успешно удалён"
+
+    def transfer_money(self, from_id: int, to_id: int, amount: float, pin: str | None = None,
+                       token: str | None = None, transfer_id: str | None = None):
+        """Снимки (получатель, отправитель), как transfer_money; в одном шарде — обычная транзакция."""
+        source, target = self.shard_for(from_id), self.shard_for(to_id)
+        if source is target:
+            return tuple(AccountSnapshot.from_body(body) for body in source.run(
+                "transfer", lambda db: workers.pair_body(workers.transfer(db, from_id, to_id, amount, pin, token))
+            ))
+
+        if amount <= 0:
+            raise ValueError("Сумма должна быть положительной")
+        # Неверный PIN и несуществующий отправитель отсекаются до записи в чужой шард.
+        source.read(lambda db: _authorize_source(db, from_id, pin, token))
+        transfer_id = transfer_id or uuid.uuid4().hex
+
+        target.run("transfer_prepare", lambda db: _prepare_target(db, transfer_id, from_id, to_id, amount))
+        try:
+            source.run("transfer_commit", lambda db: _commit_source(db, transfer_id, from_id, to_id, amount, pin, token))
+        except Exception:
+            # Ошибка могла случиться и после коммита: решение берётся из базы отправителя.
+            decision = source.run("transfer_decide", lambda db: _decide(db, transfer_id, from_id, to_id, amount))
+            if decision != COMMITTED:
+                target.run("transfer_abort", lambda db: _finish_target(db, transfer_id, ABORTED))
+                raise
+        # Зачисление мог уже выполнить recover() — тогда _finish_target ничего не меняет.
+        target.run("transfer_apply", lambda db: _finish_target(db, transfer_id, COMMITTED))
+        return (
+            AccountSnapshot.from_body(target.read(lambda db: workers.account_body(workers.get_account(db, to_id)))),
+            AccountSnapshot.from_body(source.read(lambda db: workers.account_body(workers.get_account(db, from_id)))),
+        )
+
+    def recover(self):
+        """Завершает переводы, зависшие в prepared у получателя: решение берётся из
+        записи отправителя, а если её нет — у отправителя записывается aborted."""
+        report = {COMMITTED: 0, ABORTED: 0}
+        for shard in self.shards:
+            pending = shard.read(lambda db: db.execute(
+                select(ShardTransfer.id, ShardTransfer.counterparty_id, ShardTransfer.account_id, ShardTransfer.amount)
+                .where(ShardTransfer.role == "target", ShardTransfer.state == PREPARED)
+            ).all())
+            for transfer_id, from_id, to_id, amount in pending:
+                decision = self.shard_for(from_id).run(
+                    "transfer_decide", lambda db: _decide(db, transfer_id, from_id, to_id, amount)
+                )
+                state = COMMITTED if decision == COMMITTED else ABORTED
+                shard.run("transfer_recover", lambda db: _finish_target(db, transfer_id, state))
+                report[state] += 1
+        return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Шарды счетов: схема и восстановление переводов")
+    parser.add_argument("command", choices=["recover"])
+    parser.add_argument("--shard", action="append", help="URL шарда (по умолчанию BANK_SHARD_URLS)")
+    args = parser.parse_args(argv)
+
+    router = ShardRouter(args.shard) if args.shard else ShardRouter.from_settings()
+    try:
+        print(json.dumps(router.init(), ensure_ascii=False))
+    finally:
+        router.dispose()
+
+
+if __name__ == "__main__":
+    main()
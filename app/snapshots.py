@@ -0,0 +1,87 @@
+from threading import Lock
+
+from app import auth
+from app.responses import dumps
+from app.cache import CacheBackend, LRUCache
+from app.config import settings
+
+
+class AccountSnapshot:
+    """Неизменяемый снимок счёта для чтения: без сессии, identity map и связей."""
+    __slots__ = ("id", "owner", "balance", "pin_hash", "_json")
+
+    def __init__(self, id: int, owner: str, balance: float, pin_hash: str):
+        self.id = id
+        self.owner = owner
+        self.balance = balance
+        self.pin_hash = pin_hash
+        self._json = None
+
+    @classmethod
+    def from_body(cls, body: dict):
+        """Снимок-результат денежной операции из тела ответа. Хеша PIN в теле нет,
+        поэтому такой снимок не годится для проверки PIN и не кладётся в кэш."""
+        return cls(body["id"], body["owner"], body["balance"], None)
+
+    def json(self):
+        """Тело ответа GET /accounts/{id} (BankAccountOut). Снимок неизменяем, поэтому
+        тело собирается один раз и отдаётся из кэша без повторной сериализации."""
+        if self._json is None:
+            self._json = dumps({"id": self.id, "owner": self.owner, "balance": float(self.balance)})
+        return self._json
+
+    def check_pin(self, pin: str):
+        return auth.verify_pin(self.id, self.pin_hash, pin)
+
+    def check_token(self, token: str):
+        return auth.verify_token(self.id, self.pin_hash, token)
+
+    def __repr__(self):
+        return f"AccountSnapshot(id={self.id}, owner={self.owner!r}, balance={self.balance})"
+
+
+class AccountCache:
+    """Read-through кэш снимков счетов поверх любого CacheBackend.
+
+    Каждая запись в счёт после коммита вызывает invalidate. Чтобы чтение, начатое
+    до такого коммита, не вернуло в кэш старый баланс, put принимает поколение,
+    полученное до запроса к БД, и ничего не сохраняет, если с тех пор была инвалидация."""
+
+    def __init__(self, backend: CacheBackend | None = None):
+        self.backend = backend
+        self._generation = 0
+        self._lock = Lock()
+
+    def configure(self, backend: CacheBackend | None):
+        self.backend = backend
+        self.invalidate()
+
+    def generation(self):
+        return self._generation
+
+    def get(self, account_id: int):
+        return self.backend.get(account_id) if self.backend is not None else None
+
+    def put(self, snapshot: AccountSnapshot, generation: int):
+        with self._lock:
+            if self.backend is not None and generation == self._generation:
+                self.backend.set(snapshot.id, snapshot)
+
+    def invalidate(self, *account_ids: int):
+        with self._lock:
+            self._generation += 1
+            if self.backend is None:
+                return
+            if not account_ids:
+                self.backend.clear()
+            for account_id in account_ids:
+                self.backend.pop(account_id)
+
+    def stats(self):
+        return self.backend.stats() if self.backend is not None else {}
+
+
+account_cache = AccountCache(
+    LRUCache(maxsize=settings.resolved_account_cache_size, ttl=settings.account_cache_ttl)
+    if settings.resolved_account_cache_size > 0 else None
+)
@@ -0,0 +1,148 @@
+import asyncio
+import random
+import time
+from threading import Lock
+
+from sqlalchemy.exc import OperationalError
+
+# Сообщения драйверов о временных конфликтах: SQLite (занятая база, BUSY_SNAPSHOT
+# в режиме WAL) и ошибки сериализации/взаимоблокировки серверных СУБД.
+RETRYABLE_MESSAGES = (
+    "database is locked",
+    "database table is locked",
+    "could not serialize access",
+    "deadlock detected",
+)
+
+
+class TransactionConflict(Exception):
+    """Транзакцию не удалось зафиксировать за отведённое число попыток или время."""
+
+    def __init__(self, name: str, attempts: int, waited: float):
+        super().__init__(f"{name}: база данных занята ({attempts} попыток, {waited:.3f} с)")
+        self.name = name
+        self.attempts = attempts
+        self.waited = waited
+
+
+def is_retryable(error: BaseException):
+    return isinstance(error, OperationalError) and any(
+        message in str(error.orig).lower() for message in RETRYABLE_MESSAGES
+    )
+
+
+class TransactionStats:
+    """Счётчики по имени операции: вызовы, повторы, отказы и время, потерянное на
+    блокировках (неудачные попытки + паузы между ними)."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._stats = {}
+
+    def record(self, name: str, retries: int, lock_wait: float, failed: bool = False):
+        with self._lock:
+            entry = self._stats.setdefault(
+                name, {"calls": 0, "retries": 0, "max_retries": 0, "failures": 0, "lock_wait": 0.0}
+            )
+            entry["calls"] += 1
+            entry["retries"] += retries
+            entry["max_retries"] = max(entry["max_retries"], retries)
+            entry["failures"] += failed
+            entry["lock_wait"] += lock_wait
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(entry) for name, entry in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+class TransactionRunner:
+    """Выполняет единицу работы в новой сессии и фиксирует её; при временном конфликте
+    откатывает и повторяет с экспоненциальной паузой со случайным разбросом, пока не
+    кончатся попытки или время.
+
+    Повторяется только то, что не было зафиксировано: ошибка в work или в commit
+    оставляет базу без изменений, а after_commit (обычно refresh) выполняется уже вне
+    цикла повторов. Поэтому повтор не может применить операцию дважды.
+
+    lock_timeout — сколько попытка может ждать блокировку в самом драйвере (busy_timeout
+    SQLite): новая попытка начинается, только если и с таким ожиданием укладывается в deadline."""
+
+    def __init__(self, session_factory, async_session_factory=None, max_attempts: int = 10,
+                 base_delay: float = 0.005, max_delay: float = 0.25, deadline: float = 5.0,
+                 lock_timeout: float = 0.0, stats=None):
+        self.session_factory = session_factory
+        self.async_session_factory = async_session_factory
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.lock_timeout = lock_timeout
+        self.stats = stats or TransactionStats()
+
+    def _backoff(self, attempt: int):
+        # «Full jitter»: случайная пауза до текущего потолка разводит конкурирующих писателей.
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _retry_delay(self, name, error, attempt, started):
+        """Пауза перед следующей попыткой или None, если ошибка не временная. Время
+        считается от начала первой попытки: неудачные попытки вместе с ожиданием
+        блокировки в драйвере и паузы между ними — это lock_wait."""
+        if not is_retryable(error):
+            return None
+        elapsed = time.monotonic() - started
+        delay = self._backoff(attempt)
+        if attempt + 1 >= self.max_attempts or elapsed + delay + self.lock_timeout > self.deadline:
+            self.stats.record(name, attempt, elapsed, failed=True)
+            raise TransactionConflict(name, attempt + 1, elapsed) from error
+        return delay
+
+    def run(self, name: str, work, after_commit=None):
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt_started = time.monotonic()
+            db = self.session_factory()
+            try:
+                try:
+                    result = work(db)
+                    db.commit()
+                except OperationalError as e:
+                    db.rollback()
+                    delay = self._retry_delay(name, e, attempt, started)
+                    if delay is None:
+                        raise
+                else:
+                    self.stats.record(name, attempt, attempt_started - started)
+                    if after_commit:
+                        after_commit(db, result)
+                    return result
+            finally:
+                db.close()
+            time.sleep(delay)
+            attempt += 1
+
+    async def run_async(self, name: str, work, after_commit=None):
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt_started = time.monotonic()
+            async with self.async_session_factory() as db:
+                try:
+                    result = await work(db)
+                    await db.commit()
+                except OperationalError as e:
+                    await db.rollback()
+                    delay = self._retry_delay(name, e, attempt, started)
+                    if delay is None:
+                        raise
+                else:
+                    self.stats.record(name, attempt, attempt_started - started)
+                    if after_commit:
+                        await after_commit(db, result)
+                    return result
+            await asyncio.sleep(delay)
+            attempt += 1
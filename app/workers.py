@@ -0,0 +1,133 @@
+"""Рабочие функции операций над счетами.
+
+Каждая выполняет одну операцию в переданной сессии и не коммитит: транзакцией
+управляет вызывающий — runner в app.functions, шард в app.sharding, пакет команд
+old_main. Здесь же общие для них тела ответов, запрос истории и приведение времени."""
+from datetime import datetime, UTC
+
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+
+from app.models import ArchivedAccount, BalanceCheckpoint, BankAccount, DailyAggregate, IdempotencyKey, Operation
+
+
+def validate_new_account(owner: str, pin: str, initial_balance: float = 0.0):
+    if not owner.strip():
+        raise ValueError("Имя владельца не может быть пустым")
+
+    if len(pin) < 4:
+        raise ValueError("PIN должен быть 4 или более символов")
+
+    if initial_balance < 0:
+        raise ValueError("Начальный баланс не может быть отрицательным")
+
+
+def authorize(account: BankAccount, pin: str | None = None, token: str | None = None):
+    if token is not None:
+        if not account.check_token(token):
+            raise ValueError("Недействительный или просроченный токен сессии")
+    elif pin is None or not account.check_pin(pin):
+        raise ValueError("Неверный PIN-код")
+
+
+def get_account(db, account_id: int, message: str = "Аккаунт с таким ID не найден"):
+    account = db.get(BankAccount, account_id)
+    if not account:
+        raise ValueError(message)
+    return account
+
+
+def get_authorized_account(db, account_id: int, pin: str | None, token: str | None):
+    account = get_account(db, account_id)
+    authorize(account, pin, token)
+    return account
+
+
+def load_accounts(db, account_ids):
+    """{ID: аккаунт} для найденных ID. Аккаунтов, которых нет в identity map, —
+    одним запросом IN. identity map хранит объекты по слабым ссылкам, поэтому
+    вызывающий держит словарь, пока работает с ними: тогда и db.get обходится без SQL."""
+    accounts, missing = {}, set()
+    for account_id in account_ids:
+        account = db.identity_map.get(db.identity_key(BankAccount, account_id))
+        if account is None:
+            missing.add(account_id)
+        else:
+            accounts[account_id] = account
+    if missing:
+        accounts.update((account.id, account) for account in db.scalars(
+            select(BankAccount).where(BankAccount.id.in_(missing))
+        ))
+    return accounts
+
+
+def create_account(db, owner: str, pin: str, initial_balance: float, pin_hash: str | None):
+    account = BankAccount(owner=owner, balance=initial_balance)
+    if pin_hash is not None:
+        account._pin = pin_hash
+    else:
+        account.set_pin(pin)
+    db.add(account)
+    try:
+        db.flush()
+    except IntegrityError:
+        # Уникальный индекс по owner: проверка и вставка — одна операция без гонки.
+        raise ValueError("Такой аккаунт уже существует")
+    return account
+
+
+def deposit(db, account_id: int, amount: float, pin: str | None, token: str | None):
+    account = get_account(db, account_id)
+    authorize(account, pin, token)
+    account.deposit(amount=amount)
+    return account
+
+
+def withdraw(db, account_id: int, amount: float, pin: str | None, token: str | None):
+    account = get_account(db, account_id)
+    authorize(account, pin, token)
+    account.withdraw(amount=amount)
+    return account
+
+
+def transfer(db, from_id: int, to_id: int, amount: float, pin: str | None, token: str | None):
+    accounts = load_accounts(db, (from_id, to_id))
+    from_account = accounts.get(from_id)
+    to_account = accounts.get(to_id)
+    if not from_account:
+        raise ValueError(f"Аккаунт с ID {from_id} не найден")
+    if not to_account:
+        raise ValueError(f"Аккаунт с ID {to_id} не найден")
+    authorize(from_account, pin, token)
+    from_account.transfer(to_account=to_account, amount=amount)
+    return to_account, from_account
+
+
+def delete_account(db, account_id: int, pin: str | None, token: str | None):
+    account = get_authorized_account(db, account_id, pin, token)
+    # Дочерние строки удаляются запросом на таблицу, а не загрузкой каждой в сессию
+    # (у связей passive_deletes): время не растёт с длиной истории.
+    for model in (DailyAggregate, BalanceCheckpoint, Operation, IdempotencyKey, ArchivedAccount):
+        db.execute(delete(model).where(model.account_id == account_id))
+    db.delete(account)
+
+
+def history_query(account_id: int):
+    return select(Operation.id, Operation.type, Operation.amount, Operation.timestamp).where(
+        Operation.account_id == account_id
+    ).order_by(Operation.timestamp, Operation.id)
+
+
+def account_body(account):
+    return {"id": account.id, "owner": account.owner, "balance": float(account.balance)}
+
+
+def pair_body(accounts):
+    return [account_body(account) for account in accounts]
+
+
+def to_utc_naive(value: datetime | None):
+    # В SQLite время операций хранится без зоны, в UTC.
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(UTC).replace(tzinfo=None)
+    return value
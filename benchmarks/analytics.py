@@ -0,0 +1,127 @@
+"""Отчёты app.analytics против наивного цикла по ORM-объектам Operation на
+синтетической базе (по умолчанию 10 млн операций, 100 тыс. счетов).
+
+    python -m benchmarks.analytics --rows 10000000 --dir /var/tmp
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, UTC
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app import analytics
+from app.database import Base
+from app.models import BankAccount, Operation, OPERATION_KINDS, DEPOSIT, WITHDRAWAL, TRANSFER_IN, TRANSFER_OUT, operation_kind
+
+TYPE_NAMES = {"deposit": DEPOSIT, "withdrawal": WITHDRAWAL, "transfer_in": TRANSFER_IN, "transfer_out": TRANSFER_OUT}
+INSERT_BATCH = 100_000
+
+
+def generate(path, rows, accounts, days, seed=0):
+    rng = np.random.default_rng(seed)
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    engine.dispose()
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.executemany(
+        "INSERT INTO accounts (id, owner, balance, pin, operation_count) VALUES (?, ?, ?, 'x', 0)",
+        ((i, f"owner_{i}", float(b)) for i, b in zip(range(1, accounts + 1), rng.uniform(0, 10_000, accounts).round(2)))
+    )
+    # Последние 5% счетов без операций — их должен найти отчёт о неактивных.
+    active = int(accounts * 0.95)
+    start = datetime(2026, 10, 18) - timedelta(days=days)
+    for offset in range(0, rows, INSERT_BATCH):
+        n = min(INSERT_BATCH, rows - offset)
+        account_ids = rng.integers(1, active + 1, n)
+        kinds = rng.integers(0, len(OPERATION_KINDS), n)
+        amounts = rng.lognormal(4, 1, n).round(2)
+        seconds = rng.integers(0, days * 86_400, n)
+        batch = []
+        for account_id, kind, amount, second in zip(account_ids.tolist(), kinds.tolist(), amounts.tolist(), seconds.tolist()):
+            kind = OPERATION_KINDS[kind]
+            type_ = TYPE_NAMES[kind]
+            if kind.startswith("transfer"):
+                type_ = f"{type_} {account_id % accounts + 1}"
+            if kind == "transfer_out":
+                amount = -amount
+            batch.append((type_, amount, str(start + timedelta(seconds=second)), account_id))
+        conn.executemany("INSERT INTO operations (type, amount, timestamp, account_id) VALUES (?, ?, ?, ?)", batch)
+    conn.commit()
+    conn.close()
+
+
+def orm_report(engine, top, since):
+    flow = defaultdict(lambda: [0.0, 0.0, 0])
+    amounts = {"deposit": [], "withdrawal": []}
+    volume = defaultdict(float)
+    last_seen = {}
+    with Session(engine) as db:
+        for op in db.query(Operation).yield_per(10_000):
+            kind = operation_kind(op.type)
+            amount = abs(op.amount)
+            day = flow[op.timestamp.date()]
+            day[0 if kind in ("deposit", "transfer_in") else 1] += amount
+            day[2] += 1
+            if kind in amounts:
+                amounts[kind].append(amount)
+            volume[op.account_id] += amount
+            if op.timestamp > last_seen.get(op.account_id, datetime.min):
+                last_seen[op.account_id] = op.timestamp
+        dormant = [a.id for a in db.query(BankAccount).yield_per(10_000) if last_seen.get(a.id, datetime.min) < since]
+    percentiles = {kind: np.percentile(values, analytics.PERCENTILES).tolist() for kind, values in amounts.items()}
+    return {
+        "days": len(flow),
+        "percentiles": percentiles,
+        "top": [account_id for account_id, _ in sorted(volume.items(), key=lambda item: -item[1])[:top]],
+        "dormant": len(dormant),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--accounts", type=int, default=100_000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--dir", default=None, help="каталог для временной базы")
+    parser.add_argument("--skip-orm", action="store_true", help="не запускать медленный ORM-цикл")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        path = os.path.join(tmp, "analytics.db")
+        started = time.perf_counter()
+        generate(path, args.rows, args.accounts, args.days)
+        print(f"dataset: {args.rows} operations, {args.accounts} accounts in {time.perf_counter() - started:.1f} s")
+
+        engine = create_engine(f"sqlite:///{path}")
+        now = datetime(2026, 10, 18, tzinfo=UTC)
+        since = (now - timedelta(days=90)).replace(tzinfo=None)
+
+        started = time.perf_counter()
+        with engine.connect() as conn:
+            report = analytics.build_report(conn, top=args.top, now=now)
+        numpy_seconds = time.perf_counter() - started
+        print(f"numpy: {numpy_seconds:.1f} s")
+
+        if not args.skip_orm:
+            started = time.perf_counter()
+            naive = orm_report(engine, args.top, since)
+            orm_seconds = time.perf_counter() - started
+            print(f"orm:   {orm_seconds:.1f} s  ({orm_seconds / numpy_seconds:.1f}x slower)")
+            assert naive["days"] == len(report["cash_flow"])
+            assert naive["top"] == [row["account_id"] for row in report["top_accounts"]]
+            assert naive["dormant"] == report["dormant"]["count"]
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Общее для бенчмарков: перцентили, окружение замера и сохранение результатов в JSON."""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, UTC
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def latency_summary(latencies, seconds: float):
+    """Сводка по задержкам (в секундах) за замер длиной seconds: пропускная способность и перцентили в мс."""
+    return {
+        "requests": len(latencies),
+        "per_s": len(latencies) / seconds if seconds else 0.0,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def _git(*args):
+    try:
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {
+        "commit": _git("rev-parse", "--short", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "started_at": datetime.now(UTC).isoformat(timespec="seconds"),
+    }
+
+
+def save_results(path: str | None, benchmark: str, params: dict, results: dict):
+    """Пишет результаты вместе с коммитом и окружением; python -m benchmarks.compare сравнивает два файла."""
+    report = {"benchmark": benchmark, "environment": environment(), "params": params, "results": results}
+    if path:
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        print(f"результаты: {path}", file=sys.stderr)
+    return report
+
+
+@contextmanager
+def temporary_database(directory: str | None = None, name: str = "bench.db"):
+    """Временная база для замера. Движки создаются при импорте app.database,
+    поэтому модули app импортируются только внутри этого блока."""
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        url = f"sqlite:///{os.path.join(tmp, name)}"
+        previous = os.environ.get("BANK_DATABASE_URL")
+        os.environ["BANK_DATABASE_URL"] = url
+        try:
+            yield url
+        finally:
+            if previous is None:
+                os.environ.pop("BANK_DATABASE_URL", None)
+            else:
+                os.environ["BANK_DATABASE_URL"] = previous
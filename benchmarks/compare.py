@@ -0,0 +1,59 @@
+"""Сравнение двух файлов результатов (--output у benchmarks.micro и benchmarks.load),
+например с двух коммитов. Код выхода 1, если хоть одна метрика ухудшилась больше порога.
+
+    python -m benchmarks.compare before.json after.json --threshold 10
+"""
+import argparse
+import json
+import sys
+
+# Направление по суффиксу: задержки и время — чем меньше, тем лучше, пропускная способность — наоборот.
+LOWER_IS_BETTER = ("_ms", "_us")
+HIGHER_IS_BETTER = ("per_s",)
+
+
+def flatten(results, prefix=""):
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from flatten(value, f"{name} / ")
+        elif isinstance(value, (int, float)) and name.endswith(LOWER_IS_BETTER + HIGHER_IS_BETTER):
+            yield name, float(value)
+
+
+def compare(before: dict, after: dict, threshold: float):
+    """Строки (метрика, было, стало, изменение в %, ухудшение больше порога) по общим метрикам."""
+    old = dict(flatten(before["results"]))
+    rows = []
+    for name, new_value in flatten(after["results"]):
+        if name not in old or not old[name]:
+            continue
+        change = (new_value - old[name]) / old[name] * 100
+        worse = change if name.endswith(LOWER_IS_BETTER) else -change
+        rows.append((name, old[name], new_value, change, worse > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=10.0, help="допустимое ухудшение, %%")
+    args = parser.parse_args()
+
+    with open(args.before, encoding="utf-8") as file:
+        before = json.load(file)
+    with open(args.after, encoding="utf-8") as file:
+        after = json.load(file)
+    if before["benchmark"] != after["benchmark"]:
+        parser.error(f"разные бенчмарки: {before['benchmark']} и {after['benchmark']}")
+
+    print(f"{before['environment']['commit']} -> {after['environment']['commit']}")
+    rows = compare(before, after, args.threshold)
+    for name, old, new, change, regression in rows:
+        print(f"{'!' if regression else ' '} {name:<60} {old:>12.1f} {new:>12.1f} {change:>+8.1f}%")
+    sys.exit(1 if any(row[-1] for row in rows) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Пропускная способность записи: коммит на каждую операцию против группового коммита.
+
+Конкурентные клиенты пополняют и снимают деньги через асинхронные функции app.functions
+на временной базе; PIN проверен заранее, так что замеряется запись, а не bcrypt.
+С --synchronous FULL каждый коммит делает fsync — так видно, во что упирается запись на диске.
+
+    python -m benchmarks.group_commit --clients 64 --seconds 5
+    python -m benchmarks.group_commit --synchronous FULL --window-ms 1 2 5 --output group.json
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+import uuid
+
+from benchmarks.common import latency_summary, save_results, temporary_database
+
+
+async def client(functions, accounts, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        account_id = random.choice(accounts)
+        call = functions.deposit_to_account_async if random.random() < 0.7 else functions.withdraw_from_account_async
+        started = time.perf_counter()
+        try:
+            await call(account_id, 1.0, pin="1234")
+        except ValueError:
+            errors.append(account_id)
+        latencies.append(time.perf_counter() - started)
+
+
+async def measure(functions, accounts, clients, seconds):
+    latencies, errors = [], []
+    started = time.perf_counter()
+    deadline = started + seconds
+    await asyncio.gather(*(client(functions, accounts, deadline, latencies, errors) for _ in range(clients)))
+    summary = latency_summary(latencies, time.perf_counter() - started)
+    summary["errors"] = len(errors)
+    return summary
+
+
+async def run(functions, accounts, args):
+    # Все варианты — в одном цикле событий: пул асинхронного движка привязан к циклу.
+    variants = [("commit per operation", None)] + [(f"group, window {w:g} ms", w) for w in args.window_ms]
+    results = {}
+    for label, window_ms in variants:
+        functions.configure_group_commit(window_ms is not None, args.max_batch, window_ms or 0.0)
+        results[label] = await measure(functions, accounts, args.clients, args.seconds)
+    functions.configure_group_commit(False)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--accounts", type=int, default=100)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--window-ms", type=float, nargs="+", default=[2.0])
+    parser.add_argument("--synchronous", default=None, help="PRAGMA synchronous на время замера (NORMAL, FULL)")
+    parser.add_argument("--output", default=None, help="записать результаты в JSON")
+    args = parser.parse_args()
+
+    if args.synchronous:
+        os.environ["BANK_SQLITE_SYNCHRONOUS"] = args.synchronous
+    with temporary_database():
+        from app import functions
+        from app.database import init_db
+
+        init_db()
+        accounts = [
+            functions.create_account(f"bench_{uuid.uuid4().hex[:12]}", "1234", 1_000_000.0).id
+            for _ in range(args.accounts)
+        ]
+        for account_id in accounts:
+            functions.get_account_balance(account_id, pin="1234")
+
+        results = asyncio.run(run(functions, accounts, args))
+
+    print(f"{'variant':<24}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for label, result in results.items():
+        print(f"{label:<24}{result['per_s']:>10.0f}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}")
+    save_results(args.output, "group_commit", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""Нагрузочный замер: uvicorn на временной базе с синтетическими счетами и историей,
+N параллельных клиентов со смесью чтений и записей. Для каждого маршрута —
+пропускная способность, p50/p95/p99 и число ошибок.
+
+    python -m benchmarks.load --concurrency 32 --duration 30 --read-ratio 0.8 --output load.json
+
+Клиенты по умолчанию авторизуются токеном сессии (HMAC): иначе первое обращение
+к каждому счёту стоит вызова bcrypt и замер меряет его. Генератор нагрузки
+работает в одном процессе; при нескольких воркерах uvicorn он может упереться
+в собственный CPU раньше сервера — это видно по загрузке процесса.
+"""
+import argparse
+import asyncio
+import os
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, UTC
+
+import httpx
+
+from benchmarks.common import ROOT, latency_summary, save_results, temporary_database
+
+READS = {
+    "GET /accounts/{id}": 4,
+    "GET /accounts/{id}/balance": 3,
+    "GET /accounts/{id}/operations": 2,
+    "GET /accounts/{id}/statement": 1,
+}
+WRITES = {
+    "POST /accounts/{id}/deposit": 4,
+    "POST /accounts/{id}/withdraw": 3,
+    "POST /accounts/{from}/{to}/transfer": 3,
+}
+
+
+def seed(accounts: int, operations: int, days: int, rng: random.Random):
+    """Счета и история операций прямой вставкой; контрольные точки и дневные
+    обороты пересчитываются так же, как после импорта старой базы."""
+    from sqlalchemy import insert
+
+    from app import auth
+    from app.database import SessionLocal, engine, init_db
+    from app.ledger import rebuild_checkpoints, rebuild_daily_aggregates
+    from app.models import BankAccount, Operation, DEPOSIT, WITHDRAWAL
+
+    init_db()
+    pin_hash = auth.hash_pin("1234")
+    start = datetime.now(UTC).replace(tzinfo=None) - timedelta(days=days)
+    with engine.begin() as conn:
+        conn.execute(insert(BankAccount), [
+            {"id": i, "owner": f"load_{i}", "balance": 1_000_000.0, "pin": pin_hash, "operation_count": 0}
+            for i in range(1, accounts + 1)
+        ])
+        conn.execute(insert(Operation), [
+            {"account_id": rng.randint(1, accounts), "type": rng.choice((DEPOSIT, WITHDRAWAL)),
+             "amount": round(rng.uniform(1, 500), 2), "timestamp": start + timedelta(seconds=rng.uniform(0, days * 86_400))}
+            for _ in range(operations)
+        ])
+    rebuild_checkpoints()
+    db = SessionLocal()
+    try:
+        rebuild_daily_aggregates(db)
+        db.commit()
+    finally:
+        db.close()
+    engine.dispose()
+    return {i: auth.issue_token(i, pin_hash) for i in range(1, accounts + 1)}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, workers: int, env: dict):
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+        cwd=ROOT, env={**env, "BANK_WORKERS": str(workers)}
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"uvicorn завершился с кодом {server.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/").status_code == 200:
+                return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("uvicorn не ответил за 30 с")
+
+
+def request(client, route: str, account_id: int, other_id: int, credentials: dict, period: str):
+    headers = credentials.get("headers")
+    params = credentials.get("params")
+    body = {"amount": 1.0, **credentials.get("body", {})}
+    match route:
+        case "GET /accounts/{id}":
+            return client.get(f"/accounts/{account_id}", params=params, headers=headers)
+        case "GET /accounts/{id}/balance":
+            return client.get(f"/accounts/{account_id}/balance", params=params, headers=headers)
+        case "GET /accounts/{id}/operations":
+            return client.get(f"/accounts/{account_id}/operations", params=params, headers=headers)
+        case "GET /accounts/{id}/statement":
+            return client.get(f"/accounts/{account_id}/statement", params={**(params or {}), "period": period},
+                              headers=headers)
+        case "POST /accounts/{id}/deposit":
+            return client.post(f"/accounts/{account_id}/deposit", json=body, headers=headers)
+        case "POST /accounts/{id}/withdraw":
+            return client.post(f"/accounts/{account_id}/withdraw", json=body, headers=headers)
+        case "POST /accounts/{from}/{to}/transfer":
+            return client.post(f"/accounts/{account_id}/{other_id}/transfer", json=body, headers=headers)
+
+
+async def client_loop(client, args, tokens, rng, warmup_until, deadline, samples, errors):
+    reads, read_weights = list(READS), list(READS.values())
+    writes, write_weights = list(WRITES), list(WRITES.values())
+    period = str(datetime.now(UTC).year)
+    while (now := time.perf_counter()) < deadline:
+        if rng.random() < args.read_ratio:
+            route = rng.choices(reads, read_weights)[0]
+        else:
+            route = rng.choices(writes, write_weights)[0]
+        account_id, other_id = rng.sample(range(1, args.accounts + 1), 2)
+        if args.auth == "token":
+            credentials = {"headers": {"X-Session-Token": tokens[account_id]}}
+        else:
+            credentials = {"params": {"pin": "1234"}, "body": {"pin": "1234"}}
+
+        started = time.perf_counter()
+        try:
+            response = await request(client, route, account_id, other_id, credentials, period)
+            status = response.status_code
+        except httpx.HTTPError:
+            status = None
+        elapsed = time.perf_counter() - started
+        if now < warmup_until:
+            continue
+        samples.setdefault(route, []).append(elapsed)
+        if status is None or status >= 400:
+            errors[route] = errors.get(route, 0) + 1
+
+
+async def run_load(base_url: str, args, tokens):
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    samples, errors = {}, {}
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+        warmup_until = time.perf_counter() + args.warmup
+        deadline = warmup_until + args.duration
+        await asyncio.gather(*(
+            client_loop(client, args, tokens, random.Random(rng.random()), warmup_until, deadline, samples, errors)
+            for _ in range(args.concurrency)
+        ))
+
+    routes = {
+        route: {**latency_summary(latencies, args.duration), "errors": errors.get(route, 0)}
+        for route, latencies in sorted(samples.items())
+    }
+    everything = [latency for latencies in samples.values() for latency in latencies]
+    return {"total": {**latency_summary(everything, args.duration), "errors": sum(errors.values())}, "routes": routes}
+
+
+def print_report(results):
+    print(f"{'route':<38} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for route, row in [*results["routes"].items(), ("total", results["total"])]:
+        print(f"{route:<38} {row['per_s']:>8.1f} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} "
+              f"{row['p99_ms']:>8.1f} {row['errors']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--operations", type=int, default=100_000, help="операций в истории при засеве")
+    parser.add_argument("--days", type=int, default=365, help="за сколько дней распределена история")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20.0, help="секунд замера")
+    parser.add_argument("--warmup", type=float, default=2.0, help="секунд прогрева, не входят в результат")
+    parser.add_argument("--read-ratio", type=float, default=0.8, help="доля чтений в смеси")
+    parser.add_argument("--auth", choices=("token", "pin"), default="token")
+    parser.add_argument("--workers", type=int, default=1, help="воркеров uvicorn")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", default=None, help="каталог для временной базы")
+    parser.add_argument("--output", default=None, help="файл для результатов в JSON")
+    args = parser.parse_args()
+    if args.accounts < 2:
+        parser.error("нужно хотя бы два счёта")
+
+    secret = secrets.token_hex(32)
+    os.environ["BANK_SECRET_KEY"] = secret
+    with temporary_database(args.dir, "load.db") as url:
+        started = time.perf_counter()
+        tokens = seed(args.accounts, args.operations, args.days, random.Random(args.seed))
+        print(f"seed: {args.accounts} accounts, {args.operations} operations in {time.perf_counter() - started:.1f} s",
+              file=sys.stderr)
+
+        port = free_port()
+        server = start_server(port, args.workers, {**os.environ, "BANK_DATABASE_URL": url, "BANK_SECRET_KEY": secret})
+        try:
+            results = asyncio.run(run_load(f"http://127.0.0.1:{port}", args, tokens))
+        finally:
+            server.terminate()
+            server.wait()
+    print_report(results)
+    save_results(args.output, "load", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
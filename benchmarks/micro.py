@@ -0,0 +1,143 @@
+"""Микробенчмарки: PIN (bcrypt и кэш проверок), каждая функция app.functions
+на временной базе и сериализация ответов (Pydantic против orjson).
+
+    python -m benchmarks.micro --output micro.json
+    python -m benchmarks.micro --filter "get_|Pydantic"
+"""
+import argparse
+import itertools
+import re
+import statistics
+import time
+import uuid
+from datetime import datetime, UTC
+
+from benchmarks.common import save_results, temporary_database
+
+HISTORY_SIZE = 500
+
+
+def timed(call, min_time: float, repeat: int):
+    # Число вызовов в серии подбирается так, чтобы серия шла не меньше min_time / repeat:
+    # bcrypt хватает одного вызова, чтению из кэша — десятков тысяч.
+    target = min_time / repeat
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            call()
+        elapsed = time.perf_counter() - started
+        if elapsed >= target:
+            break
+        number = max(number * 2, int(number * target / max(elapsed, 1e-9) * 1.1))
+    samples = [elapsed / number]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            call()
+        samples.append((time.perf_counter() - started) / number)
+    return {
+        "calls": number * repeat,
+        "best_us": min(samples) * 1e6,
+        "median_us": statistics.median(samples) * 1e6,
+    }
+
+
+def build_cases():
+    from app import auth, functions
+    from app.database import init_db
+    from app.models import BankAccount
+    from app.responses import dumps
+    from app.schemas.account import BankAccountOut, OperationPage, StatementOut
+    from app.snapshots import AccountSnapshot, account_cache
+
+    init_db()
+    suffix = uuid.uuid4().hex[:8]
+    names = (f"bench_{suffix}_{i}" for i in itertools.count())
+    pin_hash = auth.hash_pin("1234")
+    account = functions.create_account(next(names), "1234", 1_000_000_000.0, pin_hash=pin_hash)
+    other = functions.create_account(next(names), "1234", 1_000_000_000.0, pin_hash=pin_hash)
+    token, _ = functions.create_session(account.id, "1234")
+    functions.apply_batch([
+        {"type": "deposit", "account_id": account.id, "amount": 1.0, "token": token} for _ in range(HISTORY_SIZE)
+    ])
+    now = datetime.now(UTC)
+    page = functions.get_operations_page(account.id, token=token)
+    statement = functions.get_statement(account.id, str(now.year), token=token)
+
+    # Несохранённый объект: check_pin/set_pin без обращений к БД.
+    model = BankAccount(id=-1, owner="bench", balance=0.0)
+    model.set_pin("1234")
+    model_token = model.issue_token()
+
+    def cold_check_pin():
+        auth.invalidate(-1)
+        model.check_pin("1234")
+
+    def balance_without_cache():
+        account_cache.invalidate(account.id)
+        functions.get_account_balance(account.id, token=token)
+
+    def create_and_delete():
+        created = functions.create_account(next(names), "1234", 0.0, pin_hash=pin_hash)
+        functions.delete_account(created.id, token=created.issue_token())
+
+    def export():
+        for _ in functions.export_history(account.id, token=token):
+            pass
+
+    return {
+        "BankAccount.set_pin": lambda: model.set_pin("1234"),
+        "BankAccount.check_pin (bcrypt)": cold_check_pin,
+        "BankAccount.check_pin (cached)": lambda: model.check_pin("1234"),
+        "BankAccount.check_token": lambda: model.check_token(model_token),
+        "create_account": lambda: functions.create_account(next(names), "1234", 0.0, pin_hash=pin_hash),
+        "create_session": lambda: functions.create_session(account.id, "1234"),
+        "create_account + delete_account": create_and_delete,
+        "deposit_to_account": lambda: functions.deposit_to_account(account.id, 1.0, token=token),
+        "withdraw_from_account": lambda: functions.withdraw_from_account(account.id, 1.0, token=token),
+        "transfer_money": lambda: functions.transfer_money(account.id, other.id, 1.0, token=token),
+        "apply_batch (10 operations)": lambda: functions.apply_batch([
+            {"type": "deposit", "account_id": account.id, "amount": 1.0, "token": token} for _ in range(10)
+        ]),
+        "get_account_balance": lambda: functions.get_account_balance(account.id, token=token),
+        "get_account_balance (no cache)": balance_without_cache,
+        "get_account_by_id": lambda: functions.get_account_by_id(account.id, token=token),
+        f"get_history ({HISTORY_SIZE}+ operations)": lambda: functions.get_history(account.id, token=token),
+        "get_operations_page (50)": lambda: functions.get_operations_page(account.id, token=token),
+        "get_balance_as_of": lambda: functions.get_balance_as_of(account.id, now, token=token),
+        "get_statement (year)": lambda: functions.get_statement(account.id, str(now.year), token=token),
+        "export_history": export,
+        "BankAccountOut (Pydantic)": lambda: BankAccountOut.model_validate(account).model_dump_json(),
+        "BankAccountOut (snapshot.json)": lambda: AccountSnapshot(account.id, account.owner, account.balance, pin_hash).json(),
+        "OperationPage (Pydantic)": lambda: OperationPage.model_validate(page).model_dump_json(),
+        "OperationPage (orjson)": lambda: dumps(page),
+        "StatementOut (Pydantic)": lambda: StatementOut.model_validate(statement).model_dump_json(),
+        "StatementOut (orjson)": lambda: dumps(statement),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filter", default=None, help="регулярное выражение по имени замера")
+    parser.add_argument("--min-time", type=float, default=0.5, help="секунд на замер")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--dir", default=None, help="каталог для временной базы")
+    parser.add_argument("--output", default=None, help="файл для результатов в JSON")
+    args = parser.parse_args()
+
+    with temporary_database(args.dir):
+        cases = build_cases()
+        results = {}
+        print(f"{'case':<34} {'calls':>8} {'best µs':>11} {'median µs':>11}")
+        for name, call in cases.items():
+            if args.filter and not re.search(args.filter, name):
+                continue
+            results[name] = timed(call, args.min_time, args.repeat)
+            print(f"{name:<34} {results[name]['calls']:>8} {results[name]['best_us']:>11.1f} "
+                  f"{results[name]['median_us']:>11.1f}")
+    save_results(args.output, "micro", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
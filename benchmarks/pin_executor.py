@@ -0,0 +1,80 @@
+"""Смешанная нагрузка: создание аккаунтов и неверные PIN (bcrypt) параллельно
+с чтением баланса по токену. Сравнивает задержки чтений с отдельным пулом
+для bcrypt и с общим пулом потоков цикла событий (BANK_PIN_WORKERS=0).
+
+    python -m benchmarks.pin_executor --heavy 64 --light 16 --seconds 10
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+import httpx
+
+from app import auth
+from app.database import init_db
+from app.main import app
+from benchmarks.common import percentile
+
+
+async def heavy_client(client, account_id, deadline, created):
+    while time.perf_counter() < deadline:
+        owner = f"bench_{uuid.uuid4().hex[:12]}"
+        response = await client.post("/accounts/", json={"owner": owner, "pin": "1234", "balance": 0.0})
+        created.append(response.json()["id"])
+        await client.get(f"/accounts/{account_id}", params={"pin": "0000"})
+
+
+async def light_client(client, account_id, token, deadline, latencies):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        await client.get(f"/accounts/{account_id}", headers={"X-Session-Token": token})
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(workers, heavy, light, seconds):
+    auth.configure_executor(workers)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        owner = f"bench_{uuid.uuid4().hex[:12]}"
+        account_id = (await client.post("/accounts/", json={"owner": owner, "pin": "1234"})).json()["id"]
+        token = (await client.post(f"/accounts/{account_id}/session", json={"pin": "1234"})).json()["token"]
+
+        deadline = time.perf_counter() + seconds
+        latencies, created = [], [account_id]
+        await asyncio.gather(
+            *(heavy_client(client, account_id, deadline, created) for _ in range(heavy)),
+            *(light_client(client, account_id, token, deadline, latencies) for _ in range(light)),
+        )
+        for created_id in created:
+            await client.delete(f"/accounts/delete/{created_id}", params={"pin": "1234"})
+
+    return {
+        "pin_workers": workers,
+        "reads": len(latencies),
+        "hashes": len(created) - 1,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=auth.PIN_WORKERS)
+    parser.add_argument("--heavy", type=int, default=64)
+    parser.add_argument("--light", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    args = parser.parse_args()
+
+    init_db()
+    for workers in (0, args.workers):
+        result = asyncio.run(run(workers, args.heavy, args.light, args.seconds))
+        print(
+            f"pin_workers={result['pin_workers']:>2}  reads={result['reads']:>6}  hashes={result['hashes']:>5}  "
+            f"p50={result['p50_ms']:.1f} ms  p99={result['p99_ms']:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Стоимость одного GET /accounts/{id}: процессорное время и память на запрос.
+
+Сравниваются прежний обработчик (ORM-объект BankAccount, проверка через
+BankAccountOut с from_attributes, JSONResponse) и текущий: снимок из Core SELECT,
+тело, собранное orjson, — с выключенным и включённым кэшем счетов. Запросы идут
+через ASGI-транспорт httpx в одном процессе, так что сеть в замер не попадает.
+
+    python -m benchmarks.read_path --requests 5000
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+
+def build_legacy_app():
+    from fastapi import FastAPI, Header
+    from app import functions, workers
+    from app.database import AsyncSessionLocal
+    from app.schemas.account import BankAccountOut
+
+    app = FastAPI()
+
+    @app.get("/accounts/{account_id}", response_model=BankAccountOut)
+    async def get_account_by_id(account_id: int, pin: str | None = None,
+                                x_session_token: str | None = Header(default=None)):
+        async with AsyncSessionLocal() as db:
+            await functions._verify_pin_async(db, account_id, pin, x_session_token)
+            return await db.run_sync(workers.get_authorized_account, account_id, pin, x_session_token)
+
+    return app
+
+
+async def measure(app, url, requests, memory_samples):
+    import httpx
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        for _ in range(100):
+            assert (await client.get(url)).status_code == 200
+
+        started = time.process_time()
+        for _ in range(requests):
+            await client.get(url)
+        cpu = (time.process_time() - started) / requests
+
+        # tracemalloc замедляет всё в разы, поэтому память меряется отдельным проходом.
+        peaks = []
+        tracemalloc.start()
+        for _ in range(memory_samples):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            await client.get(url)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+    return {"cpu_us": cpu * 1e6, "peak_kib": sum(peaks) / len(peaks) / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--memory-samples", type=int, default=200)
+    parser.add_argument("--dir", default=None, help="каталог для временной базы")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        os.environ["BANK_DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'read_path.db')}"
+        from app import functions, workers
+        from app.cache import LRUCache
+        from app.config import settings
+        from app.main import app
+        from app.snapshots import account_cache
+
+        account = functions.create_account(f"bench_{uuid.uuid4().hex[:8]}", "1234", 1000.0)
+        url = f"/accounts/{account.id}?pin=1234"
+        backend = account_cache.backend or LRUCache(settings.resolved_account_cache_size or 10_000, settings.account_cache_ttl)
+
+        variants = [
+            ("orm + pydantic", build_legacy_app(), None),
+            ("core + orjson", app, None),
+            ("core + orjson, cache", app, backend),
+        ]
+        print(f"{'variant':<22} {'cpu µs/req':>11} {'peak KiB/req':>13}")
+        for name, target, cache_backend in variants:
+            account_cache.configure(cache_backend)
+            result = asyncio.run(measure(target, url, args.requests, args.memory_samples))
+            print(f"{name:<22} {result['cpu_us']:>11.0f} {result['peak_kib']:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Холодный старт: импорт app.main и время до первого обслуженного запроса.
+
+Каждый запуск — отдельный процесс: интерпретатор, импорт, сборка приложения, lifespan
+(схема базы) и первый запрос, который читает счёт из базы. Два сценария: пустая база
+(создаются таблицы и применяются миграции) и база с актуальной схемой — обычный
+перезапуск воркера при автомасштабировании.
+
+    python -m benchmarks.startup --runs 10
+    python -m benchmarks.startup --runs 20 --output startup.json
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import ROOT, save_results
+
+PHASES = ("import_ms", "create_ms", "lifespan_ms", "first_request_ms", "to_first_response_ms")
+
+
+def run_worker(spawned_at: float):
+    started = time.perf_counter()
+    import app.main
+    imported = time.perf_counter()
+    application = app.main.app
+    created = time.perf_counter()
+
+    from fastapi.testclient import TestClient
+
+    with TestClient(application) as client:
+        ready = time.perf_counter()
+        response = client.get("/accounts/1", params={"pin": "0000"})
+        answered = time.perf_counter()
+        responded_at = time.time()
+    assert response.status_code in (200, 400), response.text
+    print(json.dumps({
+        "import_ms": (imported - started) * 1000,
+        "create_ms": (created - imported) * 1000,
+        "lifespan_ms": (ready - created) * 1000,
+        "first_request_ms": (answered - ready) * 1000,
+        # От запуска процесса, вместе со стартом интерпретатора.
+        "to_first_response_ms": (responded_at - spawned_at) * 1000,
+    }))
+
+
+def spawn(database: str):
+    env = {**os.environ, "BANK_DATABASE_URL": f"sqlite:///{database}", "BANK_PIN_WORKERS": "0"}
+    env.pop("BANK_ASYNC_DATABASE_URL", None)
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--worker", repr(time.time())],
+        cwd=ROOT, env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def summarize(samples):
+    return {
+        phase: {"median": statistics.median(values), "min": min(values)}
+        for phase in PHASES for values in [[sample[phase] for sample in samples]]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--dir", default=None, help="каталог для временных баз (по умолчанию — системный tmp)")
+    parser.add_argument("--output", default=None, help="записать результаты в JSON")
+    parser.add_argument("--worker", type=float, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        run_worker(args.worker)
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        template = os.path.join(tmp, "template.db")
+        spawn(template)
+        fresh, current = [], []
+        for run in range(args.runs):
+            fresh.append(spawn(os.path.join(tmp, f"fresh_{run}.db")))
+            database = os.path.join(tmp, f"current_{run}.db")
+            shutil.copyfile(template, database)
+            current.append(spawn(database))
+        results["fresh database"] = summarize(fresh)
+        results["current schema"] = summarize(current)
+
+    print(f"{'scenario':<18}" + "".join(f"{phase.removesuffix('_ms'):>22}" for phase in PHASES))
+    for label, result in results.items():
+        print(f"{label:<18}" + "".join(f"{result[phase]['median']:>19.1f} ms" for phase in PHASES))
+    save_results(args.output, "startup", {"runs": args.runs}, results)
+
+
+if __name__ == "__main__":
+    main()
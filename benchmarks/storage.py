@@ -0,0 +1,79 @@
+"""Пропускная способность пополнений и переводов при разных настройках SQLite.
+Каждая конфигурация запускается в отдельном процессе со своей временной базой:
+движок создаётся при импорте app.database из переменных окружения BANK_*.
+
+    python -m benchmarks.storage --ops 2000 --threads 4
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+CONFIGS = {
+    "delete/full": {"BANK_SQLITE_JOURNAL_MODE": "DELETE", "BANK_SQLITE_SYNCHRONOUS": "FULL"},
+    "wal/full": {"BANK_SQLITE_JOURNAL_MODE": "WAL", "BANK_SQLITE_SYNCHRONOUS": "FULL"},
+    "wal/normal": {"BANK_SQLITE_JOURNAL_MODE": "WAL", "BANK_SQLITE_SYNCHRONOUS": "NORMAL"},
+}
+
+
+def run_worker(ops, threads):
+    from app import functions
+    from app.database import init_db
+
+    init_db()
+    suffix = uuid.uuid4().hex[:8]
+    first = functions.create_account(f"bench_a_{suffix}", "1234", 1_000_000.0)
+    second = functions.create_account(f"bench_b_{suffix}", "1234", 1_000_000.0)
+    # Прогрев кэша проверенных PIN: меряем хранилище, а не bcrypt.
+    functions.get_account_balance(first.id, "1234")
+    functions.get_account_balance(second.id, "1234")
+
+    def measure(call):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(lambda i: call(i), range(ops)))
+        return ops / (time.perf_counter() - started)
+
+    deposits = measure(lambda i: functions.deposit_to_account(first.id, 1.0, "1234"))
+    transfers = measure(lambda i: functions.transfer_money(
+        *((first.id, second.id) if i % 2 else (second.id, first.id)), 1.0, "1234"
+    ))
+    print(json.dumps({"deposits_per_s": deposits, "transfers_per_s": transfers}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--dir", default=None, help="каталог для временных баз (по умолчанию — системный tmp)")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.ops, args.threads)
+        return
+
+    for name, overrides in CONFIGS.items():
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+            env = {
+                **os.environ, **overrides,
+                "BANK_DATABASE_URL": f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+                "BANK_PIN_WORKERS": "0",
+            }
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.storage", "--worker",
+                 "--ops", str(args.ops), "--threads", str(args.threads)],
+                env=env, check=True, capture_output=True, text=True
+            ).stdout
+        result = json.loads(output.splitlines()[-1])
+        print(f"{name:<12} threads={args.threads}  deposits={result['deposits_per_s']:>7.0f}/s  "
+              f"transfers={result['transfers_per_s']:>7.0f}/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,57 @@
-from app.database import init_db
+"""Консольное мини-приложение.
+
+Без аргументов — интерактивное меню. С --script — пакетный режим для ручных правок:
+команды JSON-строками из файла или stdin («-»), по строке на команду:
+
+    {"op": "create", "owner": "alice", "pin": "1234", "balance": 100}
+    {"op": "deposit", "id": 5, "amount": 100, "pin": "1234"}
+    {"op": "withdraw", "id": 5, "amount": 30, "pin": "1234"}
+    {"op": "transfer", "id": 5, "to": 6, "amount": 10, "pin": "1234"}
+    {"op": "balance", "id": 5, "pin": "1234"}     # а также history, info, delete
+
+Команды выполняются в одной долгоживущей сессии, по --batch-size команд на транзакцию;
+PIN-коды пакета проверяются (а PIN новых счетов хэшируются) заранее, параллельно в
+--pin-workers потоках. Результат каждой команды — JSON-строка в stdout (или --output),
+итог с пропускной способностью и задержками — JSON в stderr.
+
+    python old_main.py --script corrections.jsonl --batch-size 200
+    cat corrections.jsonl | python old_main.py --script - --output results.jsonl
+"""
+import argparse
+import json
+import math
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+
+from sqlalchemy import select
+
+from app import archive, auth, workers
+from app.config import settings
+from app.database import SessionLocal, init_db
 from app.functions import (
     create_account, deposit_to_account, withdraw_from_account,
-    transfer_money, get_account_balance, get_account_by_id, get_history, delete_account
+    transfer_money, get_account_balance, get_account_by_id, get_history, delete_account, configure_sharding
 )
+from app.models import BankAccount
+from app.snapshots import account_cache
+from app.transactions import TransactionRunner
 
-init_db()
+# Поля команды пакетного режима: обязательные и необязательные со значением по умолчанию.
+SCRIPT_COMMANDS = {
+    "create": (("owner", "pin"), {"balance": 0.0}),
+    "deposit": (("id", "amount", "pin"), {}),
+    "withdraw": (("id", "amount", "pin"), {}),
+    "transfer": (("id", "to", "amount", "pin"), {}),
+    "balance": (("id", "pin"), {}),
+    "history": (("id", "pin"), {}),
+    "info": (("id", "pin"), {}),
+    "delete": (("id", "pin"), {}),
+}
+# Числовые поля команды и тип, к которому они приводятся.
+SCRIPT_NUMBERS = {"id": int, "to": int, "amount": float, "balance": float}
 
 def main():
     while True:
@@ -93,6 +140,243 @@ def main():
                     print("Неверный выбор. Попробуйте снова.")
         except Exception as e:
             print(f"Ошибка: {e}")
-            
+
+
+class BatchAborted(Exception):
+    """Транзакция пакета испорчена (например, гонка на уникальном owner при flush):
+    пакет откатывается и выполняется заново по одной команде на транзакцию."""
+
+
+def _number(field: str, value, kind):
+    # Тип поля проверяется при разборе строки: иначе list в id или строка в amount
+    # падают TypeError где-то в пакете, а не ошибкой этой команды. bool — подкласс int,
+    # но true вместо суммы — ошибка в скрипте.
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"Поле {field}: ожидается число")
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(f"Поле {field}: ожидается число")
+    if not math.isfinite(number):
+        raise ValueError(f"Поле {field}: ожидается число")
+    if kind is int and not number.is_integer():
+        raise ValueError(f"Поле {field}: ожидается целое число")
+    return kind(number)
+
+
+def parse_command(line: str):
+    try:
+        command = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Некорректный JSON: {e.msg}")
+    if not isinstance(command, dict):
+        raise ValueError("Команда должна быть JSON-объектом")
+    if command.get("op") not in SCRIPT_COMMANDS:
+        raise ValueError(f"Неизвестная команда: {command.get('op')}")
+    required, defaults = SCRIPT_COMMANDS[command["op"]]
+    missing = [field for field in required if command.get(field) is None]
+    if missing:
+        raise ValueError("Не хватает полей: " + ", ".join(missing))
+    command = {**defaults, **command, "pin": str(command["pin"])}
+    for field, kind in SCRIPT_NUMBERS.items():
+        if field in command:
+            command[field] = _number(field, command[field], kind)
+    if command["op"] == "create":
+        if not isinstance(command["owner"], str):
+            raise ValueError("Поле owner: ожидается строка")
+        workers.validate_new_account(command["owner"], command["pin"], command["balance"])
+    return command
+
+
+def _prepare_credentials(db, commands, pool):
+    """PIN пакета одним запросом за хэшами и параллельной проверкой bcrypt: удачная
+    проверка ложится в кэш auth, и _authorize в командах обходится без bcrypt. Неудачные
+    возвращаются множеством, чтобы не проверять неверный PIN повторно."""
+    credentials = {(command["id"], command["pin"]) for command in commands if command["op"] != "create"}
+    pin_hashes = dict(db.execute(
+        select(BankAccount.id, BankAccount._pin).where(BankAccount.id.in_({account_id for account_id, _ in credentials}))
+    ).all()) if credentials else {}
+    credentials = [(account_id, pin) for account_id, pin in credentials if account_id in pin_hashes]
+    checks = pool.map(lambda credential: auth.verify_pin(credential[0], pin_hashes[credential[0]], credential[1]),
+                      credentials)
+    rejected = {credential for credential, ok in zip(credentials, checks) if not ok}
+
+    creates = [command for command in commands if command["op"] == "create"]
+    hashes = dict(zip(
+        (id(command) for command in creates), pool.map(lambda command: auth.hash_pin(command["pin"]), creates)
+    ))
+    return rejected, hashes
+
+
+def _execute(db, command, rejected: set, hashes: dict):
+    op = command["op"]
+    if op == "create":
+        if db.scalar(select(BankAccount.id).where(BankAccount.owner == command["owner"])) is not None:
+            raise ValueError("Такой аккаунт уже существует")
+        pin_hash = hashes[id(command)]
+        account = workers.create_account(db, command["owner"], command["pin"], command["balance"], pin_hash)
+        # Хэш получен из этого PIN: команды пакета с новым счётом не ждут bcrypt. Если пакет
+        # откатится, запись не совпадёт ни с каким другим счётом — у него другой pin_hash.
+        auth.remember(account.id, pin_hash, command["pin"])
+        return workers.account_body(account)
+
+    account_id, pin = command["id"], command["pin"]
+    if (account_id, pin) in rejected:
+        raise ValueError("Неверный PIN-код")
+    match op:
+        case "deposit":
+            return workers.account_body(workers.deposit(db, account_id, command["amount"], pin, None))
+        case "withdraw":
+            return workers.account_body(workers.withdraw(db, account_id, command["amount"], pin, None))
+        case "transfer":
+            return workers.pair_body(workers.transfer(db, account_id, command["to"], command["amount"], pin, None))
+        case "balance":
+            return {"id": account_id, "balance": workers.get_authorized_account(db, account_id, pin, None).balance}
+        case "info":
+            return workers.account_body(workers.get_authorized_account(db, account_id, pin, None))
+        case "history":
+            workers.get_authorized_account(db, account_id, pin, None)
+            return [
+                [row.type, row.amount, row.timestamp.strftime("%Y-%m-%d %H:%M:%S")]
+                for row in chain(archive.operations(db, account_id), db.execute(workers.history_query(account_id)))
+            ]
+        case "delete":
+            workers.delete_account(db, account_id, pin, None)
+            db.flush()
+            return {"id": account_id, "deleted": True}
+
+
+def _touched(commands):
+    return {command[field] for command in commands for field in ("id", "to") if command.get(field) is not None}
+
+
+def _run_batch(runner, commands, pool):
+    """Команды пакета в одной транзакции. Ошибка проверки (ValueError) — результат своей
+    команды: рабочие функции проверяют PIN и сумму до записи, а списание — условный UPDATE."""
+    def work(db):
+        rejected, hashes = _prepare_credentials(db, [command for command in commands if command is not None], pool)
+        results = []
+        for command in commands:
+            if command is None:
+                results.append(None)
+                continue
+            try:
+                results.append(_execute(db, command, rejected, hashes))
+            except ValueError as e:
+                if not db.is_active:
+                    raise BatchAborted() from e
+                results.append(e)
+        return results
+
+    def committed(db, results):
+        account_cache.invalidate(*_touched(command for command in commands if command is not None))
+        for command, result in zip(commands, results):
+            if command is not None and command["op"] == "delete" and not isinstance(result, ValueError):
+                auth.invalidate(command["id"])
+
+    return runner.run("script", work, committed)
+
+
+def run_script(lines, output, batch_size: int = 100, pin_workers: int = settings.pin_workers):
+    """Выполняет команды из lines (JSON-строки) и пишет в output по JSON-строке на
+    команду; возвращает итог: число команд и ошибок, пакеты, время и задержки."""
+    session = SessionLocal()
+    # Долгоживущая сессия: runner после транзакции вызывает close(), и SQLAlchemy
+    # готовит тот же объект Session к следующему пакету.
+    runner = TransactionRunner(
+        lambda: session, max_attempts=settings.tx_max_attempts, base_delay=settings.tx_base_delay,
+        max_delay=settings.tx_max_delay, deadline=settings.tx_deadline, lock_timeout=settings.lock_timeout
+    )
+    summary = {"commands": 0, "ok": 0, "errors": 0, "batches": 0}
+    latencies = []
+    started = time.perf_counter()
+    numbered = ((number, line) for number, line in enumerate(lines, 1) if line.strip())
+    with ThreadPoolExecutor(max_workers=max(1, pin_workers), thread_name_prefix="script-pin") as pool:
+        while chunk := list(islice(numbered, batch_size)):
+            commands, results = [], []
+            for _, line in chunk:
+                try:
+                    commands.append(parse_command(line))
+                    results.append(None)
+                except ValueError as e:
+                    commands.append(None)
+                    results.append(e)
+
+            batch_started = time.perf_counter()
+            try:
+                outcomes = _run_batch(runner, commands, pool)
+                summary["batches"] += 1
+            except BatchAborted:
+                outcomes = []
+                for command in commands:
+                    try:
+                        outcomes.extend(_run_batch(runner, [command], pool))
+                    except BatchAborted as e:
+                        outcomes.append(e.__cause__)
+                    summary["batches"] += 1
+            latency = time.perf_counter() - batch_started
+
+            for (number, _), command, error, outcome in zip(chunk, commands, results, outcomes):
+                failure = error or (outcome if isinstance(outcome, ValueError) else None)
+                record = {"line": number, "op": command["op"] if command else None}
+                if failure is not None:
+                    record.update(status="error", detail=str(failure))
+                    summary["errors"] += 1
+                else:
+                    record.update(status="ok", result=outcome)
+                    summary["ok"] += 1
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                latencies.append(latency)
+            summary["commands"] += len(chunk)
+    session.close()
+
+    seconds = time.perf_counter() - started
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    summary.update(
+        seconds=round(seconds, 3),
+        per_s=round(summary["commands"] / seconds, 1) if seconds else 0.0,
+        # Задержка команды — от начала её пакета до его коммита.
+        p50_ms=round(quantiles[49] * 1000, 2) if quantiles else 0.0,
+        p99_ms=round(quantiles[98] * 1000, 2) if quantiles else 0.0,
+    )
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Банковское приложение в консоли")
+    parser.add_argument("--script", help="файл с командами в JSON-строках, «-» — stdin")
+    parser.add_argument("--output", help="куда писать результаты (по умолчанию stdout)")
+    parser.add_argument("--batch-size", type=int, default=100, help="команд на одну транзакцию")
+    parser.add_argument("--pin-workers", type=int, default=settings.pin_workers,
+                        help="потоков для параллельной проверки PIN")
+    args = parser.parse_args(argv)
+    if args.batch_size < 1:
+        parser.error("--batch-size должен быть положительным")
+    if args.script is not None and settings.shard_urls:
+        # Пакетный режим работает с сессией основной базы напрямую, в обход роутера шардов.
+        parser.error("--script не поддерживается при BANK_SHARD_URLS")
+    return args
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    init_db()
+    if args.script is None:
+        if settings.shard_urls:
+            from app.sharding import ShardRouter
+
+            router = ShardRouter.from_settings()
+            router.init()
+            configure_sharding(router)
+        main()
+    else:
+        source = sys.stdin if args.script == "-" else open(args.script, encoding="utf-8")
+        output = sys.stdout if args.output is None else open(args.output, "w", encoding="utf-8")
+        try:
+            report = run_script(source, output, args.batch_size, args.pin_workers)
+        finally:
+            for stream in (source, output):
+                if stream not in (sys.stdin, sys.stdout):
+                    stream.close()
+        print(json.dumps(report, ensure_ascii=False), file=sys.stderr)
+        sys.exit(1 if report["errors"] else 0)
@@ -3,7 +3,9 @@ import random
 import string
 from fastapi.testclient import TestClient
 from app.main import app
+from app import metrics
 from app.database import init_db
+from app.sharding import ShardRouter
 
 init_db()
 client = TestClient(app)
@@ -29,4 +31,27 @@ def create_account2():
     response = client.post("/accounts/", json={"owner": name, "pin": pin, "balance": balance})
     data = response.json()
     yield {"id": data['id'], "pin": pin, "name": name, "balance": balance}
-    client.delete(f"/accounts/delete/{data['id']}?pin={pin}")
\ No newline at end of file
+    client.delete(f"/accounts/delete/{data['id']}?pin={pin}")
+
+@pytest.fixture()
+def query_budget():
+    """with query_budget(5): ... — тест падает со списком запросов, если блок выполнил больше."""
+    return metrics.query_budget
+
+@pytest.fixture()
+def query_count(monkeypatch):
+    """Включает заголовок X-Query-Count и возвращает функцию, читающую его из ответа."""
+    monkeypatch.setattr(metrics, "QUERY_HEADER", True)
+    return lambda response: int(response.headers["x-query-count"])
+
+@pytest.fixture()
+def shard_urls(tmp_path):
+    return [f"sqlite:///{tmp_path / f'shard{index}.db'}" for index in range(3)]
+
+@pytest.fixture()
+def shard_router(shard_urls):
+    """Три шарда на временных файлах SQLite."""
+    router = ShardRouter(shard_urls)
+    router.init()
+    yield router
+    router.dispose()
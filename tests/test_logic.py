@@ -1,27 +1,67 @@
+import asyncio
+import random
+import time
+import sqlite3
+import subprocess
+import sys
+import threading
 import pytest
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.exc import IntegrityError, OperationalError
+from app.transactions import TransactionRunner, TransactionConflict
+from app.cache import CacheBackend, LRUCache
+from app.snapshots import AccountSnapshot, account_cache
+from app import functions
 from app.functions import (
 create_account, deposit_to_account, withdraw_from_account, transfer_money,
-get_history, get_account_balance, get_account_by_id, delete_account
+get_history, get_account_balance, get_account_by_id, delete_account, create_session,
+apply_batch, get_operations_page, export_history
 )
-from app.models import BankAccount
-from app.database import init_db
+from app import models, analytics, metrics, idempotency, sharding, archive, workers, migrations, importer
+from app.sharding import ShardRouter
+from app.models import ArchivedAccount, BankAccount, BalanceCheckpoint, DailyAggregate, Operation
+from app.ledger import rebuild_checkpoints, rebuild_daily_aggregates
+from dataclasses import replace
+from app import auth
+from app.config import load_settings, settings
+from app.importer import import_accounts
+import old_main
+import io
+import os
+import json
+import gzip
+import csv
+from app.database import create_database_engine, init_schema, SessionLocal, Base
+from app.migrations import run_migrations, get_schema_version, LATEST_VERSION
+from sqlalchemy import create_engine, inspect, text, select, insert
 import uuid
+from datetime import datetime, timedelta, timezone
 
-init_db()
 
 
 def random_owner_name():
     return f"user_{uuid.uuid4().hex[:8]}"
 
-def test_create_account():
+def test_create_account(query_budget):
     owner = random_owner_name()
-    account = create_account(owner=owner, pin="1234", initial_balance=500.0)
+    with query_budget(2):
+        account = create_account(owner=owner, pin="1234", initial_balance=500.0)
     assert isinstance(account, BankAccount)
     assert account.owner == owner
     assert account.balance == 500.0
 
     delete_account(account_id=account.id, pin="1234")
 
+def test_create_account_duplicate_owner():
+    owner = random_owner_name()
+    account = create_account(owner=owner, pin="1234", initial_balance=500.0)
+    with pytest.raises(ValueError, match="Такой аккаунт уже существует"):
+        create_account(owner=owner, pin="4321", initial_balance=0.0)
+    with pytest.raises(ValueError, match="Такой аккаунт уже существует"):
+        asyncio.run(functions.create_account_async(owner=owner, pin="4321", initial_balance=0.0))
+
+    delete_account(account_id=account.id, pin="1234")
+
 def test_create_account_empty_owner():
     with pytest.raises(ValueError) as e:
         create_account(owner="", pin="1234", initial_balance=1000.0)
@@ -40,10 +80,11 @@ def test_create_account_invalid_data(pin, balance, error_message):
         create_account(owner=owner, pin=pin, initial_balance=balance)
         
         
-def test_deposit():
+def test_deposit(query_budget):
     owner = random_owner_name()
     account = create_account(owner=owner, pin="1234", initial_balance=1000.0)
-    update_account = deposit_to_account(account_id=account.id, amount=500.0, pin="1234")
+    with query_budget(5):
+        update_account = deposit_to_account(account_id=account.id, amount=500.0, pin="1234")
     assert update_account.balance == 1500.0
     
     delete_account(account_id=update_account.id, pin="1234")
@@ -68,10 +109,11 @@ def test_deposit_to_nonexistent_account():
         deposit_to_account(account_id=999999, amount=100.0, pin="1234")
         
         
-def test_withdraw():
+def test_withdraw(query_budget):
     owner = random_owner_name()
     account = create_account(owner=owner, pin="1234", initial_balance=1000.0)
-    update_account = withdraw_from_account(account_id=account.id, amount=500.0, pin="1234")
+    with query_budget(5):
+        update_account = withdraw_from_account(account_id=account.id, amount=500.0, pin="1234")
     assert update_account.balance == 500.0
     
     delete_account(account_id=update_account.id, pin="1234")
@@ -97,18 +139,141 @@ def test_withdraw_to_nonexistent_account():
         withdraw_from_account(account_id=999999, amount=100.0, pin="1234")
         
         
-def test_transfer_money():
+def test_transfer_money(query_budget):
     owner1 = random_owner_name()
     owner2 = random_owner_name()
     account1 = create_account(owner=owner1, pin="1234", initial_balance=1000.0)
     account2 = create_account(owner=owner2, pin="4321", initial_balance=1000.0)
-    update_account2, update_account1 = transfer_money(from_id=account1.id, to_id=account2.id, amount=500.0, pin="1234")
+    # Оба счёта читаются одним IN и перечитываются одним SELECT.
+    with query_budget(8):
+        update_account2, update_account1 = transfer_money(from_id=account1.id, to_id=account2.id, amount=500.0, pin="1234")
     assert update_account1.balance == 500.0
     assert update_account2.balance == 1500.0
     
     delete_account(account_id=update_account1.id, pin="1234")
     delete_account(account_id=update_account2.id, pin="4321")
 
+def _fields(snapshot):
+    return snapshot.id, snapshot.owner, snapshot.balance
+
+def test_idempotent_deposit_replays_stored_response(query_budget):
+    account = create_account(owner=random_owner_name(), pin="1234", initial_balance=100.0)
+    key = uuid.uuid4().hex
+
+    first = deposit_to_account(account_id=account.id, amount=50.0, pin="1234", idempotency_key=key)
+    assert _fields(first) == (account.id, account.owner, 150.0)
+    # Повтор отдаётся из кэша ключей; единственный запрос — снимок счёта для проверки PIN.
+    with query_budget(1):
+        again = deposit_to_account(account_id=account.id, amount=50.0, pin="1234", idempotency_key=key)
+    assert _fields(again) == _fields(first)
+
+    # Без кэша ответ читается из таблицы.
+    idempotency.cache.clear()
+    assert _fields(deposit_to_account(account_id=account.id, amount=50.0, pin="1234", idempotency_key=key)) == _fields(again)
+    assert get_account_balance(account_id=account.id, pin="1234") == 150.0
+    assert len(get_history(account_id=account.id, pin="1234")) == 1
+
+    with pytest.raises(ValueError, match="уже использован для другого запроса"):
+        deposit_to_account(account_id=account.id, amount=60.0, pin="1234", idempotency_key=key)
+    with pytest.raises(ValueError, match="уже использован для другого запроса"):
+        withdraw_from_account(account_id=account.id, amount=50.0, pin="1234", idempotency_key=key)
+    with pytest.raises(ValueError, match="Неверный PIN-код"):
+        deposit_to_account(account_id=account.id, amount=50.0, pin="0000", idempotency_key=key)
+
+    delete_account(account_id=account.id, pin="1234")
+
+def test_idempotent_transfer_replays_both_accounts():
+    account1 = create_account(owner=random_owner_name(), pin="1234", initial_balance=1000.0)
+    account2 = create_account(owner=random_owner_name(), pin="4321", initial_balance=1000.0)
+    key = uuid.uuid4().hex
+
+    first = transfer_money(account1.id, account2.id, 300.0, pin="1234", idempotency_key=key)
+    replayed = transfer_money(account1.id, account2.id, 300.0, pin="1234", idempotency_key=key)
+    assert [_fields(account) for account in first] == [_fields(account) for account in replayed] == [
+        (account2.id, account2.owner, 1300.0),
+        (account1.id, account1.owner, 700.0),
+    ]
+    assert get_account_balance(account_id=account1.id, pin="1234") == 700.0
+    # Ключ действует в пределах счёта: тот же ключ на другом счёте — новый запрос.
+    assert deposit_to_account(account_id=account2.id, amount=1.0, pin="4321", idempotency_key=key).balance == 1301.0
+
+    delete_account(account_id=account1.id, pin="1234")
+    delete_account(account_id=account2.id, pin="4321")
+
+def test_idempotent_concurrent_duplicates_execute_once():
+    account = create_account(owner=random_owner_name(), pin="1234", initial_balance=0.0)
+    key = uuid.uuid4().hex
+
+    async def deposits():
+        return await asyncio.gather(*(
+            functions.deposit_to_account_async(account.id, 10.0, pin="1234", idempotency_key=key) for _ in range(8)
+        ))
+    balances = {result.balance for result in asyncio.run(deposits())}
+    assert balances == {10.0}
+    assert get_account_balance(account_id=account.id, pin="1234") == 10.0
+
+    delete_account(account_id=account.id, pin="1234")
+
+def test_idempotency_key_expires(monkeypatch):
+    account = create_account(owner=random_owner_name(), pin="1234", initial_balance=0.0)
+    key = uuid.uuid4().hex
+    deposit_to_account(account_id=account.id, amount=10.0, pin="1234", idempotency_key=key)
+
+    idempotency.cache.clear()
+    monkeypatch.setattr(idempotency, "_now", lambda: datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(days=2))
+    # Истёкший ключ — как новый: операция выполняется снова, запись перезаписывается.
+    assert deposit_to_account(account_id=account.id, amount=10.0, pin="1234", idempotency_key=key).balance == 20.0
+    monkeypatch.undo()
+
+    db = SessionLocal()
+    try:
+        idempotency.purge_expired(db)
+        assert db.get(models.IdempotencyKey, (account.id, key)).expires_at > datetime.now(timezone.utc).replace(tzinfo=None)
+    finally:
+        db.rollback()
+        db.close()
+
+    with pytest.raises(ValueError, match="Idempotency-Key должен быть"):
+        deposit_to_account(account_id=account.id, amount=10.0, pin="1234", idempotency_key="")
+    delete_account(account_id=account.id, pin="1234")
+
+
+def test_group_commit_coalesces_concurrent_writes():
+    account1 = create_account(owner=random_owner_name(), pin="1234", initial_balance=100.0)
+    account2 = create_account(owner=random_owner_name(), pin="4321", initial_balance=0.0)
+    # PIN проверяется до очереди; прогретый кэш проверок — чтобы все операции попали в одно окно.
+    get_account_balance(account_id=account1.id, pin="1234")
+    get_account_balance(account_id=account2.id, pin="4321")
+    functions.configure_group_commit(True, max_batch=16, window_ms=50)
+    calls_before = functions.runner.stats.snapshot().get("group_commit", {}).get("calls", 0)
+
+    async def writes():
+        return await asyncio.gather(*(
+            [functions.deposit_to_account_async(account1.id, 10.0, pin="1234") for _ in range(10)]
+            + [functions.withdraw_from_account_async(account2.id, 50.0, pin="4321"),
+               functions.deposit_to_account_async(account2.id, 5.0, pin="0000"),
+               functions.deposit_to_account_async(999999, 5.0, pin="1234")]
+        ), return_exceptions=True)
+    try:
+        results = asyncio.run(writes())
+    finally:
+        functions.configure_group_commit(False)
+
+    deposits, (overdraft, wrong_pin, missing) = results[:10], results[10:]
+    assert sorted(result.balance for result in deposits) == [110.0 + 10 * i for i in range(10)]
+    assert all(_fields(result)[:2] == (account1.id, account1.owner) for result in deposits)
+    assert str(overdraft) == "Недостаточно средств"
+    assert str(wrong_pin) == "Неверный PIN-код"
+    assert str(missing) == "Аккаунт с таким ID не найден"
+    # Ошибки не откатили соседние операции, а всё окно ушло одним коммитом.
+    assert functions.runner.stats.snapshot()["group_commit"]["calls"] - calls_before == 1
+    assert get_account_balance(account_id=account1.id, pin="1234") == 200.0
+    assert get_account_balance(account_id=account2.id, pin="4321") == 0.0
+    assert len(get_history(account_id=account1.id, pin="1234")) == 10
+
+    delete_account(account_id=account1.id, pin="1234")
+    delete_account(account_id=account2.id, pin="4321")
+
 @pytest.mark.parametrize(
     "amount, pin, error_message",
     [
@@ -146,7 +311,7 @@ def test_transfer_to_nonexistent_account():
     delete_account(account_id=sender.id, pin="1234")
 
 
-def test_get_history():
+def test_get_history(query_budget):
     owner1 = random_owner_name()
     owner2 = random_owner_name()
 
@@ -157,7 +322,9 @@ def test_get_history():
     withdraw_from_account(account_id=account1.id, amount=100.0, pin="1234")
     transfer_money(from_id=account1.id, to_id=account2.id, amount=300.0, pin="1234")
 
-    history = get_history(account_id=account1.id, pin="1234")
+    # Снимок счёта, каталог архива и сами операции.
+    with query_budget(3):
+        history = get_history(account_id=account1.id, pin="1234")
 
     assert isinstance(history, list)
     assert len(history) >= 3 
@@ -168,7 +335,10 @@ def test_get_history():
     assert any("снятие" in t for t in types)
     assert any("перевод на аккаунт" in t for t in types)
 
-    delete_account(account_id=account1.id, pin="1234")
+    # Операции, обороты, ключи идемпотентности и каталог архива удаляются запросом на таблицу,
+    # без загрузки в сессию.
+    with query_budget(7):
+        delete_account(account_id=account1.id, pin="1234")
     delete_account(account_id=account2.id, pin="4321")
 
 def test_get_history_wrong_pin():
@@ -184,10 +354,11 @@ def test_get_history_to_nonexistent_account():
     with pytest.raises(ValueError, match="Аккаунт с таким ID не найден"):
         get_history(account_id=999999, pin="1234")
     
-def test_get_account_balance():
+def test_get_account_balance(query_budget):
     owner = random_owner_name()
     account = create_account(owner=owner, pin="1234", initial_balance=1000.0)
-    balance = get_account_balance(account_id=account.id, pin="1234")
+    with query_budget(1):
+        balance = get_account_balance(account_id=account.id, pin="1234")
     assert balance == 1000.0
     
     delete_account(account_id=account.id, pin="1234")
@@ -206,10 +377,11 @@ def test_get_balance_to_nonexistent_account():
         get_account_balance(account_id=999999, pin="1234")
         
 
-def test_get_account_by_id():
+def test_get_account_by_id(query_budget):
     owner = random_owner_name()
     account = create_account(owner=owner, pin="1234", initial_balance=1000.0)
-    account_inform = get_account_by_id(account_id=account.id, pin="1234")
+    with query_budget(1):
+        account_inform = get_account_by_id(account_id=account.id, pin="1234")
     assert account_inform.id == account.id
     assert account_inform.owner == owner
     assert account_inform.balance == account.balance
@@ -230,11 +402,12 @@ def test_get_account_to_nonexistent_account():
         get_account_by_id(account_id=999999, pin="1234")
 
 
-def test_delete_account():
+def test_delete_account(query_budget):
     owner = random_owner_name()
     account = create_account(owner=owner, pin="1234", initial_balance=100.0)
 
-    delete_account(account_id=account.id, pin="1234")
+    with query_budget(7):
+        delete_account(account_id=account.id, pin="1234")
 
     with pytest.raises(ValueError, match="Аккаунт с таким ID не найден"):
         get_account_by_id(account_id=account.id, pin="1234")
@@ -250,4 +423,1350 @@ def test_delete_account_wrong_pin():
 
 def test_delete_nonexistent_account():
     with pytest.raises(ValueError, match="Аккаунт с таким ID не найден"):
-        delete_account(account_id=999999, pin="1234")
\ No newline at end of file
+        delete_account(account_id=999999, pin="1234")
+
+
+def test_create_session_and_use_token():
+    owner = random_owner_name()
+    account = create_account(owner=owner, pin="1234", initial_balance=1000.0)
+    token, expires_in = create_session(account_id=account.id, pin="1234")
+    assert expires_in == auth.SESSION_TTL
+
+    update_account = deposit_to_account(account_id=account.id, amount=100.0, token=token)
+    assert update_account.balance == 1100.0
+    assert get_account_balance(account_id=account.id, token=token) == 1100.0
+
+    delete_account(account_id=account.id, token=token)
+
+def test_create_session_wrong_pin():
+    owner = random_owner_name()
+    account = create_account(owner=owner, pin="1234", initial_balance=1000.0)
+
+    with pytest.raises(ValueError, match="Неверный PIN-код"):
+        create_session(account_id=account.id, pin="0000")
+
+    delete_account(account_id=account.id, pin="1234")
+
+@pytest.mark.parametrize("token", ["garbage", "1.1.abc", ""])
+def test_invalid_token(token):
+    owner = random_owner_name()
+    account = create_account(owner=owner, pin="1234", initial_balance=1000.0)
+
+    with pytest.raises(ValueError, match="Недействительный или просроченный токен сессии"):
+        get_account_balance(account_id=account.id, token=token)
+
+    delete_account(account_id=account.id, pin="1234")
+
+def test_token_of_other_account_rejected():
+    account1 = create_account(owner=random_owner_name(), pin="1234", initial_balance=1000.0)
+    account2 = create_account(owner=random_owner_name(), pin="4321", initial_balance=1000.0)
+    token, _ = create_session(account_id=account1.id, pin="1234")
+
+    with pytest.raises(ValueError, match="Недействительный или просроченный токен сессии"):
+        withdraw_from_account(account_id=account2.id, amount=100.0, token=token)
+
+    delete_account(account_id=account1.id, pin="1234")
+    delete_account(account_id=account2.id, pin="4321")
+
+def test_verified_pin_is_cached(monkeypatch):
+    owner = random_owner_name()
+    account = create_account(owner=owner, pin="1234", initial_balance=1000.0)
+    get_account_balance(account_id=account.id, pin="1234")
+
+    calls = []
+    monkeypatch.setattr(auth.bcrypt, "checkpw", lambda *args: calls.append(args) or False)
+    assert get_account_balance(account_id=account.id, pin="1234") == 1000.0
+    assert calls == []
+
+    with pytest.raises(ValueError, match="Неверный PIN-код"):
+        get_account_balance(account_id=account.id, pin="0000")
+    assert len(calls) == 1
+
+    monkeypatch.undo()
+    delete_account(account_id=account.id, pin="1234")
+
+@pytest.mark.parametrize("pin_workers", [0, 2])
+def test_async_pin_checks_leave_event_loop(monkeypatch, pin_workers):
+    threads = []
+    monkeypatch.setattr(auth.bcrypt, "checkpw", lambda *args: threads.append(threading.get_ident()) or False)
+    monkeypatch.setattr(auth.bcrypt, "hashpw", lambda *args: threads.append(threading.get_ident()) or b"hash")
+    previous = auth.PIN_WORKERS
+    auth.configure_executor(pin_workers)
+
+    async def check():
+        assert await auth.hash_pin_async("1234") == "hash"
+        assert await auth.verify_pin_async(-1, "hash", "1234") is False
+        return threading.get_ident()
+
+    try:
+        loop_thread = asyncio.run(check())
+    finally:
+        auth.configure_executor(previous)
+    # Даже без отдельного пула bcrypt не выполняется в потоке цикла событий.
+    assert len(threads) == 2 and loop_thread not in threads
+
+def test_pin_change_invalidates_cache_and_tokens():
+    owner = random_owner_name()
+    account = create_account(owner=owner, pin="1234", initial_balance=1000.0)
+    token = account.issue_token()
+    assert account.check_pin("1234")
+
+    account.set_pin("5678")
+    assert not account.check_pin("1234")
+    assert not account.check_token(token)
+    assert account.check_pin("5678")
+
+    delete_account(account_id=account.id, pin="1234")
+
+
+
+def test_async_functions():
+    async def scenario():
+        owner1 = random_owner_name()
+        owner2 = random_owner_name()
+        account1 = await functions.create_account_async(owner=owner1, pin="1234", initial_balance=1000.0)
+        account2 = await functions.create_account_async(owner=owner2, pin="4321", initial_balance=1000.0)
+
+        account1 = await functions.deposit_to_account_async(account_id=account1.id, amount=200.0, pin="1234")
+        assert account1.balance == 1200.0
+        account1 = await functions.withdraw_from_account_async(account_id=account1.id, amount=100.0, pin="1234")
+        assert account1.balance == 1100.0
+        to_account, from_account = await functions.transfer_money_async(
+            from_id=account1.id, to_id=account2.id, amount=300.0, pin="1234"
+        )
+        assert from_account.balance == 800.0
+        assert to_account.balance == 1300.0
+
+        assert await functions.get_account_balance_async(account_id=account1.id, pin="1234") == 800.0
+        info = await functions.get_account_by_id_async(account_id=account2.id, pin="4321")
+        assert info.owner == owner2
+        history = await functions.get_history_async(account_id=account1.id, pin="1234")
+        assert len(history) == 3
+
+        await functions.delete_account_async(account_id=account1.id, pin="1234")
+        await functions.delete_account_async(account_id=account2.id, pin="4321")
+        with pytest.raises(ValueError, match="Аккаунт с таким ID не найден"):
+            await functions.get_account_balance_async(account_id=account1.id, pin="1234")
+
+    asyncio.run(scenario())
+
+@pytest.mark.parametrize(
+    "amount, pin, error_message",
+    [
+        (500.0, "4321", "Неверный PIN-код"),
+        (-500.0, "1234", "Сумма должна быть положительной"),
+        (100000.0, "1234", "Недостаточно средств")
+    ]
+)
+def test_withdraw_async_invalid_data(amount, pin, error_message):
+    owner = random_owner_name()
+    account = create_account(owner=owner, pin="1234", initial_balance=1000.0)
+    with pytest.raises(ValueError, match=error_message):
+        asyncio.run(functions.withdraw_from_account_async(account_id=account.id, amount=amount, pin=pin))
+
+    assert get_account_balance(account_id=account.id, pin="1234") == 1000.0
+    delete_account(account_id=account.id, pin="1234")
+
+
+
+def test_apply_batch(query_budget):
+    account1 = create_account(owner=random_owner_name(), pin="1234", initial_balance=1000.0)
+    account2 = create_account(owner=random_owner_name(), pin="4321", initial_balance=500.0)
+    # Один SELECT на все счета пакета, дальше по три запроса на каждое движение денег.
+    with query_budget(1 + 3 * 4):
+        results = apply_batch([
+            {"type": "deposit", "account_id": account1.id, "amount": 100.0, "pin": "1234"},
+            {"type": "withdraw", "account_id": account2.id, "amount": 200.0, "pin": "4321"},
+            {"type": "transfer", "account_id": account1.id, "to_id": account2.id, "amount": 300.0, "pin": "1234"},
+        ])
+    assert [r["status"] for r in results] == ["ok", "ok", "ok"]
+    assert [r["balance"] for r in results] == [1100.0, 300.0, 800.0]
+    assert get_account_balance(account_id=account2.id, pin="4321") == 600.0
+
+    delete_account(account_id=account1.id, pin="1234")
+    delete_account(account_id=account2.id, pin="4321")
+
+@pytest.mark.parametrize(
+    "bad_operation, error_message",
+    [
+        ({"type": "withdraw", "amount": 100000.0, "pin": "1234"}, "Операция 1: Недостаточно средств"),
+        ({"type": "deposit", "amount": 100.0, "pin": "0000"}, "Операция 1: Неверный PIN-код"),
+        ({"type": "transfer", "amount": 100.0, "pin": "1234"}, "Операция 1: Не указан получатель перевода"),
+        ({"type": "deposit", "amount": -1.0, "pin": "1234"}, "Операция 1: Сумма должна быть положительной"),
+    ]
+)
+def test_apply_batch_atomic_rollback(bad_operation, error_message):
+    account = create_account(owner=random_owner_name(), pin="1234", initial_balance=1000.0)
+    operations = [
+        {"type": "deposit", "account_id": account.id, "amount": 100.0, "pin": "1234"},
+        {**bad_operation, "account_id": account.id},
+    ]
+    with pytest.raises(ValueError, match=error_message):
+        apply_batch(operations)
+    assert get_account_balance(account_id=account.id, pin="1234") == 1000.0
+
+    delete_account(account_id=account.id, pin="1234")
+
+def test_apply_batch_best_effort():
+    account = create_account(owner=random_owner_name(), pin="1234", initial_balance=1000.0)
+    results = apply_batch([
+        {"type": "deposit", "account_id": account.id, "amount": 100.0, "pin": "1234"},
+        {"type": "withdraw", "account_id": account.id, "amount": 5000.0, "pin": "1234"},
+        {"type": "withdraw", "account_id": 999999, "amount": 10.0, "pin": "1234"},
+        {"type": "withdraw", "account_id": account.id, "amount": 10.0, "pin": "0000"},
+        {"type": "withdraw", "account_id": account.id, "amount": 50.0, "pin": "1234"},
+    ], atomic=False)
+    assert [r["status"] for r in results] == ["ok", "error", "error", "error", "ok"]
+    assert results[1]["detail"] == "Недостаточно средств"
+    assert results[2]["detail"] == "Аккаунт с таким ID не найден"
+    assert results[3]["detail"] == "Неверный PIN-код"
+    assert get_account_balance(account_id=account.id, pin="1234") == 1050.0
+
+    delete_account(account_id=account.id, pin="1234")
+
+
+
+def test_import_accounts_ndjson():
+    existing = create_account(owner=random_owner_name(), pin="1234", initial_balance=0.0)
+    owners = [random_owner_name() for _ in range(3)]
+    lines = [
+        json.dumps({"owner": owners[0], "pin": "1111", "balance": 10.0}),
+        json.dumps({"owner": owners[1], "pin": "2222"}),
+        "",
+        json.dumps({"owner": owners[0], "pin": "3333"}),
+        json.dumps({"owner": existing.owner, "pin": "4444"}),
+        json.dumps({"owner": owners[2], "pin": "12"}),
+        "{not json",
+        json.dumps({"owner": owners[2], "pin": 5555}),
+    ]
+    progress = []
+    rejected = []
+    report = import_accounts(io.StringIO("\n".join(lines)), "ndjson", chunk_size=2,
+                             progress=lambda r: progress.append(r["processed"]), on_reject=rejected.append)
+
+    assert report["processed"] == 7
+    assert report["created"] == 2
+    assert report["rejected"] == 5
+    assert progress == [2, 4, 6, 7]
+    assert [(e["line"], e["reason"]) for e in rejected] == [
+        (4, "Такой аккаунт уже существует"),
+        (5, "Такой аккаунт уже существует"),
+        (6, "PIN должен быть 4 или более символов"),
+        (7, "Строка не является объектом"),
+        (8, "owner и pin должны быть строками"),
+    ]
+
+    created = [(owners[0], "1111", 10.0), (owners[1], "2222", 0.0)]
+    db = SessionLocal()
+    ids = {a.owner: a.id for a in db.query(BankAccount).filter(BankAccount.owner.in_(owners)).all()}
+    db.close()
+    for owner, pin, balance in created:
+        assert get_account_balance(account_id=ids[owner], pin=pin) == balance
+        delete_account(account_id=ids[owner], pin=pin)
+    delete_account(account_id=existing.id, pin="1234")
+
+def test_import_accounts_skips_owner_created_concurrently(monkeypatch):
+    racer, other = random_owner_name(), random_owner_name()
+    hash_pins = importer._hash_pins
+
+    def hash_and_race(pins):
+        # Параллельное создание между проверкой владельцев и вставкой чанка.
+        create_account(owner=racer, pin="9999", initial_balance=1.0)
+        return hash_pins(pins)
+    monkeypatch.setattr(importer, "_hash_pins", hash_and_race)
+    lines = [json.dumps({"owner": owner, "pin": "1234", "balance": 2.0}) for owner in (racer, other)]
+    report = import_accounts(io.StringIO("\n".join(lines)), "ndjson")
+
+    assert (report["created"], report["rejected"]) == (1, 1)
+    assert report["errors"] == [{"line": 1, "owner": racer, "reason": "Такой аккаунт уже существует"}]
+    db = SessionLocal()
+    ids = dict(db.query(BankAccount.owner, BankAccount.id).filter(BankAccount.owner.in_([racer, other])).all())
+    db.close()
+    assert get_account_balance(account_id=ids[racer], pin="9999") == 1.0
+    assert get_account_balance(account_id=ids[other], pin="1234") == 2.0
+    delete_account(account_id=ids[racer], pin="9999")
+    delete_account(account_id=ids[other], pin="1234")
+
+def test_import_accounts_csv():
+    owner = random_owner_name()
+    report = import_accounts(io.StringIO(f"owner,pin,balance\n{owner},1234,5.5\n,1234,1\n"), "csv")
+    assert report["created"] == 1
+    assert report["errors"] == [{"line": 3, "owner": "", "reason": "Имя владельца не может быть пустым"}]
+
+    db = SessionLocal()
+    account_id = db.query(BankAccount.id).filter(BankAccount.owner == owner).scalar()
+    db.close()
+    assert get_account_balance(account_id=account_id, pin="1234") == 5.5
+    delete_account(account_id=account_id, pin="1234")
+
+def test_import_accounts_unknown_format():
+    with pytest.raises(ValueError, match="Неизвестный формат импорта"):
+        import_accounts(io.StringIO(""), "xml")
+
+
+
+def test_get_operations_page(query_budget):
+    account1 = create_account(owner=random_owner_name(), pin="1234", initial_balance=1000.0)
+    account2 = create_account(owner=random_owner_name(), pin="4321", initial_balance=0.0)
+    for amount in (1.0, 2.0, 3.0, 4.0):
+        deposit_to_account(account_id=account1.id, amount=amount, pin="1234")
+    withdraw_from_account(account_id=account1.id, amount=5.0, pin="1234")
+    transfer_money(from_id=account1.id, to_id=account2.id, amount=6.0, pin="1234")
+
+    pages, cursor = [], None
+    while True:
+        # Неполная страница дочитывается из каталога архива — ещё один запрос.
+        with query_budget(3):
+            page = get_operations_page(account_id=account1.id, pin="1234", limit=4, cursor=cursor)
+        pages.append([op["amount"] for op in page["items"]])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert pages == [[-6.0, 5.0, 4.0, 3.0], [2.0, 1.0]]
+
+    page = get_operations_page(account_id=account1.id, pin="1234", op_type="deposit")
+    assert [op["amount"] for op in page["items"]] == [4.0, 3.0, 2.0, 1.0]
+    page = get_operations_page(account_id=account2.id, pin="4321", op_type="transfer_in")
+    assert [(op["type"], op["amount"]) for op in page["items"]] == [(f"Перевод от аккаунта {account1.id}", 6.0)]
+
+    now = datetime.now(timezone.utc)
+    assert get_operations_page(account_id=account1.id, pin="1234", date_to=now - timedelta(days=1))["items"] == []
+    assert len(get_operations_page(account_id=account1.id, pin="1234", date_from=now - timedelta(days=1))["items"]) == 6
+    assert get_operations_page(account_id=account1.id, pin="1234", date_from=now + timedelta(minutes=1))["items"] == []
+
+    delete_account(account_id=account1.id, pin="1234")
+    delete_account(account_id=account2.id, pin="4321")
+
+@pytest.mark.parametrize(
+    "kwargs, error_message",
+    [
+        ({"pin": "0000"}, "Неверный PIN-код"),
+        ({"pin": "1234", "cursor": "not-a-cursor"}, "Некорректный курсор"),
+        ({"pin": "1234", "op_type": "refund"}, "Неизвестный тип операции"),
+        ({"pin": "1234", "limit": 0}, "Размер страницы должен быть положительным"),
+    ]
+)
+def test_get_operations_page_invalid(kwargs, error_message):
+    account = create_account(owner=random_owner_name(), pin="1234", initial_balance=100.0)
+    with pytest.raises(ValueError, match=error_message):
+        get_operations_page(account_id=account.id, **kwargs)
+
+    delete_account(account_id=account.id, pin="1234")
+
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_export_history(compress):
+    account = create_account(owner=random_owner_name(), pin="1234", initial_balance=100.0)
+    deposit_to_account(account_id=account.id, amount=50.0, pin="1234")
+    withdraw_from_account(account_id=account.id, amount=20.0, pin="1234")
+
+    ndjson = b"".join(export_history(account_id=account.id, pin="1234", compress=compress))
+    if compress:
+        ndjson = gzip.decompress(ndjson)
+    rows = [json.loads(line) for line in ndjson.decode().splitlines()]
+    assert [(row["type"], row["amount"]) for row in rows] == [("Пополнение", 50.0), ("Снятие", 20.0)]
+
+    data = b"".join(export_history(account_id=account.id, pin="1234", fmt="csv", compress=compress))
+    if compress:
+        data = gzip.decompress(data)
+    rows = list(csv.reader(io.StringIO(data.decode())))
+    assert rows[0] == ["id", "type", "amount", "timestamp"]
+    assert [row[1:3] for row in rows[1:]] == [["Пополнение", "50.0"], ["Снятие", "20.0"]]
+
+    delete_account(account_id=account.id, pin="1234")
+
+@pytest.mark.parametrize(
+    "kwargs, error_message",
+    [
+        ({"pin": "0000"}, "Неверный PIN-код"),
+        ({"pin": "1234", "fmt": "xml"}, "Неизвестный формат выгрузки"),
+    ]
+)
+def test_export_history_invalid(kwargs, error_message):
+    account = create_account(owner=random_owner_name(), pin="1234", initial_balance=100.0)
+    with pytest.raises(ValueError, match=error_message):
+        export_history(account_id=account.id, **kwargs)
+
+    delete_account(account_id=account.id, pin="1234")
+
+
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE accounts (id INTEGER PRIMARY KEY, owner VARCHAR NOT NULL, balance FLOAT, "
+    "created_at DATETIME, pin VARCHAR NOT NULL)",
+    "CREATE TABLE operations (id INTEGER PRIMARY KEY, type VARCHAR, amount FLOAT, timestamp DATETIME, "
+    "account_id INTEGER REFERENCES accounts (id))",
+]
+
+def _legacy_engine(tmp_path, owners):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        for statement in LEGACY_SCHEMA:
+            conn.exec_driver_sql(statement)
+        for owner in owners:
+            conn.exec_driver_sql("INSERT INTO accounts (owner, balance, pin) VALUES (?, 10.0, 'x')", (owner,))
+        conn.exec_driver_sql(
+            "INSERT INTO operations (type, amount, timestamp, account_id) "
+            "VALUES ('Пополнение', 10.0, '2026-09-01 10:00:00.000000', 1)"
+        )
+    return engine
+
+def test_migrations_upgrade_legacy_database(tmp_path):
+    engine = _legacy_engine(tmp_path, ["alice", "bob"])
+
+    applied = run_migrations(engine)
+    assert [version for version, _ in applied] == [1, 2, 3, 4, 5, 6, 7]
+    assert run_migrations(engine) == []
+
+    indexes = {index["name"]: index for table in ("accounts", "operations") for index in inspect(engine).get_indexes(table)}
+    assert indexes["ix_accounts_owner"]["unique"]
+    assert indexes["ix_operations_account_timestamp_id"]["column_names"] == ["account_id", "timestamp", "id"]
+    with engine.connect() as conn:
+        assert get_schema_version(conn) == LATEST_VERSION
+        assert conn.exec_driver_sql("SELECT owner FROM accounts ORDER BY id").scalars().all() == ["alice", "bob"]
+        assert conn.exec_driver_sql("SELECT COUNT(*) FROM operations").scalar() == 1
+        assert conn.exec_driver_sql("SELECT operation_count FROM accounts ORDER BY id").scalars().all() == [1, 0]
+        assert conn.exec_driver_sql(
+            "SELECT account_id, day, deposit_count, deposit_total FROM daily_aggregates"
+        ).all() == [(1, "2026-09-01", 1, 10.0)]
+    engine.dispose()
+
+def test_migrations_store_version_in_table_outside_sqlite(tmp_path, monkeypatch):
+    # Путь для СУБД без PRAGMA user_version, проверенный на SQLite.
+    monkeypatch.setattr(migrations, "_uses_pragma", lambda conn: False)
+    engine = _legacy_engine(tmp_path, ["alice"])
+
+    assert [version for version, _ in run_migrations(engine)] == [1, 2, 3, 4, 5, 6, 7]
+    assert run_migrations(engine) == []
+    with engine.connect() as conn:
+        assert get_schema_version(conn) == LATEST_VERSION
+        assert conn.exec_driver_sql("SELECT version FROM schema_version").scalars().all() == [LATEST_VERSION]
+        assert conn.exec_driver_sql("PRAGMA user_version").scalar() == 0
+        assert conn.exec_driver_sql("SELECT operation_count FROM accounts").scalars().all() == [1]
+    engine.dispose()
+
+def test_init_schema_skips_create_all_when_current(tmp_path):
+    engine = create_database_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    init_schema(engine)
+    with engine.connect() as conn:
+        assert get_schema_version(conn) == LATEST_VERSION
+    assert set(Base.metadata.tables) <= set(inspect(engine).get_table_names())
+
+    # Версия актуальна — повторный старт не проверяет таблицы, а делает один PRAGMA.
+    with metrics.count_queries() as counter:
+        init_schema(engine)
+    assert counter.count == 1 and "user_version" in counter.statements[0]
+    engine.dispose()
+
+def test_init_schema_without_models_imported(tmp_path):
+    # Отдельный процесс: в тестах app.models уже импортирован и метаданные заполнены.
+    url = f"sqlite:///{tmp_path / 'fresh.db'}"
+    code = f"from app.database import create_database_engine, init_schema; init_schema(create_database_engine({url!r}))"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+    engine = create_database_engine(url)
+    with engine.connect() as conn:
+        assert get_schema_version(conn) == LATEST_VERSION
+    assert set(Base.metadata.tables) <= set(inspect(engine).get_table_names())
+    engine.dispose()
+
+def test_migrations_refuse_duplicate_owners(tmp_path):
+    engine = _legacy_engine(tmp_path, ["alice", "alice"])
+
+    with pytest.raises(RuntimeError, match="повторяются владельцы alice"):
+        run_migrations(engine)
+    with engine.connect() as conn:
+        assert get_schema_version(conn) == 1
+        assert conn.exec_driver_sql("SELECT COUNT(*) FROM accounts").scalar() == 2
+    engine.dispose()
+
+def test_settings_env_overrides_config_file(tmp_path):
+    config_file = tmp_path / "bank.toml"
+    config_file.write_text('[bank]\ndatabase_url = "sqlite:///from_file.db"\npool_size = 3\nsqlite_synchronous = "FULL"\n')
+
+    settings = load_settings({"BANK_CONFIG_FILE": str(config_file), "BANK_POOL_SIZE": "7"})
+    assert settings.database_url == "sqlite:///from_file.db"
+    assert settings.resolved_async_database_url == "sqlite+aiosqlite:///from_file.db"
+    assert settings.pool_size == 7
+    assert settings.sqlite_pragmas()["synchronous"] == "FULL"
+    assert settings.sqlite_pragmas()["journal_mode"] == "WAL"
+    assert load_settings({"BANK_DEBUG_QUERY_HEADER": "yes"}).debug_query_header is True
+    assert load_settings({"BANK_DEBUG_QUERY_HEADER": "0"}).debug_query_header is False
+
+def test_settings_reject_invalid_values(tmp_path):
+    with pytest.raises(ValueError, match="sqlite_journal_mode"):
+        load_settings({"BANK_SQLITE_JOURNAL_MODE": "WAL; DROP TABLE accounts"})
+    with pytest.raises(ValueError, match="логическое"):
+        load_settings({"BANK_DEBUG_QUERY_HEADER": "maybe"})
+    config_file = tmp_path / "bank.json"
+    config_file.write_text(json.dumps({"database_ulr": "sqlite:///typo.db"}))
+    with pytest.raises(ValueError, match="Неизвестные настройки: database_ulr"):
+        load_settings({"BANK_CONFIG_FILE": str(config_file)})
+
+def test_sqlite_pragmas_applied_on_connect():
+    from app.database import engine
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == settings.sqlite_journal_mode.lower()
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == settings.sqlite_busy_timeout
+
+def test_concurrent_money_movement_conserves_total_balance():
+    accounts = [create_account(f"stress_{uuid.uuid4().hex[:10]}", "1234", 100.0) for _ in range(4)]
+    ids = [account.id for account in accounts]
+    for account_id in ids:
+        get_account_balance(account_id, "1234")
+
+    def worker(seed):
+        rng = random.Random(seed)
+        moved = 0.0
+        for _ in range(40):
+            account_id = rng.choice(ids)
+            try:
+                match rng.choice(["deposit", "withdraw", "transfer"]):
+                    case "deposit":
+                        deposit_to_account(account_id, 5.0, "1234")
+                        moved += 5.0
+                    case "withdraw":
+                        withdraw_from_account(account_id, 60.0, "1234")
+                        moved -= 60.0
+                    case "transfer":
+                        transfer_money(account_id, rng.choice(ids), 60.0, "1234")
+            except (ValueError, TransactionConflict):
+                # Недостаточно средств или база занята дольше дедлайна — операция
+                # не выполнена целиком, баланс от неё не меняется.
+                pass
+        return moved
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        moved = sum(pool.map(worker, range(8)))
+
+    db = SessionLocal()
+    try:
+        rows = db.query(BankAccount).filter(BankAccount.id.in_(ids)).all()
+        assert sum(row.balance for row in rows) == pytest.approx(400.0 + moved)
+        for row in rows:
+            assert row.balance >= 0
+            signed = sum(-op.amount if op.type == "Снятие" else op.amount for op in row.operations)
+            assert row.balance == pytest.approx(100.0 + signed)
+    finally:
+        db.close()
+    for account_id in ids:
+        delete_account(account_id, "1234")
+
+def _locked_error():
+    return OperationalError("UPDATE accounts", {}, sqlite3.OperationalError("database is locked"))
+
+def test_transaction_runner_retries_locked_database():
+    runner = TransactionRunner(SessionLocal, base_delay=0.001, deadline=1.0)
+    attempts = []
+
+    def work(db):
+        attempts.append(db)
+        if len(attempts) < 3:
+            raise _locked_error()
+        return "ok"
+
+    assert runner.run("deposit", work) == "ok"
+    assert len(attempts) == 3
+    stats = runner.stats.snapshot()["deposit"]
+    assert stats["calls"] == 1 and stats["retries"] == 2 and stats["max_retries"] == 2
+    assert stats["failures"] == 0 and stats["lock_wait"] > 0
+
+def test_transaction_runner_does_not_retry_other_errors():
+    runner = TransactionRunner(SessionLocal, base_delay=0.001)
+    calls = []
+
+    def work(db):
+        calls.append(1)
+        raise ValueError("Недостаточно средств")
+
+    with pytest.raises(ValueError):
+        runner.run("withdraw", work)
+    with pytest.raises(OperationalError):
+        runner.run("withdraw", lambda db: (calls.append(1), db.execute(text("SELECT * FROM no_such_table"))))
+    assert len(calls) == 2
+
+def test_transaction_runner_gives_up_after_deadline():
+    runner = TransactionRunner(SessionLocal, max_attempts=4, base_delay=0.001)
+
+    def work(db):
+        raise _locked_error()
+
+    with pytest.raises(TransactionConflict) as info:
+        runner.run("transfer", work)
+    assert info.value.attempts == 4
+    assert runner.stats.snapshot()["transfer"]["failures"] == 1
+
+def test_transaction_runner_deadline_counts_driver_lock_wait():
+    runner = TransactionRunner(SessionLocal, base_delay=0.001, max_delay=0.001, deadline=0.5, lock_timeout=0.2)
+    attempts = []
+
+    def work(db):
+        # Попытка висит в busy handler драйвера и только потом получает «database is locked».
+        attempts.append(time.sleep(0.1))
+        raise _locked_error()
+
+    started = time.monotonic()
+    with pytest.raises(TransactionConflict):
+        runner.run("transfer", work)
+    # Следующая попытка не начинается, если с полным busy_timeout не укладывается в срок.
+    assert time.monotonic() - started < 0.5
+    assert len(attempts) == 3
+    assert runner.stats.snapshot()["transfer"]["lock_wait"] >= 0.3
+
+def test_settings_busy_timeout_below_deadline():
+    with pytest.raises(ValueError, match="sqlite_busy_timeout"):
+        replace(settings, sqlite_busy_timeout=5000, tx_deadline=5.0)
+    assert replace(settings, database_url="postgresql://bank", sqlite_busy_timeout=5000, tx_deadline=5.0).lock_timeout == 0.0
+
+def test_transaction_runner_does_not_repeat_committed_work(create_account1):
+    runner = TransactionRunner(SessionLocal, base_delay=0.001)
+
+    def after_commit(db, account):
+        raise _locked_error()
+
+    with pytest.raises(OperationalError):
+        runner.run("deposit", lambda db: workers.deposit(db, create_account1["id"], 10.0, "1234", None), after_commit)
+    assert get_account_balance(create_account1["id"], "1234") == create_account1["balance"] + 10.0
+    assert runner.stats.snapshot()["deposit"]["retries"] == 0
+
+def test_transaction_runner_async_retries():
+    runner = TransactionRunner(SessionLocal, functions.AsyncSessionLocal, base_delay=0.001)
+    attempts = []
+
+    async def work(db):
+        attempts.append(1)
+        if len(attempts) < 2:
+            raise _locked_error()
+        return len(attempts)
+
+    assert asyncio.run(runner.run_async("delete", work)) == 2
+    assert runner.stats.snapshot()["delete"]["retries"] == 1
+
+def _checkpoints(account_id):
+    db = SessionLocal()
+    try:
+        return db.execute(
+            select(BalanceCheckpoint.operation_id, BalanceCheckpoint.balance)
+            .where(BalanceCheckpoint.account_id == account_id).order_by(BalanceCheckpoint.operation_id)
+        ).all()
+    finally:
+        db.close()
+
+def test_balance_as_of_uses_checkpoints(monkeypatch):
+    monkeypatch.setattr(models, "settings", replace(models.settings, checkpoint_interval=3))
+    first = create_account(f"asof_{uuid.uuid4().hex[:10]}", "1234", 100.0)
+    second = create_account(f"asof_{uuid.uuid4().hex[:10]}", "1234", 0.0)
+    moments = [(datetime.now(timezone.utc), 100.0)]
+    steps = [
+        lambda: deposit_to_account(first.id, 50.0, "1234"),
+        lambda: withdraw_from_account(first.id, 30.0, "1234"),
+        lambda: transfer_money(first.id, second.id, 20.0, "1234"),
+        lambda: deposit_to_account(first.id, 5.0, "1234"),
+        lambda: transfer_money(second.id, first.id, 10.0, "1234"),
+        lambda: withdraw_from_account(first.id, 1.0, "1234"),
+        lambda: deposit_to_account(first.id, 7.0, "1234"),
+    ]
+    for step in steps:
+        step()
+        moments.append((datetime.now(timezone.utc), get_account_balance(first.id, "1234")))
+
+    assert len(_checkpoints(first.id)) == 2
+    for moment, expected in moments:
+        assert functions.get_balance_as_of(first.id, moment, "1234") == pytest.approx(expected)
+    assert functions.get_balance_as_of(first.id, moments[0][0] - timedelta(days=1), "1234") == pytest.approx(100.0)
+    assert functions.get_balance_as_of(first.id, None, "1234") == pytest.approx(moments[-1][1])
+    assert asyncio.run(functions.get_balance_as_of_async(first.id, moments[3][0], "1234")) == pytest.approx(moments[3][1])
+
+    incremental = _checkpoints(first.id)
+    assert rebuild_checkpoints([first.id], interval=3) == {"accounts": 1, "checkpoints": 2}
+    assert _checkpoints(first.id) == incremental
+
+    delete_account(first.id, "1234")
+    delete_account(second.id, "1234")
+    assert _checkpoints(first.id) == []
+
+def test_self_transfer_checkpoints_each_leg(monkeypatch):
+    monkeypatch.setattr(models, "settings", replace(models.settings, checkpoint_interval=2))
+    account = create_account(f"asof_{uuid.uuid4().hex[:10]}", "1234", 100.0)
+    deposit_to_account(account.id, 10.0, "1234")
+    transfer_money(account.id, account.id, 50.0, "1234")
+
+    # Вторая операция — списывающая половина: точка должна получить 60, а не 110.
+    assert [balance for _, balance in _checkpoints(account.id)] == [60.0]
+    db = SessionLocal()
+    try:
+        out_leg, in_leg = db.execute(
+            select(Operation.timestamp).where(Operation.account_id == account.id, Operation.amount.in_([-50.0, 50.0]))
+            .order_by(Operation.id)
+        ).scalars().all()
+    finally:
+        db.close()
+    assert functions.get_balance_as_of(account.id, out_leg, "1234") == pytest.approx(60.0)
+    assert functions.get_balance_as_of(account.id, in_leg, "1234") == pytest.approx(110.0)
+
+    delete_account(account.id, "1234")
+
+def test_balance_as_of_without_checkpoints(create_account1):
+    before = datetime.now(timezone.utc)
+    deposit_to_account(create_account1["id"], 40.0, "1234")
+    assert functions.get_balance_as_of(create_account1["id"], before, "1234") == pytest.approx(create_account1["balance"])
+    assert functions.get_balance_as_of(create_account1["id"], datetime.now(timezone.utc), "1234") == pytest.approx(
+        create_account1["balance"] + 40.0
+    )
+
+def _daily_rows(account_id):
+    db = SessionLocal()
+    try:
+        return [
+            (row.day, row.deposit_count, row.deposit_total, row.withdrawal_count, row.withdrawal_total,
+             row.transfer_in_count, row.transfer_in_total, row.transfer_out_count, row.transfer_out_total)
+            for row in db.query(DailyAggregate).filter_by(account_id=account_id).order_by(DailyAggregate.day)
+        ]
+    finally:
+        db.close()
+
+def test_statement_from_daily_aggregates(create_account1, create_account2):
+    first, second = create_account1["id"], create_account2["id"]
+    deposit_to_account(first, 100.0, "1234")
+    deposit_to_account(first, 50.0, "1234")
+    withdraw_from_account(first, 30.0, "1234")
+    transfer_money(first, second, 20.0, "1234")
+    transfer_money(second, first, 5.0, "4321")
+
+    today = datetime.now(timezone.utc).date()
+    statement = functions.get_statement(first, today.strftime("%Y-%m"), "1234")
+    assert statement["operations"] == {
+        "deposit": {"count": 2, "amount": 150.0},
+        "withdrawal": {"count": 1, "amount": 30.0},
+        "transfer_in": {"count": 1, "amount": 5.0},
+        "transfer_out": {"count": 1, "amount": 20.0},
+    }
+    assert statement["total_in"] == 155.0 and statement["total_out"] == 50.0
+    assert statement["opening_balance"] == pytest.approx(create_account1["balance"])
+    assert statement["closing_balance"] == pytest.approx(get_account_balance(first, "1234"))
+    assert statement["date_from"] == today.replace(day=1)
+
+    yearly = asyncio.run(functions.get_statement_async(first, str(today.year), "1234"))
+    assert yearly["operations"] == statement["operations"]
+    empty = functions.get_statement(first, str(today.year - 1), "1234")
+    assert empty["total_in"] == 0 and empty["closing_balance"] == pytest.approx(create_account1["balance"])
+
+    incremental = _daily_rows(first)
+    db = SessionLocal()
+    try:
+        assert rebuild_daily_aggregates(db, [first]) == 1
+        db.commit()
+    finally:
+        db.close()
+    assert _daily_rows(first) == incremental
+
+@pytest.mark.parametrize("period", ["2026-13", "26-09-01-01", "сентябрь", "2026-02-30"])
+def test_statement_invalid_period(create_account1, period):
+    with pytest.raises(ValueError, match="Период указывается"):
+        functions.get_statement(create_account1["id"], period, "1234")
+
+def _analytics_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'analytics.db'}")
+    Base.metadata.create_all(engine)
+    day = datetime(2026, 9, 1, 12, 0)
+    with engine.begin() as conn:
+        conn.execute(insert(BankAccount), [
+            {"id": 1, "owner": "a", "balance": 100.0, "pin": "x"},
+            {"id": 2, "owner": "b", "balance": 50.0, "pin": "x"},
+            {"id": 3, "owner": "c", "balance": 7.0, "pin": "x"},
+        ])
+        conn.execute(insert(Operation), [
+            {"account_id": 1, "type": "Пополнение", "amount": 100.0, "timestamp": day},
+            {"account_id": 1, "type": "Снятие", "amount": 30.0, "timestamp": day},
+            {"account_id": 1, "type": "Перевод на аккаунт 2", "amount": -20.0, "timestamp": day + timedelta(days=1)},
+            {"account_id": 2, "type": "Перевод от аккаунта 1", "amount": 20.0, "timestamp": day + timedelta(days=1)},
+            {"account_id": 2, "type": "Пополнение", "amount": 10.0, "timestamp": day - timedelta(days=200)},
+        ])
+    return engine
+
+def test_analytics_report(tmp_path):
+    engine = _analytics_engine(tmp_path)
+    with engine.connect() as conn:
+        ops = analytics.load_operations(conn, chunk_size=2)
+        assert sorted(ops.account_id.tolist()) == [1, 1, 1, 2, 2]
+        report = analytics.build_report(conn, top=2, dormant_days=90, now=datetime(2026, 10, 1, tzinfo=timezone.utc))
+
+    assert report["operations"] == 5
+    assert report["cash_flow"][-2:] == [
+        {"day": "2026-09-01", "in": 100.0, "out": 30.0, "net": 70.0, "operations": 2},
+        {"day": "2026-09-02", "in": 20.0, "out": 20.0, "net": 0.0, "operations": 2},
+    ]
+    assert report["percentiles"]["deposit"]["p50"] == pytest.approx(55.0)
+    assert report["percentiles"]["withdrawal"] == {"p50": 30.0, "p90": 30.0, "p95": 30.0, "p99": 30.0}
+    assert report["top_accounts"] == [
+        {"account_id": 1, "volume": 150.0, "operations": 3},
+        {"account_id": 2, "volume": 30.0, "operations": 2},
+    ]
+    assert report["dormant"] == {"count": 1, "balance": 7.0, "account_ids": [3]}
+    engine.dispose()
+
+def test_analytics_period_filter(tmp_path):
+    engine = _analytics_engine(tmp_path)
+    with engine.connect() as conn:
+        report = analytics.build_report(
+            conn, date_from=datetime(2026, 9, 2, tzinfo=timezone.utc), now=datetime(2026, 10, 1, tzinfo=timezone.utc)
+        )
+    assert report["operations"] == 2
+    assert [row["day"] for row in report["cash_flow"]] == ["2026-09-02"]
+    assert report["percentiles"]["deposit"]["p50"] is None
+    # Неактивность считается по всей истории, а не по выбранному периоду.
+    assert report["dormant"]["account_ids"] == [3]
+    engine.dispose()
+
+def test_lru_cache_counters(monkeypatch):
+    cache = LRUCache(maxsize=2, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    assert cache.get("missing") is None
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    clock = time.monotonic() + 11
+    monkeypatch.setattr(time, "monotonic", lambda: clock)
+    assert cache.get("a") is None
+    assert cache.stats() == {"size": 1, "maxsize": 2, "hits": 1, "misses": 3, "evictions": 1, "expirations": 1}
+
+@pytest.fixture()
+def fresh_account_cache():
+    backend = LRUCache(maxsize=100, ttl=60)
+    previous = account_cache.backend
+    account_cache.configure(backend)
+    yield backend
+    account_cache.configure(previous)
+
+def test_balance_as_of_ignores_stale_cached_balance(fresh_account_cache, create_account1):
+    before = datetime.now(timezone.utc)
+    deposit_to_account(create_account1["id"], 40.0, "1234")
+    cached = functions.get_account_by_id(create_account1["id"], "1234")
+    # Снимок, отставший от базы (например, запись в другом процессе).
+    account_cache.put(AccountSnapshot(cached.id, cached.owner, 0.0, cached.pin_hash), account_cache.generation())
+    assert functions.get_balance_as_of(create_account1["id"], before, "1234") == pytest.approx(create_account1["balance"])
+
+def test_account_cache_read_through_and_invalidation(fresh_account_cache, create_account1, create_account2):
+    first, second = create_account1["id"], create_account2["id"]
+    assert get_account_balance(first, "1234") == 1000.0
+    assert get_account_by_id(first, "1234").owner == create_account1["name"]
+    assert fresh_account_cache.stats()["misses"] == 1 and fresh_account_cache.stats()["hits"] == 1
+
+    with pytest.raises(ValueError, match="Неверный PIN-код"):
+        get_account_balance(first, "0000")
+
+    deposit_to_account(first, 10.0, "1234")
+    assert get_account_balance(first, "1234") == 1010.0
+    withdraw_from_account(first, 5.0, "1234")
+    assert asyncio.run(functions.get_account_balance_async(first, "1234")) == 1005.0
+    get_account_balance(second, "4321")
+    asyncio.run(functions.transfer_money_async(first, second, 5.0, "1234"))
+    assert get_account_balance(first, "1234") == 1000.0
+    assert get_account_balance(second, "4321") == 1005.0
+    apply_batch([{"type": "deposit", "account_id": second, "amount": 1.0, "pin": "4321"}])
+    assert get_account_balance(second, "4321") == 1006.0
+
+    delete_account(first, "1234")
+    with pytest.raises(ValueError, match="Аккаунт с таким ID не найден"):
+        get_account_balance(first, "1234")
+
+def test_account_cache_size_depends_on_workers():
+    assert load_settings({}).resolved_account_cache_size == (10000 if settings.workers == 1 else 0)
+    assert load_settings({"BANK_WORKERS": "1"}).resolved_account_cache_size == 10000
+    # Кэш процесса не видит записей других воркеров — по умолчанию он выключен.
+    workers = {"BANK_WORKERS": "4", "BANK_SECRET_KEY": "shared"}
+    assert load_settings(workers).resolved_account_cache_size == 0
+    assert load_settings({**workers, "BANK_ACCOUNT_CACHE_SIZE": "500"}).resolved_account_cache_size == 500
+    assert load_settings({"BANK_ACCOUNT_CACHE_SIZE": "0"}).resolved_account_cache_size == 0
+    with pytest.raises(ValueError, match="workers"):
+        load_settings({"BANK_WORKERS": "0"})
+
+def test_several_workers_require_secret_key():
+    # Случайный ключ у каждого процесса — токены одного воркера отклонялись бы другими.
+    with pytest.raises(ValueError, match="BANK_SECRET_KEY"):
+        load_settings({"BANK_WORKERS": "2"})
+    assert load_settings({"BANK_WORKERS": "2", "BANK_SECRET_KEY": "shared"}).secret_key == "shared"
+    assert load_settings({"BANK_WORKERS": "1"}).secret_key == ""
+
+def test_account_cache_skips_stale_snapshot(fresh_account_cache, create_account1):
+    generation = account_cache.generation()
+    stale = AccountSnapshot(create_account1["id"], create_account1["name"], 1.0, "x")
+    account_cache.invalidate(create_account1["id"])
+    account_cache.put(stale, generation)
+    assert account_cache.get(create_account1["id"]) is None
+
+def test_account_cache_custom_backend(create_account1):
+    class DictBackend(CacheBackend):
+        def __init__(self):
+            self.data = {}
+        def get(self, key, default=None):
+            return self.data.get(key, default)
+        def set(self, key, value):
+            self.data[key] = value
+        def pop(self, key):
+            self.data.pop(key, None)
+        def clear(self):
+            self.data.clear()
+
+    backend = DictBackend()
+    previous = account_cache.backend
+    account_cache.configure(backend)
+    try:
+        get_account_balance(create_account1["id"], "1234")
+        assert backend.data[create_account1["id"]].balance == 1000.0
+        deposit_to_account(create_account1["id"], 1.0, "1234")
+        assert create_account1["id"] not in backend.data
+    finally:
+        account_cache.configure(previous)
+
+def test_account_snapshot_json_is_built_once():
+    snapshot = AccountSnapshot(7, "Иван", 10, "hash")
+    body = snapshot.json()
+    assert json.loads(body) == {"id": 7, "owner": "Иван", "balance": 10.0}
+    assert b"hash" not in body
+    assert snapshot.json() is body
+
+def test_read_paths_do_not_load_orm_accounts(create_account1):
+    db = SessionLocal()
+    try:
+        functions._get_history(db, create_account1["id"], "1234", None)
+        functions._get_operations_page(db, create_account1["id"], "1234", None)
+        assert functions._get_balance_as_of(db, create_account1["id"], "1234", None) == 1000.0
+        assert not any(isinstance(obj, BankAccount) for obj in db.identity_map.values())
+    finally:
+        db.close()
+
+def test_metrics_registry_render_and_series_cap(monkeypatch):
+    registry = metrics.Registry()
+    requests = registry.counter("test_requests", "Запросы", ("route",))
+    latency = registry.histogram("test_latency_seconds", "Задержка", buckets=(0.1, 1.0))
+    monkeypatch.setattr(metrics, "MAX_SERIES", 2)
+    for route in ("/a", "/b", "/c", "/d"):
+        requests.inc(route=route)
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5.0)
+
+    lines = registry.render().splitlines()
+    assert "# TYPE test_requests_total counter" in lines
+    assert 'test_requests_total{route="other"} 2.0' in lines
+    assert 'test_latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{le="1.0"} 2' in lines
+    assert 'test_latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert "test_latency_seconds_count 3" in lines
+
+def test_metrics_request_phases(create_account1):
+    phases = metrics.RequestPhases()
+    token = metrics._phases.set(phases)
+    try:
+        auth.invalidate(create_account1["id"])
+        deposit_to_account(create_account1["id"], 1.0, "1234")
+    finally:
+        metrics._phases.reset(token)
+    assert phases.db_queries >= 2
+    assert phases.db > 0 and phases.pin > 0 and phases.commit > 0
+
+def test_query_budget_reports_statements(create_account1):
+    with pytest.raises(metrics.QueryBudgetExceeded) as error:
+        with metrics.query_budget(0):
+            asyncio.run(functions.get_history_async(create_account1["id"], "1234"))
+    assert error.value.counter.count >= 1
+    assert "допустимо: 0" in str(error.value) and "FROM operations" in str(error.value)
+
+    with metrics.count_queries() as outer:
+        with metrics.count_queries() as inner:
+            get_history(create_account1["id"], "1234")
+        get_history(create_account1["id"], "1234")
+    # Повторный вызов берёт снимок счёта из кэша: остаются каталог архива и операции.
+    assert outer.count == inner.count + 2
+
+def _cross_shard_pair(router):
+    first = router.create_account(random_owner_name(), "1234", 1000.0)
+    while True:
+        second = router.create_account(random_owner_name(), "4321", 1000.0)
+        if router.shard_for(second.id) is not router.shard_for(first.id):
+            return first, second
+
+def _shard_transfers(router, account_id):
+    return router.shard_for(account_id).read(lambda db: db.execute(
+        select(models.ShardTransfer.role, models.ShardTransfer.state).where(models.ShardTransfer.account_id == account_id)
+    ).all())
+
+def test_sharding_routes_accounts_to_owning_shard(shard_router):
+    accounts = [shard_router.create_account(f"owner_{index}", "1234", 100.0) for index in range(12)]
+    for account in accounts:
+        shard = shard_router.shard_for(account.id)
+        assert shard is shard_router.shard_for_owner(account.owner)
+        assert shard.read(lambda db: db.get(BankAccount, account.id)) is not None
+        assert sum(other.read(lambda db: db.get(BankAccount, account.id) is not None) for other in shard_router.shards) == 1
+    assert len({shard_router.shard_for(account.id).index for account in accounts}) == 3
+    with pytest.raises(ValueError, match="Такой аккаунт уже существует"):
+        shard_router.create_account("owner_0", "1234")
+
+    account = accounts[0]
+    assert shard_router.deposit_to_account(account.id, 50.0, pin="1234").balance == 150.0
+    assert shard_router.withdraw_from_account(account.id, 30.0, pin="1234").balance == 120.0
+    assert shard_router.get_account_balance(account.id, pin="1234") == 120.0
+    with pytest.raises(ValueError, match="Неверный PIN-код"):
+        shard_router.get_account_balance(account.id, pin="0000")
+    shard_router.delete_account(account.id, pin="1234")
+    with pytest.raises(ValueError, match="Аккаунт с таким ID не найден"):
+        shard_router.get_account_balance(account.id, pin="1234")
+
+def test_sharding_cross_shard_transfer(shard_router):
+    source, target = _cross_shard_pair(shard_router)
+
+    to_account, from_account = shard_router.transfer_money(source.id, target.id, 300.0, pin="1234")
+    assert (from_account.balance, to_account.balance) == (700.0, 1300.0)
+    assert shard_router.get_history(target.id, pin="4321")[0][:2] == (f"Перевод от аккаунта {source.id}", 300.0)
+    assert _shard_transfers(shard_router, source.id) == [("source", "committed")]
+    assert _shard_transfers(shard_router, target.id) == [("target", "committed")]
+
+    # Списание не прошло — у получателя запись отменена, балансы не изменились.
+    with pytest.raises(ValueError, match="Недостаточно средств"):
+        shard_router.transfer_money(source.id, target.id, 5000.0, pin="1234")
+    assert sorted(_shard_transfers(shard_router, target.id)) == [("target", "aborted"), ("target", "committed")]
+    with pytest.raises(ValueError, match="Неверный PIN-код"):
+        shard_router.transfer_money(source.id, target.id, 10.0, pin="0000")
+    with pytest.raises(ValueError, match="Аккаунт с ID 999999 не найден"):
+        shard_router.transfer_money(source.id, 999999, 10.0, pin="1234")
+    assert shard_router.get_account_balance(source.id, pin="1234") == 700.0
+    assert shard_router.get_account_balance(target.id, pin="4321") == 1300.0
+
+def test_sharding_recovers_in_doubt_transfers(shard_router, shard_urls):
+    source, target = _cross_shard_pair(shard_router)
+    source_shard, target_shard = shard_router.shard_for(source.id), shard_router.shard_for(target.id)
+    # «Падение» после списания, до зачисления, и падение до списания.
+    for transfer_id in ("decided", "undecided"):
+        target_shard.run("prepare", lambda db: sharding._prepare_target(db, transfer_id, source.id, target.id, 100.0))
+    source_shard.run("commit", lambda db: sharding._commit_source(db, "decided", source.id, target.id, 100.0, "1234", None))
+    with pytest.raises(ValueError, match="незавершённые переводы"):
+        shard_router.delete_account(target.id, pin="4321")
+
+    restarted = ShardRouter(shard_urls)
+    try:
+        assert restarted.init() == {"committed": 1, "aborted": 1}
+        assert restarted.init() == {"committed": 0, "aborted": 0}
+        assert restarted.get_account_balance(source.id, pin="1234") == 900.0
+        assert restarted.get_account_balance(target.id, pin="4321") == 1100.0
+        assert sorted(_shard_transfers(restarted, target.id)) == [("target", "aborted"), ("target", "committed")]
+        restarted.delete_account(target.id, pin="4321")
+    finally:
+        restarted.dispose()
+
+def test_functions_use_configured_shard_router(shard_router):
+    source, target = _cross_shard_pair(shard_router)
+    functions.configure_sharding(shard_router)
+    try:
+        to_account, from_account = functions.transfer_money(source.id, target.id, 300.0, pin="1234")
+        assert (from_account.balance, to_account.balance) == (700.0, 1300.0)
+        assert asyncio.run(functions.deposit_to_account_async(source.id, 50.0, pin="1234")).balance == 750.0
+        token, _ = functions.create_session(target.id, "4321")
+        assert functions.get_account_by_id(target.id, token=token).balance == 1300.0
+        assert asyncio.run(functions.get_balance_as_of_async(source.id, pin="1234")) == 750.0
+        with pytest.raises(ValueError, match="не поддерживается при шардировании"):
+            functions.deposit_to_account(source.id, 1.0, pin="1234", idempotency_key=uuid.uuid4().hex)
+        with pytest.raises(ValueError, match="не поддерживается при шардировании"):
+            asyncio.run(functions.get_statement_async(source.id, "2024-01", pin="1234"))
+    finally:
+        functions.configure_sharding(None)
+    assert shard_router.get_account_balance(source.id, pin="1234") == 750.0
+
+def _age_operations(account_ids, days):
+    """Сдвигает все операции и дневные обороты счетов на days дней в прошлое."""
+    db = SessionLocal()
+    try:
+        for account_id in account_ids:
+            for operation in db.query(Operation).filter_by(account_id=account_id):
+                operation.timestamp -= timedelta(days=days)
+        db.flush()
+        rebuild_daily_aggregates(db, account_ids)
+        db.commit()
+    finally:
+        db.close()
+
+def _all_pages(account_id, limit, **filters):
+    pages, cursor = [], None
+    while True:
+        page = get_operations_page(account_id=account_id, pin="1234", limit=limit, cursor=cursor, **filters)
+        pages.append(page["items"])
+        if (cursor := page["next_cursor"]) is None:
+            return pages
+
+def _archive_snapshot(account_id, moments):
+    return {
+        "history": get_history(account_id=account_id, pin="1234"),
+        "pages": _all_pages(account_id, 2),
+        "window": _all_pages(account_id, 1, date_from=moments[1], date_to=moments[3]),
+        "deposits": get_operations_page(account_id=account_id, pin="1234", op_type="deposit")["items"],
+        "withdrawals": get_operations_page(account_id=account_id, pin="1234", op_type="withdrawal")["items"],
+        "export": b"".join(export_history(account_id=account_id, pin="1234", fmt="csv")),
+        "export_async": asyncio.run(_collect_async(functions.export_history_async(account_id, pin="1234"))),
+    }
+
+async def _collect_async(stream):
+    return b"".join([chunk async for chunk in await stream])
+
+def test_archive_keeps_history_pages_and_balances(monkeypatch, tmp_path):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    first = create_account(random_owner_name(), "1234", 100.0)
+    second = create_account(random_owner_name(), "4321", 0.0)
+    deposit_to_account(first.id, 50.0, "1234")
+    withdraw_from_account(first.id, 30.0, "1234")
+    transfer_money(first.id, second.id, 20.0, "1234")
+    deposit_to_account(first.id, 5.0, "1234")
+    _age_operations([first.id, second.id], 200)
+    deposit_to_account(first.id, 7.0, "1234")
+
+    db = SessionLocal()
+    try:
+        moments = [row.timestamp for row in db.query(Operation).filter_by(account_id=first.id).order_by(Operation.id)]
+    finally:
+        db.close()
+    balances = [functions.get_balance_as_of(first.id, moment, "1234") for moment in moments]
+    before = _archive_snapshot(first.id, moments)
+    assert len(before["window"]) == 2
+
+    cutoff = archive.cutoff_for(90)
+    report = archive.archive_operations(cutoff=cutoff)
+    assert report["operations"] >= 5 and report["segments"]
+    assert sorted(os.listdir(tmp_path)) == sorted(report["segments"])
+    db = SessionLocal()
+    try:
+        assert db.query(Operation).filter_by(account_id=first.id).count() == 1
+        assert archive.archived_until(db) >= cutoff
+    finally:
+        db.close()
+
+    assert _archive_snapshot(first.id, moments) == before
+
+    # Асинхронный экспорт читает и распаковывает блоки не в потоке цикла событий.
+    read_block, threads = archive.read_block, []
+
+    def recording_read_block(*args):
+        threads.append(threading.current_thread())
+        return read_block(*args)
+    monkeypatch.setattr(archive, "read_block", recording_read_block)
+    assert asyncio.run(_collect_async(functions.export_history_async(first.id, pin="1234"))) == before["export_async"]
+    assert threads and threading.main_thread() not in threads
+    assert [functions.get_balance_as_of(first.id, moment, "1234") for moment in moments] == pytest.approx(balances)
+    assert functions.get_balance_as_of(first.id, moments[0] - timedelta(days=1), "1234") == pytest.approx(100.0)
+    assert get_history(second.id, "4321")[0][:2] == (f"Перевод от аккаунта {first.id}", 20.0)
+    # Счётчик операций учитывает архив: пересборка точек его не меняет.
+    assert rebuild_checkpoints([first.id]) == {"accounts": 1, "checkpoints": 0}
+    db = SessionLocal()
+    try:
+        assert db.get(BankAccount, first.id).operation_count == 5
+    finally:
+        db.close()
+
+    # Повторный запуск с той же границей ничего не переносит.
+    assert archive.archive_operations(cutoff=cutoff)["operations"] == 0
+
+    delete_account(first.id, "1234")
+    delete_account(second.id, "4321")
+
+def test_sharding_recovery_blocks_late_commit(shard_router):
+    source, target = _cross_shard_pair(shard_router)
+    source_shard, target_shard = shard_router.shard_for(source.id), shard_router.shard_for(target.id)
+    target_shard.run("prepare", lambda db: sharding._prepare_target(db, "late", source.id, target.id, 100.0))
+    # Восстановление рядом с живым переводом: решение aborted пишется раньше списания.
+    assert shard_router.recover() == {"committed": 0, "aborted": 1}
+    with pytest.raises(IntegrityError):
+        source_shard.run("commit", lambda db: sharding._commit_source(db, "late", source.id, target.id, 100.0, "1234", None))
+    assert shard_router.get_account_balance(source.id, pin="1234") == 1000.0
+    assert shard_router.get_account_balance(target.id, pin="4321") == 1000.0
+
+def test_sharding_transfer_survives_error_after_source_commit(shard_router, monkeypatch):
+    source, target = _cross_shard_pair(shard_router)
+    run = sharding.Shard.run
+
+    def flaky(shard, name, work, after_commit=None):
+        result = run(shard, name, work, after_commit)
+        if name == "transfer_commit":
+            raise RuntimeError("соединение оборвалось после коммита")
+        return result
+
+    monkeypatch.setattr(sharding.Shard, "run", flaky)
+    to_account, from_account = shard_router.transfer_money(source.id, target.id, 300.0, pin="1234")
+    assert (from_account.balance, to_account.balance) == (700.0, 1300.0)
+    assert _shard_transfers(shard_router, target.id) == [("target", "committed")]
+
+def test_archive_page_reads_only_needed_blocks(monkeypatch, tmp_path):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    account = create_account(random_owner_name(), "1234", 100.0)
+    deposit_to_account(account.id, 0.5, "1234")
+    deposit_to_account(account.id, 1.0, "1234")
+    _age_operations([account.id], 300)
+    archive.archive_operations(horizon_days=250)
+    deposit_to_account(account.id, 2.0, "1234")
+    deposit_to_account(account.id, 3.0, "1234")
+    _age_operations([account.id], 200)
+    archive.archive_operations(horizon_days=150)
+
+    reads = []
+    read_block = archive.read_block
+    monkeypatch.setattr(archive, "read_block", lambda *args: reads.append(args[0]) or read_block(*args))
+    db = SessionLocal()
+    try:
+        everything = archive.page(db, account.id, limit=100)
+        assert [row.amount for row in everything] == [3.0, 2.0, 1.0, 0.5]
+        assert list(archive.operations(db, account.id)) == everything[::-1]
+        # Страница наполняется из младшего сегмента, а курсор в старшем отсекает младший по каталогу.
+        reads.clear()
+        assert archive.page(db, account.id, limit=1) == everything[:1]
+        assert len(reads) == 1
+        reads.clear()
+        oldest = everything[2]
+        assert archive.page(db, account.id, limit=10, before=(oldest.timestamp, oldest.id)) == everything[3:]
+        assert len(reads) == 1
+    finally:
+        db.close()
+
+    delete_account(account.id, "1234")
+
+def _own_errors(report, segments, account_ids):
+    marks = list(segments) + [f"счёт {account_id}," for account_id in account_ids]
+    return [error for error in report["errors"] if any(mark in error for mark in marks)]
+
+def test_archive_verify_detects_tampering(monkeypatch, tmp_path):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    account = create_account(random_owner_name(), "1234", 100.0)
+    deposit_to_account(account.id, 10.0, "1234")
+    withdraw_from_account(account.id, 4.0, "1234")
+    _age_operations([account.id], 200)
+    segments = archive.archive_operations(horizon_days=90)["segments"]
+    (tmp_path / "leftover.seg.tmp").write_bytes(b"")
+
+    db = SessionLocal()
+    try:
+        report = archive.verify(db)
+        assert _own_errors(report, segments, [account.id]) == []
+        assert report["orphans"] == ["leftover.seg.tmp"]
+
+        index = archive.read_index(str(tmp_path / segments[0]))["accounts"][str(account.id)]
+        assert index["operations"] == 2 and index["total"] == pytest.approx(6.0)
+
+        db.query(DailyAggregate).filter_by(account_id=account.id).delete()
+        db.commit()
+        assert _own_errors(archive.verify(db), segments, [account.id]) == [
+            f"счёт {account.id}, {(datetime.now(timezone.utc) - timedelta(days=200)).date()}: "
+            f"обороты {kind} не совпадают с архивом" for kind in ("deposit", "withdrawal")
+        ]
+
+        with open(tmp_path / segments[0], "r+b") as file:
+            file.seek(len(archive.MAGIC))
+            file.write(b"\x00")
+        assert _own_errors(archive.verify(db), segments, [account.id]) == [
+            f"{segments[0]}: контрольная сумма не совпадает"
+        ] + _own_errors(archive.verify(db), [], [account.id])
+    finally:
+        db.close()
+
+    delete_account(account.id, "1234")
+
+def test_archive_verify_skips_deleted_accounts(monkeypatch, tmp_path):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    first = create_account(random_owner_name(), "1234", 100.0)
+    second = create_account(random_owner_name(), "1234", 50.0)
+    deposit_to_account(first.id, 10.0, "1234")
+    transfer_money(first.id, second.id, 5.0, "1234")
+    _age_operations([first.id, second.id], 200)
+    segments = archive.archive_operations(horizon_days=90)["segments"]
+    # Удаление счёта убирает его каталог и обороты, а блок в неизменяемом файле остаётся.
+    delete_account(first.id, "1234")
+
+    db = SessionLocal()
+    try:
+        assert _own_errors(archive.verify(db), segments, [first.id, second.id]) == []
+        db.query(ArchivedAccount).filter_by(account_id=second.id).delete()
+        db.commit()
+        assert f"{segments[0]}: счета в индексе файла и в каталоге различаются" in archive.verify(db)["errors"]
+    finally:
+        db.close()
+
+    delete_account(second.id, "1234")
+
+@pytest.mark.parametrize(
+    "command, error_message",
+    [
+        ({"op": "deposit", "id": [1], "amount": 10, "pin": "1234"}, "Поле id: ожидается число"),
+        ({"op": "deposit", "id": 1, "amount": "x", "pin": "1234"}, "Поле amount: ожидается число"),
+        ({"op": "deposit", "id": 1, "amount": True, "pin": "1234"}, "Поле amount: ожидается число"),
+        ({"op": "withdraw", "id": 1, "amount": "nan", "pin": "1234"}, "Поле amount: ожидается число"),
+        ({"op": "transfer", "id": 1, "to": 2.5, "amount": 1, "pin": "1234"}, "Поле to: ожидается целое число"),
+        ({"op": "create", "owner": "x" * 8, "pin": "1234", "balance": {}}, "Поле balance: ожидается число"),
+        ({"op": "create", "owner": 42, "pin": "1234"}, "Поле owner: ожидается строка"),
+    ]
+)
+def test_old_main_script_rejects_bad_field_types(command, error_message):
+    account = create_account(random_owner_name(), "1234", 100.0)
+    lines = [
+        json.dumps(command),
+        # Число строкой приводится к типу поля.
+        json.dumps({"op": "deposit", "id": str(account.id), "amount": "5", "pin": "1234"}),
+    ]
+    output = io.StringIO()
+    summary = old_main.run_script(lines, output, batch_size=10, pin_workers=1)
+    bad, good = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert (bad["status"], bad["detail"]) == ("error", error_message)
+    assert good["status"] == "ok" and good["result"]["balance"] == 105.0
+    assert (summary["ok"], summary["errors"]) == (1, 1)
+
+    delete_account(account.id, "1234")
+
+
+def test_old_main_script_mode():
+    first, second = random_owner_name(), random_owner_name()
+    lines = [
+        json.dumps({"op": "create", "owner": first, "pin": "1234", "balance": 100}),
+        json.dumps({"op": "create", "owner": second, "pin": 4321}),
+        "not json",
+        "",
+        json.dumps({"op": "create", "owner": first, "pin": "1234"}),
+        json.dumps({"op": "create", "owner": random_owner_name(), "pin": "12"}),
+        json.dumps({"op": "refund", "id": 1}),
+        json.dumps({"op": "deposit", "id": 1}),
+    ]
+    output = io.StringIO()
+    summary = old_main.run_script(lines, output, batch_size=3, pin_workers=2)
+    created = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [(row["line"], row["status"]) for row in created] == [
+        (1, "ok"), (2, "ok"), (3, "error"), (5, "error"), (6, "error"), (7, "error"), (8, "error")
+    ]
+    assert created[3]["detail"] == "Такой аккаунт уже существует"
+    assert created[5]["detail"] == "Неизвестная команда: refund"
+    assert created[6]["detail"] == "Не хватает полей: amount, pin"
+    first_id, second_id = created[0]["result"]["id"], created[1]["result"]["id"]
+
+    lines = [
+        json.dumps({"op": "deposit", "id": first_id, "amount": 50, "pin": "1234"}),
+        json.dumps({"op": "transfer", "id": first_id, "to": second_id, "amount": 30, "pin": "1234"}),
+        json.dumps({"op": "balance", "id": second_id, "pin": "4321"}),
+        json.dumps({"op": "withdraw", "id": first_id, "amount": 1000, "pin": "1234"}),
+        json.dumps({"op": "deposit", "id": first_id, "amount": 5, "pin": "0000"}),
+        json.dumps({"op": "history", "id": first_id, "pin": "1234"}),
+        json.dumps({"op": "delete", "id": second_id, "pin": "4321"}),
+        json.dumps({"op": "info", "id": second_id, "pin": "4321"}),
+    ]
+    output = io.StringIO()
+    summary = old_main.run_script(lines, output, batch_size=100, pin_workers=2)
+    rows = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [row["status"] for row in rows] == ["ok", "ok", "ok", "error", "error", "ok", "ok", "error"]
+    assert rows[1]["result"][1]["balance"] == 120.0
+    assert rows[2]["result"] == {"id": second_id, "balance": 30.0}
+    assert (rows[3]["detail"], rows[4]["detail"]) == ("Недостаточно средств", "Неверный PIN-код")
+    assert [(op, amount) for op, amount, _ in rows[5]["result"]] == [
+        ("Пополнение", 50.0), (f"Перевод на аккаунт {second_id}", -30.0)
+    ]
+    assert rows[7]["detail"] == "Аккаунт с таким ID не найден"
+    # Все команды — одна транзакция.
+    assert {key: summary[key] for key in ("commands", "ok", "errors", "batches")} == {
+        "commands": 8, "ok": 5, "errors": 3, "batches": 1
+    }
+    assert summary["per_s"] > 0 and summary["p99_ms"] >= summary["p50_ms"] > 0
+    assert get_account_balance(first_id, "1234") == 120.0
+
+    delete_account(first_id, "1234")
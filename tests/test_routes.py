@@ -1,7 +1,18 @@
 from conftest import random_owner_name
 from fastapi.testclient import TestClient
-from app.main import app
+from app.main import app, create_app
+from app import auth, functions, metrics
+from app.transactions import TransactionConflict
+from app.config import settings
+from app.database import SessionLocal
+from app.models import BankAccount
 import pytest
+import gzip
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime, timezone
 
 client = TestClient(app)
 
@@ -24,6 +35,11 @@ def test_create_account():
     
     client.delete(f"/accounts/delete/{account_id}?pin={pin}")
 
+def test_create_account_duplicate_owner(create_account1):
+    response = client.post("/accounts/", json={"owner": create_account1['name'], "pin": "1234", "balance": 0.0})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Такой аккаунт уже существует"
+
 @pytest.mark.parametrize("payload, expected_status, expected_detail", [
     ({"pin": "1234", "balance": 1000.0}, 422, None),
     ({"owner": "placeholder", "balance": 1000.0}, 422, None),
@@ -41,12 +57,15 @@ def test_create_account_invalid(payload, expected_status, expected_detail):
         assert response.json()["detail"] == expected_detail
     
 
-def test_get_account_by_id(create_account1):
+def test_get_account_by_id(create_account1, query_count):
     response = client.get(f"/accounts/{create_account1['id']}?pin={create_account1['pin']}")
     assert response.status_code == 200
+    assert query_count(response) <= 1
     data = response.json()
     assert data['owner'] == create_account1['name']
     assert data['balance'] == create_account1['balance']
+    assert data == {"id": create_account1['id'], "owner": create_account1['name'], "balance": create_account1['balance']}
+    assert response.headers["content-type"] == "application/json"
 
 @pytest.mark.parametrize("get_url, expected_status, expected_detail", [
     (lambda acc: f"/accounts/{acc['id']}?pin=0000", 400, "Неверный PIN-код"),
@@ -60,12 +79,13 @@ def test_get_account_by_id_negative(create_account1, get_url, expected_status, e
         assert response.json()["detail"] == expected_detail
         
 
-def test_deposit(create_account1):
+def test_deposit(create_account1, query_count):
     response = client.post(f"/accounts/{create_account1['id']}/deposit", json={
         "amount": 1000.0,
         "pin": create_account1['pin']
     })
     assert response.status_code == 200
+    assert query_count(response) <= 6
     data = response.json()
     assert data['balance'] == create_account1['balance'] + 1000.0
     
@@ -83,6 +103,22 @@ def test_deposit_invalid(create_account1, payload, expected_status, expected_det
     if expected_detail:
         assert response.json()['detail'] == expected_detail
         
+def test_deposit_idempotency_key(create_account1, query_count):
+    url = f"/accounts/{create_account1['id']}/deposit"
+    payload = {"amount": 100.0, "pin": create_account1['pin']}
+    headers = {"Idempotency-Key": "deposit-1"}
+
+    first = client.post(url, json=payload, headers=headers)
+    retry = client.post(url, json=payload, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.json()['balance'] == create_account1['balance'] + 100.0
+    assert query_count(retry) <= 1
+
+    conflict = client.post(url, json={**payload, "amount": 200.0}, headers=headers)
+    assert conflict.status_code == 400
+    assert conflict.json()['detail'] == "Idempotency-Key уже использован для другого запроса"
+
 def test_deposit_nonexistent_account():
     response = client.post("/accounts/99999/deposit", json={
         "amount": 1000.0,
@@ -124,12 +160,13 @@ def test_withdraw_nonexistent_account():
     assert response.json()['detail'] == "Аккаунт с таким ID не найден"
     
     
-def test_transfer(create_account1, create_account2):
+def test_transfer(create_account1, create_account2, query_count):
     response = client.post(f"/accounts/{create_account1['id']}/{create_account2['id']}/transfer", json={
         "amount": 500.0,
         "pin": create_account1['pin']
     })
     assert response.status_code == 200
+    assert query_count(response) <= 9
     data1, data2 = response.json()
     assert data1['balance'] == create_account1['balance'] - 500.0
     assert data2['balance'] == create_account2['balance'] + 500.0
@@ -184,4 +221,294 @@ def test_delete_invalid_pin(create_account1):
 def test_delete_nonexistent_account():
     response = client.delete("/accounts/delete/412584?pin=1234")
     assert response.status_code == 400
-    assert response.json()['detail'] == "Аккаунт с таким ID не найден"
\ No newline at end of file
+    assert response.json()['detail'] == "Аккаунт с таким ID не найден"
+
+
+def test_session_token(create_account1):
+    response = client.post(f"/accounts/{create_account1['id']}/session", json={"pin": create_account1['pin']})
+    assert response.status_code == 200
+    token = response.json()['token']
+
+    response = client.post(f"/accounts/{create_account1['id']}/deposit", json={"amount": 100.0},
+                           headers={"X-Session-Token": token})
+    assert response.status_code == 200
+    assert response.json()['balance'] == create_account1['balance'] + 100.0
+
+    response = client.get(f"/accounts/{create_account1['id']}", headers={"X-Session-Token": token})
+    assert response.status_code == 200
+    assert response.json()['balance'] == create_account1['balance'] + 100.0
+
+@pytest.mark.parametrize("request_kwargs, expected_status, expected_detail", [
+    ({"json": {"pin": "0000"}}, 400, "Неверный PIN-код"),
+    ({"json": {}}, 422, None),
+])
+def test_session_token_invalid(create_account1, request_kwargs, expected_status, expected_detail):
+    response = client.post(f"/accounts/{create_account1['id']}/session", **request_kwargs)
+    assert response.status_code == expected_status
+    if expected_detail:
+        assert response.json()['detail'] == expected_detail
+
+def test_invalid_session_token(create_account1):
+    response = client.get(f"/accounts/{create_account1['id']}", headers={"X-Session-Token": "bad"})
+    assert response.status_code == 400
+    assert response.json()['detail'] == "Недействительный или просроченный токен сессии"
+
+
+@pytest.mark.parametrize("pin_workers", [0, 2])
+def test_deposit_pin_executor_modes(create_account1, pin_workers):
+    previous = auth.PIN_WORKERS
+    auth.configure_executor(pin_workers)
+    try:
+        response = client.post(f"/accounts/{create_account1['id']}/deposit", json={
+            "amount": 100.0,
+            "pin": create_account1['pin']
+        })
+        assert response.status_code == 200
+        assert response.json() == {
+            "id": create_account1['id'],
+            "owner": create_account1['name'],
+            "balance": create_account1['balance'] + 100.0
+        }
+        response = client.post(f"/accounts/{create_account1['id']}/deposit", json={"amount": 100.0, "pin": "0000"})
+        assert response.status_code == 400
+        assert response.json()['detail'] == "Неверный PIN-код"
+    finally:
+        auth.configure_executor(previous)
+
+
+def test_batch(create_account1, create_account2):
+    response = client.post("/operations/batch", json={"operations": [
+        {"type": "deposit", "account_id": create_account1['id'], "amount": 100.0, "pin": create_account1['pin']},
+        {"type": "transfer", "account_id": create_account1['id'], "to_id": create_account2['id'],
+         "amount": 600.0, "pin": create_account1['pin']},
+    ]})
+    assert response.status_code == 200
+    assert [r['balance'] for r in response.json()] == [1100.0, 500.0]
+    response = client.get(f"/accounts/{create_account2['id']}?pin={create_account2['pin']}")
+    assert response.json()['balance'] == create_account2['balance'] + 600.0
+
+@pytest.mark.parametrize("atomic, expected_status, expected_balance", [
+    (True, 400, 1000.0),
+    (False, 200, 1100.0),
+])
+def test_batch_failure_modes(create_account1, atomic, expected_status, expected_balance):
+    response = client.post("/operations/batch", json={"atomic": atomic, "operations": [
+        {"type": "deposit", "account_id": create_account1['id'], "amount": 100.0, "pin": create_account1['pin']},
+        {"type": "withdraw", "account_id": create_account1['id'], "amount": 100.0, "pin": "0000"},
+    ]})
+    assert response.status_code == expected_status
+    if atomic:
+        assert response.json()['detail'] == "Операция 1: Неверный PIN-код"
+    else:
+        assert [r['status'] for r in response.json()] == ["ok", "error"]
+    response = client.get(f"/accounts/{create_account1['id']}?pin={create_account1['pin']}")
+    assert response.json()['balance'] == expected_balance
+
+@pytest.mark.parametrize("operation", [
+    {"type": "refund", "account_id": 1, "amount": 1.0, "pin": "1234"},
+    {"type": "deposit", "account_id": 1, "amount": 1.0},
+])
+def test_batch_invalid_payload(operation):
+    response = client.post("/operations/batch", json={"operations": [operation]})
+    assert response.status_code == 422
+
+
+def test_batch_rejects_too_many_operations(create_account1):
+    operation = {"type": "deposit", "account_id": create_account1['id'], "amount": 1.0, "pin": create_account1['pin']}
+    response = client.post("/operations/batch", json={
+        "operations": [operation] * (settings.batch_max_operations + 1), "atomic": False
+    })
+    assert response.status_code == 422
+    response = client.get(f"/accounts/{create_account1['id']}?pin={create_account1['pin']}")
+    assert response.json()['balance'] == create_account1['balance']
+
+
+@pytest.mark.parametrize("content_type, body_template", [
+    ("application/x-ndjson", '{{"owner": "{owner}", "pin": "1234", "balance": 7.0}}\n{{"owner": "{owner}", "pin": "1234"}}\n'),
+    ("text/csv", "owner,pin,balance\n{owner},1234,7.0\n{owner},1234,\n"),
+])
+def test_import_accounts(content_type, body_template):
+    owner = random_owner_name()
+    response = client.post("/accounts/import", content=body_template.format(owner=owner),
+                           headers={"Content-Type": content_type})
+    assert response.status_code == 200
+    report = response.json()
+    assert (report["processed"], report["created"], report["rejected"]) == (2, 1, 1)
+    assert report["errors"][0]["reason"] == "Такой аккаунт уже существует"
+
+    db = SessionLocal()
+    account_id = db.query(BankAccount.id).filter(BankAccount.owner == owner).scalar()
+    db.close()
+    response = client.get(f"/accounts/{account_id}?pin=1234")
+    assert response.json()["balance"] == 7.0
+    client.delete(f"/accounts/delete/{account_id}?pin=1234")
+
+def test_import_accounts_unknown_format():
+    response = client.post("/accounts/import?format=xml", content="")
+    assert response.status_code == 400
+
+
+def test_get_operations(create_account1, query_count):
+    for amount in (10.0, 20.0, 30.0):
+        client.post(f"/accounts/{create_account1['id']}/deposit", json={"amount": amount, "pin": create_account1['pin']})
+    client.post(f"/accounts/{create_account1['id']}/withdraw", json={"amount": 5.0, "pin": create_account1['pin']})
+
+    response = client.get(f"/accounts/{create_account1['id']}/operations?pin={create_account1['pin']}&limit=3")
+    assert response.status_code == 200
+    assert query_count(response) <= 2
+    data = response.json()
+    assert [op['amount'] for op in data['items']] == [5.0, 30.0, 20.0]
+    response = client.get(f"/accounts/{create_account1['id']}/operations",
+                          params={"pin": create_account1['pin'], "cursor": data['next_cursor']})
+    assert response.json()['next_cursor'] is None
+    assert [op['amount'] for op in response.json()['items']] == [10.0]
+
+    response = client.get(f"/accounts/{create_account1['id']}/operations",
+                          params={"pin": create_account1['pin'], "type": "withdraw"})
+    assert [op['type'] for op in response.json()['items']] == ["Снятие"]
+    # Написание из выписок и аналитики — тот же фильтр.
+    response = client.get(f"/accounts/{create_account1['id']}/operations",
+                          params={"pin": create_account1['pin'], "type": "withdrawal"})
+    assert [op['type'] for op in response.json()['items']] == ["Снятие"]
+
+@pytest.mark.parametrize("query, expected_status, expected_detail", [
+    ("pin=0000", 400, "Неверный PIN-код"),
+    ("pin=1234&cursor=abc", 400, "Некорректный курсор"),
+    ("pin=1234&type=refund", 422, None),
+    ("pin=1234&limit=0", 422, None),
+    ("", 422, None),
+])
+def test_get_operations_invalid(create_account1, query, expected_status, expected_detail):
+    response = client.get(f"/accounts/{create_account1['id']}/operations?{query}")
+    assert response.status_code == expected_status
+    if expected_detail:
+        assert response.json()['detail'] == expected_detail
+
+
+@pytest.mark.parametrize("query, media_type, decode", [
+    ("", "application/x-ndjson", lambda body: [json.loads(line)["amount"] for line in body.decode().splitlines()]),
+    ("&gzip=true", "application/gzip",
+     lambda body: [json.loads(line)["amount"] for line in gzip.decompress(body).decode().splitlines()]),
+    ("&format=csv", "text/csv", lambda body: [float(line.split(",")[2]) for line in body.decode().splitlines()[1:]]),
+])
+def test_export_operations(create_account1, query, media_type, decode):
+    for amount in (10.0, 20.0):
+        client.post(f"/accounts/{create_account1['id']}/deposit", json={"amount": amount, "pin": create_account1['pin']})
+
+    response = client.get(f"/accounts/{create_account1['id']}/operations/export?pin={create_account1['pin']}{query}")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith(media_type)
+    assert "attachment" in response.headers["content-disposition"]
+    assert decode(response.content) == [10.0, 20.0]
+
+@pytest.mark.parametrize("query, expected_status", [
+    ("pin=0000", 400),
+    ("pin=1234&format=xml", 422),
+    ("", 422),
+])
+def test_export_operations_invalid(create_account1, query, expected_status):
+    response = client.get(f"/accounts/{create_account1['id']}/operations/export?{query}")
+    assert response.status_code == expected_status
+
+def test_deposit_busy_database_returns_503(create_account1, monkeypatch):
+    async def always_locked(name, work, after_commit=None):
+        raise TransactionConflict(name, 10, 5.0)
+
+    monkeypatch.setattr(functions.runner, "run_async", always_locked)
+    response = client.post(f"/accounts/{create_account1['id']}/deposit", json={"amount": 10.0, "pin": create_account1["pin"]})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert response.json()["detail"] == "База данных занята, повторите запрос позже"
+
+def test_balance_as_of(create_account1):
+    before = datetime.now(timezone.utc).isoformat()
+    client.post(f"/accounts/{create_account1['id']}/deposit", json={"amount": 25.0, "pin": create_account1["pin"]})
+
+    response = client.get(f"/accounts/{create_account1['id']}/balance", params={"pin": create_account1["pin"], "as_of": before})
+    assert response.status_code == 200
+    assert response.json()["balance"] == create_account1["balance"]
+    current = client.get(f"/accounts/{create_account1['id']}/balance", params={"pin": create_account1["pin"]}).json()
+    assert current == {"account_id": create_account1["id"], "balance": create_account1["balance"] + 25.0, "as_of": None}
+    assert client.get(f"/accounts/{create_account1['id']}/balance", params={"pin": "0000"}).status_code == 400
+
+def test_statement(create_account1):
+    client.post(f"/accounts/{create_account1['id']}/deposit", json={"amount": 40.0, "pin": create_account1["pin"]})
+    period = datetime.now(timezone.utc).strftime("%Y-%m")
+
+    response = client.get(f"/accounts/{create_account1['id']}/statement", params={"pin": create_account1["pin"], "period": period})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["period"] == period
+    assert data["operations"]["deposit"] == {"count": 1, "amount": 40.0}
+    assert data["closing_balance"] == create_account1["balance"] + 40.0
+
+    response = client.get(f"/accounts/{create_account1['id']}/statement", params={"pin": create_account1["pin"], "period": "2026-13"})
+    assert response.status_code == 400
+
+
+def test_metrics_endpoint(create_account1):
+    route = "/accounts/{account_id}/deposit"
+    before = metrics.http_requests.value(method="POST", route=route, status="2xx")
+    commits = metrics.db_commit_duration.count()
+    client.post(f"/accounts/{create_account1['id']}/deposit", json={"amount": 10.0, "pin": create_account1["pin"]})
+    client.get("/no-such-page")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    body = response.text
+    assert metrics.http_requests.value(method="POST", route=route, status="2xx") == before + 1
+    assert metrics.db_commit_duration.count() > commits
+    assert f'bank_http_request_db_queries_count{{route="{route}"}}' in body
+    assert f'bank_http_request_phase_seconds_count{{route="{route}",phase="commit"}}' in body
+    assert 'bank_http_requests_total{method="GET",route="unmatched",status="4xx"}' in body
+    assert 'bank_transactions_total{operation="deposit"}' in body
+    # Метки — шаблоны маршрутов, конкретные ID в них не попадают.
+    assert f"/accounts/{create_account1['id']}/" not in body
+
+
+def test_query_count_header_is_opt_in(create_account1):
+    response = client.get(f"/accounts/{create_account1['id']}?pin={create_account1['pin']}")
+    assert "x-query-count" not in response.headers
+
+
+def test_importing_main_does_not_load_app_or_database():
+    code = "import sys, app.main; print(sorted(m for m in ('app.functions', 'app.database') if m in sys.modules))"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True).stdout
+    assert output.strip() == "[]"
+
+
+def test_create_app_lifespan_prepares_schema():
+    with TestClient(create_app()) as fresh:
+        assert fresh.get("/").json() == {"message": "Welcome"}
+        assert fresh.get("/accounts/999999", params={"pin": "1234"}).status_code == 400
+
+
+def test_create_app_lifespan_starts_shards_and_recovers(monkeypatch, shard_urls):
+    from dataclasses import replace
+    from app import config, sharding
+
+    # Перевод, оставшийся в prepared у получателя: при старте приложения он отменяется.
+    router = sharding.ShardRouter(shard_urls)
+    router.init()
+    target = router.create_account(random_owner_name(), "4321", 0.0)
+    router.shard_for(target.id).run("prepare", lambda db: sharding._prepare_target(db, "crashed", 999, target.id, 5.0))
+    router.dispose()
+
+    sharded = replace(settings, shard_urls=",".join(shard_urls))
+    monkeypatch.setattr(config, "settings", sharded)
+    monkeypatch.setattr(sharding, "settings", sharded)
+    with TestClient(create_app()) as fresh:
+        assert functions.shard_router is not None
+        recovered = functions.shard_router.shard_for(target.id).read(lambda db: db.get(sharding.ShardTransfer, "crashed").state)
+        assert recovered == "aborted"
+
+        created = fresh.post("/accounts/", json={"owner": random_owner_name(), "pin": "1234", "balance": 100.0}).json()
+        response = fresh.post(f"/accounts/{created['id']}/deposit", json={"amount": 50.0, "pin": "1234"})
+        assert response.json()["balance"] == 150.0
+        shard = functions.shard_router.shard_for(created["id"])
+        assert shard.read(lambda db: db.get(BankAccount, created["id"]).balance) == 150.0
+        response = fresh.get(f"/accounts/{created['id']}/statement", params={"period": "2024-01", "pin": "1234"})
+        assert response.status_code == 400
+    assert functions.shard_router is None